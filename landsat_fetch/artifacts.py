@@ -0,0 +1,275 @@
+
+import hashlib
+import json
+import os
+import os.path
+import pickle
+import shutil
+import tempfile
+import threading
+import time
+
+from .common import LOGGER
+
+__all__ = ['artifact_store', 'memo_pool', 'memoize']
+
+def memoize(func, outputs, ignore=(), version=1):
+    # marks a *_one kernel as safe to skip when its outputs already exist in an artifact store. outputs are the
+    # positions of the output filenames in its job tuple, ignore the positions of parameters which don't affect the
+    # output (such as memory limits); version should be bumped whenever the kernel's output changes
+    func.outputs = tuple(outputs)
+    func.ignore = tuple(ignore)
+    func.version = version
+    return func
+
+def _link_or_copy(src, dst):
+    try:
+        os.unlink(dst)
+    except FileNotFoundError:
+        pass
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+class _output (object):
+    # stands in for the output filenames in a stored job result
+    def __init__(self, index):
+        self.index = index
+
+def _substitute(value, replace):
+    # applies replace to every leaf of a (nested) job result
+    if isinstance(value, tuple):
+        return tuple(_substitute(v, replace) for v in value)
+    if isinstance(value, list):
+        return [_substitute(v, replace) for v in value]
+    if isinstance(value, dict):
+        return {k: _substitute(v, replace) for k, v in value.items()}
+    return replace(value)
+
+class artifact_store (object):
+    # outputs of *_one jobs keyed by a hash of the kernel, its version, the keys of its input files and its other
+    # parameters. each entry is a directory holding the output files and the pickled job result; it is renamed into
+    # place complete, and the mtime of the result file serves as the last-use time for eviction by age and size
+
+    def __init__(self, path, max_bytes=None, max_age=None):
+        os.makedirs(path, mode=0o700, exist_ok=True)
+        self._path = path
+        self._max_bytes = max_bytes
+        self._max_age = max_age
+        self._keys = {}
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.shared = 0
+
+    def _entry(self, key):
+        return os.path.join(self._path, key[:2], key)
+
+    def register(self, filename, key):
+        st = os.stat(filename)
+        with self._lock:
+            self._keys[filename] = (key, st.st_size, st.st_mtime_ns)
+
+    def register_download(self, filename, url):
+        # published files never change, so a download is known by its url rather than by hashing it
+        self.register(filename, 'url:' + url)
+
+    def file_key(self, filename):
+        # files produced or restored by a job are known by the job's key and downloads by their url; anything else is
+        # identified by its contents
+        st = os.stat(filename)
+        with self._lock:
+            known = self._keys.get(filename)
+        if known is not None and known[1:] == (st.st_size, st.st_mtime_ns):
+            return known[0]
+        h = hashlib.sha256()
+        with open(filename, 'rb') as fh:
+            for chunk in iter(lambda: fh.read(1 << 20), b''):
+                h.update(chunk)
+        key = 'sha256:' + h.hexdigest()
+        self.register(filename, key)
+        return key
+
+    def _describe(self, value):
+        if isinstance(value, str) and os.path.isfile(value):
+            return ['file', self.file_key(value)]
+        if isinstance(value, (tuple, list)):
+            return [self._describe(v) for v in value]
+        return repr(value)
+
+    def job_key(self, func, job):
+        params = [self._describe(v) for i, v in enumerate(job) if i not in func.outputs and i not in func.ignore]
+        desc = json.dumps([func.__module__, func.__name__, func.version, params])
+        return hashlib.sha256(desc.encode('utf-8')).hexdigest()
+
+    def get(self, key, outputs):
+        # restores the outputs of the job with this key into the given filenames, returning its result
+        entry = self._entry(key)
+        result_file = os.path.join(entry, 'result.pickle')
+        try:
+            with open(result_file, 'rb') as fh:
+                result = pickle.load(fh)
+            for i, filename in enumerate(outputs):
+                _link_or_copy(os.path.join(entry, 'out{:d}'.format(i)), filename)
+            os.utime(result_file)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            with self._lock:
+                self.misses += 1
+            return False, None
+        with self._lock:
+            self.hits += 1
+        return True, _substitute(result, lambda v: outputs[v.index] if isinstance(v, _output) else v)
+
+    def claim(self, key):
+        # jobs with the same key (e.g. from overlapping requests to the job server) run once at a time: returns None
+        # if the caller is to run the job and finish the claim, or an event set once the job running it is done
+        with self._lock:
+            running = self._inflight.get(key)
+            if running is None:
+                self._inflight[key] = threading.Event()
+            else:
+                self.shared += 1
+            return running
+
+    def finish(self, key):
+        with self._lock:
+            running = self._inflight.pop(key)
+        running.set()
+
+    def put(self, key, outputs, result):
+        entry = self._entry(key)
+        os.makedirs(os.path.dirname(entry), mode=0o700, exist_ok=True)
+        tmp = tempfile.mkdtemp(dir=os.path.dirname(entry), suffix='.tmp')
+        try:
+            for i, filename in enumerate(outputs):
+                _link_or_copy(filename, os.path.join(tmp, 'out{:d}'.format(i)))
+            with open(os.path.join(tmp, 'result.pickle'), 'wb') as fh:
+                index = {f: i for i, f in enumerate(outputs)}
+                pickle.dump(_substitute(result, lambda v: _output(index[v]) if isinstance(v, str) and v in index else v), fh)
+            os.rename(tmp, entry)
+        except OSError:
+            # stored concurrently by another run
+            pass
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    def entries(self):
+        res = []
+        for prefix in os.listdir(self._path):
+            prefix_dir = os.path.join(self._path, prefix)
+            if not os.path.isdir(prefix_dir):
+                continue
+            for key in os.listdir(prefix_dir):
+                entry = os.path.join(prefix_dir, key)
+                if key.endswith('.tmp'):
+                    continue
+                try:
+                    used = os.path.getmtime(os.path.join(entry, 'result.pickle'))
+                    size = sum(os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry))
+                except OSError:
+                    continue
+                res.append((used, size, entry))
+        return res
+
+    def evict(self):
+        # walks the whole store, so workflows call it once they are done rather than after every map
+        if self._max_bytes is None and self._max_age is None:
+            return
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        now = time.time()
+        while entries:
+            used, size, entry = entries[0]
+            too_old = self._max_age is not None and now - used > self._max_age
+            too_big = self._max_bytes is not None and total > self._max_bytes
+            if not too_old and not too_big:
+                break
+            entries.pop(0)
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+            self.evictions += 1
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'shared': self.shared}
+
+class memo_pool (object):
+    # wraps an executor so jobs of memoized kernels whose outputs are already in the store are restored instead of
+    # run. a job already running for another map on the same store (such as a concurrent request to the job server)
+    # is waited for and then restored. virtual (.vrt) outputs only reference their inputs by name, so those jobs
+    # always run, but their outputs still get keys so jobs downstream of them can be reused
+    def __init__(self, pool, store):
+        self._pool = pool
+        self._store = store
+
+    def _restore(self, results, i, key, outputs):
+        found, res = self._store.get(key, outputs)
+        if found:
+            results[i] = res
+            for n, f in enumerate(outputs):
+                self._store.register(f, '{:s}:{:d}'.format(key, n))
+        return found
+
+    def _run(self, func, jobs, results, pending):
+        # runs the pending jobs, storing their outputs before finishing their claims so waiters find them
+        try:
+            for (i, key, outputs, virtual), res in zip(pending, self._pool.map(func, [jobs[i] for i, _, _, _ in pending])):
+                results[i] = res
+                if not virtual:
+                    self._store.put(key, outputs, res)
+                for n, f in enumerate(outputs):
+                    self._store.register(f, '{:s}:{:d}'.format(key, n))
+        finally:
+            for _, key, _, virtual in pending:
+                if not virtual:
+                    self._store.finish(key)
+
+    def map(self, func, jobs):
+        if not hasattr(func, 'outputs'):
+            return self._pool.map(func, jobs)
+
+        results = [None] * len(jobs)
+        pending = []
+        waiting = []
+        for i, job in enumerate(jobs):
+            key = self._store.job_key(func, job)
+            outputs = [job[o] for o in func.outputs]
+            virtual = any(f.endswith('.vrt') for f in outputs)
+            if not virtual:
+                if self._restore(results, i, key, outputs):
+                    continue
+                running = self._store.claim(key)
+                if running is not None:
+                    waiting.append((running, (i, key, outputs, virtual)))
+                    continue
+            pending.append((i, key, outputs, virtual))
+
+        if len(pending) < len(jobs):
+            LOGGER.info('Reusing {:d} of {:d} {:s} jobs from the artifact store...'.format(len(jobs) - len(pending), len(jobs), func.__name__))
+
+        self._run(func, jobs, results, pending)
+
+        # jobs run elsewhere are restored once they finish; any that failed there are claimed and run here
+        retry = []
+        for running, job in waiting:
+            i, key, outputs, _ = job
+            while running is not None:
+                running.wait()
+                if self._restore(results, i, key, outputs):
+                    break
+                running = self._store.claim(key)
+            else:
+                retry.append(job)
+        self._run(func, jobs, results, retry)
+        return results
+
+    def register_download(self, filename, url):
+        self._store.register_download(filename, url)
+
+    def apply_async(self, func, args=()):
+        return self._pool.apply_async(func, args)
+
+    def __getattr__(self, name):
+        return getattr(self._pool, name)
@@ -0,0 +1,63 @@
+
+import os
+import os.path
+import tempfile
+
+from ..common import LOGGER
+from .fixtures import generate
+from .server import fixture_server
+from .harness import CASES, run_case, save_results, compare_results
+
+__all__ = ['benchmark_workflow']
+
+class benchmark_workflow (object):
+    @classmethod
+    def register(cls, subparsers):
+        parser = subparsers.add_parser('benchmark')
+        parser.add_argument("-o", "--results", type=str, default="bench_results.jsonl", help="File to append results to (default bench_results.jsonl)")
+        parser.add_argument("--compare", type=str, default=None, help="Earlier results file to compare wall times against (optional)")
+        parser.add_argument("--workdir", type=str, default=None, help="Location for fixtures and outputs instead of a temporary directory")
+        parser.add_argument("-s", "--size", type=int, default=1024, help="Width and height of each synthetic scene in pixels (default 1024)")
+        parser.add_argument("-d", "--dates", type=int, default=2, help="Number of acquisitions per WRS cell (default 2)")
+        parser.add_argument("-c", "--case", type=str, action='append', default=None, choices=sorted(CASES), help="Benchmark to run (default is all)")
+        parser.add_argument("-n", "--num_workers", type=int, default=4, help="Number of worker threads to use in the workflows")
+        parser.set_defaults(func=cls.run)
+
+    @classmethod
+    def run(cls, args):
+        cases = args.case if args.case is not None else list(CASES)
+        workdir = args.workdir if args.workdir is not None else tempfile.mkdtemp()
+        fixture_dir = os.path.join(workdir, 'fixtures')
+        output_dir = os.path.join(workdir, 'output')
+        os.makedirs(output_dir, exist_ok=True)
+
+        LOGGER.info("Generating fixtures in {:s}...".format(fixture_dir))
+        dates = ['2019-{:02d}-01'.format(m + 1) for m in range(args.dates)]
+        ctx = generate(fixture_dir, size=args.size, dates=dates)
+        ctx.update({'root': fixture_dir, 'workdir': output_dir, 'num_workers': args.num_workers})
+
+        with fixture_server(fixture_dir) as server:
+            # the workflows and acquire pick the mirror up from the environment, including in spawned processes
+            os.environ['LANDSAT_8_URL'] = server.url + ctx['base']
+            results = [run_case(c, ctx) for c in cases]
+
+        for r in results:
+            if 'error' in r:
+                print('{:22s} failed: {:s}'.format(r['case'], r['error']))
+            else:
+                line = '{case:22s} {wall_s:8.2f} s {cpu_s:8.2f} cpu s {pixels_per_s:14.0f} px/s {mb_per_s:8.1f} MB/s {peak_rss_mb:8.1f} MB peak'.format(**r)
+                if r['scratch_mb'] is not None:
+                    line += ' {:8.1f} MB written'.format(r['scratch_mb'])
+                if r['stored_mb'] is not None:
+                    line += ' {:8.1f} MB stored'.format(r['stored_mb'])
+                print(line)
+                for phase, t in r['phases'].items():
+                    print('  {:20s} {:8.2f} s {:8.2f} cpu s'.format(phase, t['wall_s'], t['cpu_s']))
+                for check, value in r['checks'].items():
+                    print('  {:20s} {}'.format(check, value))
+
+        if args.compare is not None:
+            for case, old, new, ratio in compare_results(args.compare, results):
+                print('{:22s} {:8.2f} s -> {:8.2f} s ({:.2f}x)'.format(case, old, new, ratio))
+
+        save_results(args.results, results, {'size': args.size, 'dates': args.dates, 'num_workers': args.num_workers})
@@ -0,0 +1,125 @@
+
+import datetime
+import gzip
+import json
+import os
+import os.path
+
+import numpy as np
+import pandas as pd
+from osgeo import gdal, osr
+
+__all__ = ['generate']
+
+# scenes are laid out on a grid in UTM zone 13N, overlapping their neighbours like adjacent WRS cells do
+EPSG = 32613
+ORIGIN = (300000.0, 4000000.0)
+RESOLUTION = 30.0
+OVERLAP = 0.2
+
+def _footprint(gt, cols, rows):
+    utm = osr.SpatialReference()
+    utm.ImportFromEPSG(EPSG)
+    wgs84 = osr.SpatialReference()
+    wgs84.ImportFromEPSG(4326)
+    for srs in (utm, wgs84):
+        if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+            srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    transform = osr.CoordinateTransformation(utm, wgs84)
+    corners = [(gt[0] + c * gt[1], gt[3] + r * gt[5]) for c in (0, cols) for r in (0, rows)]
+    lonlat = np.array(transform.TransformPoints(corners))
+    return lonlat[:, 1].min(), lonlat[:, 0].min(), lonlat[:, 1].max(), lonlat[:, 0].max()
+
+def _band(rng, cols, rows, collar):
+    # smooth gradient plus noise in the DN range of real scenes, with a nodata collar like the edge of a scene
+    y, x = np.mgrid[0:rows, 0:cols].astype(np.float32)
+    arr = 8000 + 10000 * (x / cols) + 6000 * (y / rows) + rng.normal(0, 1500, (rows, cols)).astype(np.float32)
+    arr = np.clip(arr, 1, 65535).astype(np.uint16)
+    c = int(collar * cols)
+    r = int(collar * rows)
+    arr[:r, :] = 0
+    arr[-r:, :] = 0
+    arr[:, :c] = 0
+    arr[:, -c:] = 0
+    return arr
+
+def _write(filename, arr, gt):
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(EPSG)
+    rows, cols = arr.shape
+    ds = gdal.GetDriverByName('GTiff').Create(filename, cols, rows, 1, gdal.GDT_UInt16,
+                                              options=['TILED=YES', 'BLOCKXSIZE=512', 'BLOCKYSIZE=512', 'COMPRESS=DEFLATE'])
+    ds.SetGeoTransform(gt)
+    ds.SetProjection(srs.ExportToWkt())
+    ds.GetRasterBand(1).WriteArray(arr)
+    ds.FlushCache()
+
+def generate(root, size=1024, paths=(33, 34), rows=(36, 37), dates=('2019-01-01', '2019-02-01'), bands=(2, 3, 4, 8), seed=0):
+    # writes a mirror of LANDSAT_8_URL under root/c1/L8/: band TIFFs and MTL.json files for every (path, row, date),
+    # plus a gzipped scene list describing them. returns the base url path and the parameters to query them with
+    rng = np.random.default_rng(seed)
+    base = os.path.join(root, 'c1', 'L8')
+    os.makedirs(base, exist_ok=True)
+    step = size * RESOLUTION * (1 - OVERLAP)
+
+    scenes = []
+    for i, path in enumerate(paths):
+        for j, row in enumerate(rows):
+            gt = (ORIGIN[0] + i * step, RESOLUTION, 0.0, ORIGIN[1] - j * step, 0.0, -RESOLUTION)
+            min_lat, min_lon, max_lat, max_lon = _footprint(gt, size, size)
+            for k, date in enumerate(dates):
+                acquired = datetime.datetime.strptime(date, '%Y-%m-%d')
+                prod_id = 'LC08_L1TP_{:03d}{:03d}_{:s}_{:s}_01_T1'.format(path, row, acquired.strftime('%Y%m%d'), (acquired + datetime.timedelta(days=7)).strftime('%Y%m%d'))
+                prod_dir = os.path.join(base, '{:03d}'.format(path), '{:03d}'.format(row), prod_id)
+                os.makedirs(prod_dir, exist_ok=True)
+
+                mtl = {'IMAGE_ATTRIBUTES': {'SUN_ELEVATION': 30.0 + 5 * k, 'CLOUD_COVER': float(k)}, 'RADIOMETRIC_RESCALING': {}}
+                for b in bands:
+                    if b == 8:
+                        arr = _band(rng, size * 2, size * 2, 0.05)
+                        _write(os.path.join(prod_dir, '{:s}_B{:d}.TIF'.format(prod_id, b)), arr, (gt[0], RESOLUTION / 2, 0.0, gt[3], 0.0, -RESOLUTION / 2))
+                    else:
+                        arr = _band(rng, size, size, 0.05)
+                        _write(os.path.join(prod_dir, '{:s}_B{:d}.TIF'.format(prod_id, b)), arr, gt)
+                    mtl['RADIOMETRIC_RESCALING']['REFLECTANCE_MULT_BAND_{:d}'.format(b)] = 2.0e-05
+                    mtl['RADIOMETRIC_RESCALING']['REFLECTANCE_ADD_BAND_{:d}'.format(b)] = -0.1
+                with open(os.path.join(prod_dir, '{:s}_MTL.json'.format(prod_id)), 'w') as fh:
+                    json.dump({'L1_METADATA_FILE': mtl}, fh)
+
+                scenes.append({
+                    'productId': prod_id,
+                    'entityId': 'LC8{:03d}{:03d}{:s}LGN00'.format(path, row, acquired.strftime('%Y%j')),
+                    'acquisitionDate': acquired.strftime('%Y-%m-%d %H:%M:%S.%f'),
+                    'cloudCover': float(k),
+                    'processingLevel': 'L1TP',
+                    'path': path,
+                    'row': row,
+                    'min_lat': min_lat,
+                    'min_lon': min_lon,
+                    'max_lat': max_lat,
+                    'max_lon': max_lon,
+                    'download_url': 'index.html',
+                })
+
+    scene_list = os.path.join(base, 'scene_list.gz')
+    with gzip.open(scene_list, 'wt') as fh:
+        pd.DataFrame(scenes).to_csv(fh, index=False)
+
+    # a bounding box in the middle of the grid, touching every scene
+    df = pd.DataFrame(scenes)
+    lat = (df.min_lat.max() + df.max_lat.min()) / 2
+    lon = (df.min_lon.max() + df.max_lon.min()) / 2
+    half = (df.max_lat - df.min_lat).min() / 8
+
+    return {
+        'base': 'c1/L8/',
+        'scene_list': scene_list,
+        'bbox': [lat + half, lon - half, lat - half, lon + half],
+        'path': paths[0],
+        'row': rows[0],
+        'start': dates[0],
+        'end': (datetime.datetime.strptime(dates[-1], '%Y-%m-%d') + datetime.timedelta(days=1)).strftime('%Y-%m-%d'),
+        'bands': [b for b in bands if b != 8],
+        'products': scenes,
+        'first_date': [i for i, sc in enumerate(scenes) if sc['acquisitionDate'].startswith(dates[0])],
+    }
@@ -0,0 +1,423 @@
+
+import datetime
+import json
+import multiprocessing
+import os
+import os.path
+import resource
+import shutil
+import subprocess
+import sys
+import time
+
+import numpy as np
+from osgeo import gdal
+
+from ..common import LOGGER
+from ..storage import storage_policy
+
+__all__ = ['CASES', 'run_case', 'save_results', 'compare_results']
+
+def _band_file(ctx, prod_index, band):
+    prod = ctx['products'][prod_index]
+    return os.path.join(ctx['root'], ctx['base'], '{:03d}'.format(prod['path']), '{:03d}'.format(prod['row']), prod['productId'],
+                        '{:s}_B{:d}.TIF'.format(prod['productId'], band))
+
+def _pixels(files):
+    total = 0
+    for f in files:
+        ds = gdal.Open(f)
+        total += ds.RasterXSize * ds.RasterYSize * ds.RasterCount
+    return total
+
+def _size(files):
+    return sum(os.path.getsize(f) for f in files)
+
+def _out(ctx, name):
+    return os.path.join(ctx['workdir'], name)
+
+def _footprint_bbox(ctx, prod_index):
+    prod = ctx['products'][prod_index]
+    return [prod['min_lon'], prod['min_lat'], prod['max_lon'], prod['max_lat']]
+
+def _aoi_bbox(ctx):
+    lat0, lon0, lat1, lon1 = ctx['bbox']
+    return [lon0, lat1, lon1, lat0]
+
+def case_acquire(ctx):
+    from ..filemanager import tempfilemanager
+    from ..download import downloader
+    from ..executors import thread_executor
+    from ..product import product_set
+    from ..scenes import scenelist
+
+    sc = scenelist.load_or_acquire(ctx['scene_list'], columns=scenelist.COLUMNS)
+    entries = sc.all()
+    io_pool = thread_executor(ctx['num_workers'])
+    try:
+        with tempfilemanager(_out(ctx, 'acquire')) as mgr, downloader() as dl:
+            data = product_set.acquire_products(io_pool, mgr, entries, True, ctx['bands'] + [8], downloader=dl)
+            files = [f for _, prod in data.products for _, f in prod.bands]
+            return {'pixels': _pixels(files), 'bytes': _size(files)}
+    finally:
+        io_pool.close()
+
+def case_download_check(ctx):
+    # the downloader against its own fixture server: a file split into segments, a response cut short that has to
+    # resume (in one piece and in segments), a missing file and the rate cap. the server counts the bytes it sent,
+    # so a transfer that started over instead of resuming shows up as bytes fetched twice
+    from ..download import downloader, download_error
+    from .server import fixture_server
+    src = _out(ctx, 'download_src')
+    dst = _out(ctx, 'download_dst')
+    for d in (src, dst):
+        shutil.rmtree(d, ignore_errors=True)
+        os.makedirs(d)
+    segment = 256 * 1024
+    size = 3 * segment + 12345
+    data = np.random.default_rng(0).integers(0, 256, size, dtype=np.uint8).tobytes()
+    for name in ('segmented', 'resumed', 'resumed_segments', 'resumed_later', 'limited'):
+        with open(os.path.join(src, name), 'wb') as fh:
+            fh.write(data)
+
+    def fetch(server, dl, name, before=None):
+        before = server.bytes_served if before is None else before
+        filename = dl.fetch(server.url + name, os.path.join(dst, name))
+        with open(filename, 'rb') as fh:
+            if fh.read() != data:
+                raise AssertionError('{:s}: fetched file differs from the source'.format(name))
+        if server.bytes_served - before != size:
+            raise AssertionError('{:s}: {:d} bytes sent for a {:d} byte file'.format(name, server.bytes_served - before, size))
+        leftover = [f for f in os.listdir(dst) if f.startswith(name + '.part')]
+        if leftover:
+            raise AssertionError('{:s}: parts left behind: {!r}'.format(name, leftover))
+
+    checks = {}
+    with fixture_server(src) as server, downloader(segment_size=segment, max_segments=4, backoff=0.01) as dl:
+        fetch(server, dl, 'segmented')
+
+        server.cut('/resumed', segment // 3)
+        with downloader(segment_size=size, backoff=0.01) as single:
+            fetch(server, single, 'resumed')
+
+        # every segment's first response is cut short
+        server.cut('/resumed_segments', segment // 3, times=4)
+        fetch(server, dl, 'resumed_segments')
+
+        # a segmented transfer that fails for good keeps its parts, and fetching the file again picks them up
+        server.cut('/resumed_later', segment // 3, times=4)
+        before = server.bytes_served
+        with downloader(segment_size=segment, max_segments=4, retries=0) as failing:
+            try:
+                failing.fetch(server.url + 'resumed_later', os.path.join(dst, 'resumed_later'))
+                raise AssertionError('a transfer without retries survived a cut response')
+            except download_error:
+                pass
+        fetch(server, dl, 'resumed_later', before)
+
+        try:
+            dl.fetch(server.url + 'missing', os.path.join(dst, 'missing'))
+            raise AssertionError('fetching a missing file succeeded')
+        except download_error:
+            pass
+
+        rate = size // 4
+        with downloader(segment_size=segment, max_segments=4, max_rate=rate) as limited:
+            wall = time.perf_counter()
+            fetch(server, limited, 'limited')
+            wall = time.perf_counter() - wall
+        # the bucket starts with a second's worth of allowance
+        limited_rate = (size - rate) / wall
+        if limited_rate > rate * 1.1:
+            raise AssertionError('rate cap exceeded: {:.0f} bytes/s after the first second at a cap of {:d}'.format(limited_rate, rate))
+        checks['limited_rate'] = '{:.0f} bytes/s (cap {:d})'.format(limited_rate, rate)
+    return {'pixels': 0, 'bytes': 5 * size, 'checks': checks}
+
+def case_calibrate_one(ctx):
+    from ..operations.calibrate import calibrate_one
+    src = _band_file(ctx, 0, ctx['bands'][0])
+    calibrate_one(('bench', ctx['bands'][0], src, 2.0e-05, -0.1, 0.5, _out(ctx, 'calibrated.tiff'), 256 * 1024 * 1024, storage_policy()))
+    return {'pixels': _pixels([src]), 'bytes': _size([src])}
+
+def case_reproject_one(ctx):
+    from ..operations.reproject import reproject_one
+    src = _band_file(ctx, 0, ctx['bands'][0])
+    reproject_one(('bench', ctx['bands'][0], src, _footprint_bbox(ctx, 0), None, None, None, storage_policy(), _out(ctx, 'reprojected.tiff')))
+    return {'pixels': _pixels([src]), 'bytes': _size([src])}
+
+def case_reproject_preview_one(ctx):
+    from ..operations.reproject import reproject_one
+    from ..grid import fit_width
+    src = _band_file(ctx, 0, ctx['bands'][0])
+    bbox = _footprint_bbox(ctx, 0)
+    cols, rows = fit_width(bbox, 1080)
+    reproject_one(('bench', ctx['bands'][0], src, bbox, cols, rows, 'average', storage_policy(), _out(ctx, 'reprojected_preview.tiff')))
+    return {'pixels': _pixels([src]), 'bytes': _size([src])}
+
+def case_reproject_stack_one(ctx):
+    # all bands of a product warped in one pass, for comparison with reproject_one times the number of bands
+    from ..operations.reproject import reproject_one
+    from ..vrt import stacked_vrt
+    srcs = [_band_file(ctx, 0, b) for b in ctx['bands']]
+    stacked = stacked_vrt(_out(ctx, 'stacked.vrt'), srcs)
+    reproject_one(('bench', 'merged', stacked, _footprint_bbox(ctx, 0), None, None, None, storage_policy(), _out(ctx, 'reprojected_stack.tiff')))
+    return {'pixels': _pixels(srcs), 'bytes': _size(srcs)}
+
+def case_merge_one(ctx):
+    from ..operations.merge import merge_one
+    srcs = [_band_file(ctx, 0, b) for b in ctx['bands']]
+    merge_one(('bench', srcs, storage_policy(), _out(ctx, 'merged.tiff')))
+    return {'pixels': _pixels(srcs), 'bytes': _size(srcs)}
+
+def case_mosaic_one(ctx):
+    from ..operations.mosaic import mosaic_one
+    srcs = [_band_file(ctx, i, ctx['bands'][0]) for i in ctx['first_date']]
+    mosaic_one((ctx['bands'][0], srcs, _aoi_bbox(ctx), None, None, None, storage_policy(), _out(ctx, 'mosaic.tiff')))
+    return {'pixels': _pixels(srcs), 'bytes': _size(srcs)}
+
+def case_pansharpen_tile_one(ctx):
+    # the whole product as a single tile
+    from ..operations.pansharpen import pansharpen_tile_one
+    pan = _band_file(ctx, 0, 8)
+    spec = [_band_file(ctx, 0, b) for b in ctx['bands']]
+    ds = gdal.Open(pan)
+    window = (0, 0, ds.RasterXSize, ds.RasterYSize)
+    pansharpen_tile_one(('bench', 0, (pan, 1), [(f, 1) for f in spec], window, None, storage_policy(), _out(ctx, 'pansharpened.tiff')))
+    return {'pixels': _pixels([pan] + spec), 'bytes': _size([pan] + spec)}
+
+def _pansharpened_vrt(pan, spec):
+    # gdal's own weighted brovey pansharpening, with its default equal weights and cubic upsampling
+    bands = ''.join('<SpectralBand dstBand="{:d}"><SourceFilename relativeToVRT="0">{:s}</SourceFilename><SourceBand>1</SourceBand></SpectralBand>'.format(i + 1, f)
+                    for i, f in enumerate(spec))
+    return ('<VRTDataset subClass="VRTPansharpenedDataset"><PansharpeningOptions><Algorithm>WeightedBrovey</Algorithm>'
+            '<Resampling>Cubic</Resampling><NoData>0</NoData><PanchroBand><SourceFilename relativeToVRT="0">{:s}</SourceFilename>'
+            '<SourceBand>1</SourceBand></PanchroBand>{:s}</PansharpeningOptions></VRTDataset>').format(pan, bands)
+
+def case_pansharpen_check(ctx):
+    # the product pansharpened in tiles, compared with gdal's pansharpening of the same bands: reports the largest
+    # difference in DN and the number of pixels that are nodata in one but not the other
+    from ..operations.pansharpen import pansharpen_tile_one, _windows
+    pan = _band_file(ctx, 0, 8)
+    spec = [_band_file(ctx, 0, b) for b in ctx['bands']]
+    expected = gdal.Open(_pansharpened_vrt(pan, spec)).ReadAsArray().astype(np.int64)
+    max_diff, nodata_mismatch = 0, 0
+    for tile, window in enumerate(_windows(expected.shape[2], expected.shape[1], 512)):
+        out = _out(ctx, 'pansharpen_check_{:d}.tiff'.format(tile))
+        pansharpen_tile_one(('bench', tile, (pan, 1), [(f, 1) for f in spec], window, None, storage_policy(), out))
+        x, y, cols, rows = window
+        ds = gdal.Open(out)
+        actual = ds.ReadAsArray().astype(np.int64)
+        ref = expected[:, y:y + rows, x:x + cols]
+        max_diff = max(max_diff, int(np.abs(actual - ref).max()))
+        nodata_mismatch += int(((actual == 0) != (ref == 0)).sum())
+    return {'pixels': _pixels([pan] + spec), 'bytes': _size([pan] + spec), 'checks': {'max_diff': max_diff, 'nodata_mismatch': nodata_mismatch}}
+
+def case_to_jpeg_one(ctx):
+    from ..operations.to_jpeg import to_jpeg_one
+    src = _band_file(ctx, 0, ctx['bands'][0])
+    to_jpeg_one(('bench', ctx['bands'][0], src, [0, 65536, 0, 255], 1080, _out(ctx, 'frame.jpeg')))
+    return {'pixels': _pixels([src]), 'bytes': _size([src])}
+
+def _cli(ctx, *args):
+    cmd = [sys.executable, '-m', 'landsat_fetch.main'] + [str(a) for a in args] + ['-f', ctx['scene_list'], '-n', str(ctx['num_workers'])]
+    subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+def case_mosaic_workflow(ctx):
+    lat0, lon0, lat1, lon1 = ctx['bbox']
+    _cli(ctx, 'mosaic', _out(ctx, 'mosaic_workflow.tiff'), lat0, lon0, lat1, lon1, '--calibrate')
+    srcs = [_band_file(ctx, i, b) for i in ctx['first_date'] for b in ctx['bands']]
+    return {'pixels': _pixels(srcs), 'bytes': _size(srcs)}
+
+def case_timelapse_workflow(ctx):
+    _cli(ctx, 'timelapse', _out(ctx, 'timelapse_workflow.mp4'), ctx['path'], ctx['row'], ctx['start'], ctx['end'], '--calibrate')
+    srcs = [_band_file(ctx, i, b) for i, p in enumerate(ctx['products']) if (p['path'], p['row']) == (ctx['path'], ctx['row']) for b in ctx['bands']]
+    return {'pixels': _pixels(srcs), 'bytes': _size(srcs)}
+
+def _flaky_job(job):
+    # fails the first time it runs (or every time, if always_fail) and reports which worker process ran it; the
+    # marker file is created atomically, so exactly one attempt fails even with several workers. it takes a while,
+    # so no worker gets through the whole queue before the others have started
+    value, marker, always_fail = job
+    time.sleep(0.2)
+    if always_fail:
+        raise RuntimeError('job {:d} always fails'.format(value))
+    try:
+        os.close(os.open(marker, os.O_CREAT | os.O_EXCL))
+        raise RuntimeError('job {:d} fails once'.format(value))
+    except FileExistsError:
+        return value * value, os.getpid()
+
+def case_shared_executor(ctx):
+    # the shared queue served by two `landsat_fetch worker` processes standing in for hosts: every third job fails
+    # once and has to be retried, possibly by the other worker, and a job failing every time has to raise job_error
+    from ..executors import shared_dir_executor, job_error
+    queue = _out(ctx, 'queue')
+    markers = _out(ctx, 'queue_markers')
+    for d in (queue, markers):
+        shutil.rmtree(d, ignore_errors=True)
+        os.makedirs(d)
+    cmd = [sys.executable, '-m', 'landsat_fetch.main', 'worker', queue, '-n', '1', '--idle_exit', '10']
+    workers = [subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) for _ in range(2)]
+    try:
+        pool = shared_dir_executor(queue, retries=1, poll=0.05)
+        # a job with a marker that already exists doesn't fail
+        jobs = [(i, os.path.join(markers, str(i) if i % 3 == 0 else 'ok'), False) for i in range(24)]
+        open(os.path.join(markers, 'ok'), 'w').close()
+        results = pool.map(_flaky_job, jobs)
+        if [r for r, _ in results] != [i * i for i in range(24)]:
+            raise AssertionError('wrong results from the shared queue: {!r}'.format(results))
+        if pool.retried != 8:
+            raise AssertionError('expected 8 retries, got {:d}'.format(pool.retried))
+        pids = {pid for _, pid in results}
+        if pids != {w.pid for w in workers}:
+            raise AssertionError('expected jobs to run on both workers, ran on {:d}'.format(len(pids & {w.pid for w in workers})))
+        try:
+            pool.apply_async(_flaky_job, ((0, None, True),)).get()
+            raise AssertionError('a job failing on every attempt succeeded')
+        except job_error:
+            pass
+        if pool.retried != 9:
+            raise AssertionError('expected the failing job to be retried once, got {:d} retries'.format(pool.retried - 8))
+        return {'pixels': 0, 'bytes': 0, 'checks': {'jobs': len(jobs), 'retries': pool.retried, 'workers_used': len(pids)}}
+    finally:
+        for w in workers:
+            w.terminate()
+            w.wait()
+
+# intermediate storage variants, every compression with every reflectance type, each measured as a calibration, a
+# plain read of its output and a reprojection reading it, which (like the workflows) stays in the stored data type.
+# each phase is timed in wall and cpu time, so the gap between the two shows how much of it went to i/o rather than
+# computation or decompression
+STORAGE_POLICIES = {'{:s}_{:s}'.format(compress or 'none', reflectance): {'compress': compress, 'reflectance': reflectance}
+                    for compress in (None, 'deflate', 'zstd') for reflectance in ('float32', 'float16', 'uint16')}
+
+def _timed(func):
+    wall, cpu = time.perf_counter(), time.process_time()
+    func()
+    return time.perf_counter() - wall, time.process_time() - cpu
+
+def _read_all(filename):
+    ds = gdal.Open(filename)
+    for i in range(ds.RasterCount):
+        ds.GetRasterBand(i + 1).ReadAsArray()
+
+def _storage_case(policy):
+    def case(ctx):
+        from ..operations.calibrate import calibrate_one
+        from ..operations.reproject import reproject_one
+        storage = storage_policy(**policy)
+        src = _band_file(ctx, 0, ctx['bands'][0])
+        calibrated = _out(ctx, 'storage_calibrated.tiff')
+        reprojected = _out(ctx, 'storage_reprojected.tiff')
+        # the page cache is left as it is: the source is warm for every variant, and the stored raster has just
+        # been written when it is read
+        write = _timed(lambda: calibrate_one(('bench', ctx['bands'][0], src, 2.0e-05, -0.1, 0.5, calibrated, 256 * 1024 * 1024, storage)))
+        read = _timed(lambda: _read_all(calibrated))
+        warp = _timed(lambda: reproject_one(('bench', ctx['bands'][0], calibrated, _footprint_bbox(ctx, 0), None, None, None, storage, reprojected)))
+        return {'pixels': _pixels([src]), 'bytes': _size([src]), 'scratch_bytes': _size([calibrated, reprojected]),
+                'stored_bytes': _size([calibrated]), 'phases': {'calibrate': write, 'read': read, 'reproject': warp}}
+    return case
+
+CASES = {
+    'acquire': case_acquire,
+    'download_check': case_download_check,
+    'calibrate_one': case_calibrate_one,
+    'reproject_one': case_reproject_one,
+    'reproject_preview_one': case_reproject_preview_one,
+    'reproject_stack_one': case_reproject_stack_one,
+    'merge_one': case_merge_one,
+    'mosaic_one': case_mosaic_one,
+    'pansharpen_tile_one': case_pansharpen_tile_one,
+    'pansharpen_check': case_pansharpen_check,
+    'to_jpeg_one': case_to_jpeg_one,
+    'mosaic_workflow': case_mosaic_workflow,
+    'timelapse_workflow': case_timelapse_workflow,
+    'shared_executor': case_shared_executor,
+}
+CASES.update({'storage_{:s}'.format(k): _storage_case(v) for k, v in STORAGE_POLICIES.items()})
+
+def _cpu_time():
+    # user and system time of this process and of its reaped children (pool workers and workflow subprocesses)
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+def _own_peak_rss():
+    # VmHWM starts over when the case's interpreter is exec'd, while ru_maxrss keeps the peak of the process it was
+    # forked from (the benchmark itself, holding the fixtures)
+    try:
+        with open('/proc/self/status', 'r') as fh:
+            for line in fh:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def _measure(name, ctx, conn):
+    try:
+        wall = time.perf_counter()
+        cpu = _cpu_time()
+        stats = CASES[name](ctx)
+        wall = time.perf_counter() - wall
+        cpu = _cpu_time() - cpu
+        # ru_maxrss is in kilobytes on linux; children covers pool workers and workflow subprocesses
+        rss = _own_peak_rss()
+        child_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+        conn.send({
+            'case': name,
+            'wall_s': wall,
+            'cpu_s': cpu,
+            'pixels': stats['pixels'],
+            'bytes': stats['bytes'],
+            'pixels_per_s': stats['pixels'] / wall,
+            'mb_per_s': stats['bytes'] / wall / (1024 * 1024),
+            'peak_rss_mb': max(rss, child_rss) / (1024 * 1024),
+            'scratch_mb': stats['scratch_bytes'] / (1024 * 1024) if 'scratch_bytes' in stats else None,
+            'stored_mb': stats['stored_bytes'] / (1024 * 1024) if 'stored_bytes' in stats else None,
+            'phases': {k: {'wall_s': w, 'cpu_s': c} for k, (w, c) in stats.get('phases', {}).items()},
+            'checks': stats.get('checks', {}),
+        })
+    except Exception as e:
+        conn.send({'case': name, 'error': repr(e)})
+    finally:
+        conn.close()
+
+def run_case(name, ctx):
+    # each case runs in a freshly spawned interpreter so its peak RSS isn't polluted by earlier cases
+    LOGGER.info('Running benchmark {:s}...'.format(name))
+    mp = multiprocessing.get_context('spawn')
+    parent, child = mp.Pipe(False)
+    proc = mp.Process(target=_measure, args=(name, ctx, child))
+    proc.start()
+    child.close()
+    res = parent.recv()
+    proc.join()
+    return res
+
+def _commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(__file__), capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def save_results(filename, results, params):
+    run = {'timestamp': datetime.datetime.now().isoformat(), 'commit': _commit(), 'params': params}
+    with open(filename, 'a') as fh:
+        for r in results:
+            fh.write(json.dumps(dict(run, **r)) + '\n')
+
+def compare_results(filename, results):
+    # compares against the most recent result of each case in filename, as the ratio of wall times
+    previous = {}
+    with open(filename, 'r') as fh:
+        for line in fh:
+            r = json.loads(line)
+            if 'error' not in r:
+                previous[r['case']] = r
+    rows = []
+    for r in results:
+        old = previous.get(r['case'])
+        if old is not None and 'error' not in r:
+            rows.append((r['case'], old['wall_s'], r['wall_s'], r['wall_s'] / old['wall_s']))
+    return rows
@@ -0,0 +1,99 @@
+
+import http.server
+import os
+import os.path
+import re
+import threading
+
+__all__ = ['fixture_server']
+
+class _handler (http.server.BaseHTTPRequestHandler):
+    # serves files under the server's root with keep-alive and single-range requests, like S3 does
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def _respond(self, send_body):
+        path = os.path.normpath(os.path.join(self.server.root, self.path.split('?')[0].lstrip('/')))
+        if not path.startswith(self.server.root) or not os.path.isfile(path):
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        size = os.path.getsize(path)
+        start, end = 0, size - 1
+        match = re.match(r'bytes=(\d+)-(\d*)$', self.headers.get('Range', ''))
+        if match:
+            start = int(match.group(1))
+            end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {:d}-{:d}/{:d}'.format(start, end, size))
+        else:
+            self.send_response(200)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+
+        if send_body:
+            # a response cut short (see fixture_server.cut) ends after the given number of bytes, with the connection
+            with self.server.lock:
+                cut = self.server.cuts.get(self.path)
+                if cut is not None:
+                    cut[1] -= 1
+                    if cut[1] == 0:
+                        del self.server.cuts[self.path]
+            remaining = end - start + 1 if cut is None else min(end - start + 1, cut[0])
+            with open(path, 'rb') as fh:
+                fh.seek(start)
+                while remaining > 0:
+                    chunk = fh.read(min(remaining, 1 << 20))
+                    if not chunk:
+                        break
+                    # counted before sending, so a client never has the bytes before they are counted
+                    with self.server.lock:
+                        self.server.bytes_served += len(chunk)
+                    self.wfile.write(chunk)
+                    remaining -= len(chunk)
+            if cut is not None:
+                self.wfile.flush()
+                self.close_connection = True
+
+    def do_HEAD(self):
+        self._respond(False)
+
+    def do_GET(self):
+        self._respond(True)
+
+class fixture_server (object):
+    def __init__(self, root, port=0):
+        self._server = http.server.ThreadingHTTPServer(('127.0.0.1', port), _handler)
+        self._server.daemon_threads = True
+        self._server.root = os.path.abspath(root)
+        self._server.lock = threading.Lock()
+        self._server.bytes_served = 0
+        self._server.cuts = {}
+        self._thread = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{:d}/'.format(self._server.server_address[1])
+
+    @property
+    def bytes_served(self):
+        return self._server.bytes_served
+
+    def cut(self, path, nbytes, times=1):
+        # the next times responses for path (a url path such as /c1/L8/file) stop after nbytes of the body
+        with self._server.lock:
+            self._server.cuts[path] = [nbytes, times]
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._server.shutdown()
+        self._server.server_close()
@@ -0,0 +1,127 @@
+
+import hashlib
+import json
+import os
+import os.path
+import shutil
+import tempfile
+import time
+
+from .common import LOGGER
+
+__all__ = ['downloadcache']
+
+def _link_or_copy(src, dst):
+    try:
+        os.unlink(dst)
+    except FileNotFoundError:
+        pass
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+def _sha256(filename):
+    h = hashlib.sha256()
+    with open(filename, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+class downloadcache (object):
+    # each entry is a data file plus a json sidecar with its size, mtime and sha256; the sidecar is renamed into
+    # place last so it marks a complete entry, and its mtime serves as the last-access time for LRU eviction.
+    # a hit only compares the size and mtime of the data file with the sidecar, as hashing every band again would
+    # read the whole cache on each run; with verify, hits are checked against the sha256 as well. eviction is left to
+    # the caller (see evict), so a run storing many files walks the cache once
+
+    def __init__(self, path, max_bytes=None, verify=False):
+        os.makedirs(path, mode=0o700, exist_ok=True)
+        self._path = path
+        self._max_bytes = max_bytes
+        self._verify = verify
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _entry(self, prod, cat, ident):
+        base = os.path.join(self._path, prod, '{}_{}'.format(cat, ident))
+        return base + '.data', base + '.json'
+
+    def _drop(self, data_file, meta_file):
+        for f in (meta_file, data_file):
+            try:
+                os.unlink(f)
+            except FileNotFoundError:
+                pass
+
+    def get(self, prod, cat, ident, filename):
+        data_file, meta_file = self._entry(prod, cat, ident)
+        try:
+            with open(meta_file, 'r') as fh:
+                meta = json.load(fh)
+            st = os.stat(data_file)
+            # entries stored without an mtime are checked against their sha256
+            changed = st.st_size != meta['size'] or st.st_mtime_ns != meta.get('mtime_ns', st.st_mtime_ns)
+            if changed or ((self._verify or 'mtime_ns' not in meta) and _sha256(data_file) != meta['sha256']):
+                LOGGER.info('Discarding corrupt cache entry for {:s} {} {}'.format(prod, cat, ident))
+                self._drop(data_file, meta_file)
+                raise FileNotFoundError(data_file)
+        except (FileNotFoundError, ValueError, KeyError):
+            self.misses += 1
+            return False
+
+        os.utime(meta_file)
+        _link_or_copy(data_file, filename)
+        self.hits += 1
+        return True
+
+    def put(self, prod, cat, ident, filename):
+        data_file, meta_file = self._entry(prod, cat, ident)
+        dirname = os.path.dirname(data_file)
+        os.makedirs(dirname, mode=0o700, exist_ok=True)
+
+        fd, tmp_data = tempfile.mkstemp(dir=dirname, suffix='.tmp')
+        os.close(fd)
+        fd, tmp_meta = tempfile.mkstemp(dir=dirname, suffix='.tmp')
+        os.close(fd)
+        try:
+            _link_or_copy(filename, tmp_data)
+            st = os.stat(tmp_data)
+            with open(tmp_meta, 'w') as fh:
+                json.dump({'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'sha256': _sha256(tmp_data), 'stored': time.time()}, fh)
+            os.replace(tmp_data, data_file)
+            os.replace(tmp_meta, meta_file)
+        finally:
+            self._drop(tmp_data, tmp_meta)
+
+    def entries(self):
+        res = []
+        for dirpath, _, filenames in os.walk(self._path):
+            for f in filenames:
+                if not f.endswith('.json'):
+                    continue
+                meta_file = os.path.join(dirpath, f)
+                data_file = meta_file[:-len('.json')] + '.data'
+                try:
+                    res.append((os.path.getmtime(meta_file), os.path.getsize(data_file), data_file, meta_file))
+                except FileNotFoundError:
+                    pass
+        return res
+
+    def size(self):
+        return sum(size for _, size, _, _ in self.entries())
+
+    def evict(self):
+        if self._max_bytes is None:
+            return
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _, _ in entries)
+        while entries and total > self._max_bytes:
+            _, size, data_file, meta_file = entries.pop(0)
+            self._drop(data_file, meta_file)
+            total -= size
+            self.evictions += 1
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
@@ -0,0 +1,153 @@
+
+import json
+import os
+import os.path
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from .common import LOGGER
+
+__all__ = ['scenecatalog']
+
+# columns of scene_list.gz with a known compact representation; anything else is inferred
+DATE_COLUMNS = ['acquisitionDate']
+CATEGORY_COLUMNS = ['productId', 'entityId', 'processingLevel', 'download_url']
+NUMERIC_COLUMNS = {
+    'cloudCover': np.float32,
+    'path': np.int16,
+    'row': np.int16,
+    'min_lat': np.float32,
+    'min_lon': np.float32,
+    'max_lat': np.float32,
+    'max_lon': np.float32,
+}
+
+def _code_dtype(num_categories):
+    # the dtype pandas keeps categorical codes in; codes stored in any other one are copied on load
+    for dtype in (np.int8, np.int16, np.int32):
+        if num_categories < np.iinfo(dtype).max:
+            return dtype
+    return np.int64
+
+class scenecatalog (object):
+    # a columnar copy of the scene list: one .npy file per column (categorical columns store their codes, with the
+    # categories alongside in json), inside a version directory named by the CURRENT file so updates can be swapped in
+    # atomically while other processes still have the previous version mapped
+
+    def __init__(self, path):
+        self._path = path
+
+    def exists(self):
+        return os.path.exists(os.path.join(self._path, 'CURRENT'))
+
+    def _current(self):
+        with open(os.path.join(self._path, 'CURRENT'), 'r') as fh:
+            version = fh.read().strip()
+        with open(os.path.join(self._path, version, 'meta.json'), 'r') as fh:
+            return version, json.load(fh)
+
+    def columns(self):
+        return list(self._current()[1]['columns'])
+
+    def __len__(self):
+        return self._current()[1]['rows'] if self.exists() else 0
+
+    def _load_column(self, version, name, kind, mmap):
+        base = os.path.join(self._path, version, name)
+        mode = 'r' if mmap else None
+        if kind == 'category':
+            with open(base + '.categories.json', 'r') as fh:
+                categories = json.load(fh)
+            return pd.Categorical.from_codes(np.load(base + '.npy', mmap_mode=mode), categories)
+        return np.load(base + '.npy', mmap_mode=mode)
+
+    def load(self, columns=None, mmap=True):
+        version, meta = self._current()
+        if columns is None:
+            columns = list(meta['columns'])
+        # copy=False keeps one block per column instead of consolidating columns of the same dtype into a new array,
+        # so the columns stay memory-mapped and pages are only read as queries touch them
+        return pd.DataFrame({c: self._load_column(version, c, meta['columns'][c], mmap) for c in columns}, columns=columns, copy=False)
+
+    def _kind(self, name, series):
+        if name in DATE_COLUMNS:
+            return 'datetime'
+        if name in CATEGORY_COLUMNS or series.dtype == object:
+            return 'category'
+        return 'numeric'
+
+    def _convert(self, df):
+        for c in DATE_COLUMNS:
+            if c in df:
+                df[c] = pd.to_datetime(df[c])
+        for c, dtype in NUMERIC_COLUMNS.items():
+            if c in df:
+                df[c] = df[c].astype(dtype)
+        return df
+
+    def update(self, source, chunksize=1000000):
+        # appends the rows of the csv at source whose productId isn't in the catalog yet; everything else in the csv
+        # is skipped without conversion
+        if self.exists():
+            old_version, meta = self._current()
+            known = self._load_column(old_version, 'productId', 'category', True).categories
+        else:
+            old_version, meta, known = None, None, None
+
+        new_chunks = []
+        for chunk in pd.read_csv(source, chunksize=chunksize):
+            if known is not None:
+                chunk = chunk[~chunk.productId.isin(known)]
+            if len(chunk):
+                new_chunks.append(self._convert(chunk))
+
+        if not new_chunks:
+            LOGGER.info('Scene catalog is up to date ({:d} scenes)'.format(len(self)))
+            return 0
+        new = pd.concat(new_chunks, ignore_index=True)
+
+        os.makedirs(self._path, exist_ok=True)
+        version = tempfile.mkdtemp(dir=self._path, prefix='v')
+        kinds = meta['columns'] if meta is not None else {c: self._kind(c, new[c]) for c in new.columns}
+        rows = 0
+        for name, kind in kinds.items():
+            base = os.path.join(version, name)
+            values = new[name]
+            if kind == 'category':
+                categories = list(self._load_column(old_version, name, kind, True).categories) if old_version else []
+                index = {v: i for i, v in enumerate(categories)}
+                for v in values.unique():
+                    if not pd.isnull(v) and v not in index:
+                        index[v] = len(categories)
+                        categories.append(v)
+                codes = values.map(index).fillna(-1).to_numpy(dtype=np.int32)
+                if old_version:
+                    codes = np.concatenate([np.asarray(self._load_column(old_version, name, kind, True).codes, dtype=np.int32), codes])
+                with open(base + '.categories.json', 'w') as fh:
+                    json.dump(categories, fh)
+                np.save(base + '.npy', codes.astype(_code_dtype(len(categories))))
+                rows = len(codes)
+            else:
+                arr = values.to_numpy()
+                if old_version:
+                    old = self._load_column(old_version, name, kind, True)
+                    arr = np.concatenate([old, arr.astype(old.dtype)])
+                np.save(base + '.npy', arr)
+                rows = len(arr)
+
+        with open(os.path.join(version, 'meta.json'), 'w') as fh:
+            json.dump({'columns': kinds, 'rows': rows}, fh)
+
+        fd, current = tempfile.mkstemp(dir=self._path)
+        with os.fdopen(fd, 'w') as fh:
+            fh.write(os.path.basename(version))
+        os.replace(current, os.path.join(self._path, 'CURRENT'))
+
+        if old_version is not None:
+            shutil.rmtree(os.path.join(self._path, old_version), ignore_errors=True)
+
+        LOGGER.info('Added {:d} scenes to catalog ({:d} total)'.format(len(new), rows))
+        return len(new)
@@ -1,9 +1,11 @@
 
 import logging
+import os
 
 logging.basicConfig(level=logging.INFO)
 
 __all__ = ["LANDSAT_8_URL", "LOGGER"]
 
-LANDSAT_8_URL = "http://landsat-pds.s3.amazonaws.com/c1/L8/"
+# can be pointed at a mirror (or the benchmark server) through the environment
+LANDSAT_8_URL = os.environ.get("LANDSAT_8_URL", "http://landsat-pds.s3.amazonaws.com/c1/L8/")
 LOGGER = logging
@@ -0,0 +1,60 @@
+
+import numpy as np
+from osgeo import gdal, osr
+
+from .common import LOGGER
+from .artifacts import memoize
+
+__all__ = ['bbox_window', 'fetch_window_one']
+
+def _wgs84():
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(4326)
+    if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+        srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    return srs
+
+def bbox_window(ds, bbox, margin=2, samples=16):
+    # pixel window (xoff, yoff, xsize, ysize) of ds covering the lon/lat bounding box [x0, y0, x1, y1], expanded by
+    # margin pixels for resampling and aligned to the block grid so that no partially used tile is fetched
+    x0, y0, x1, y1 = bbox
+    dst = osr.SpatialReference(wkt=ds.GetProjection())
+    if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+        dst.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    transform = osr.CoordinateTransformation(_wgs84(), dst)
+
+    # the edges of the box are curved in the scene's projection, so sample along them rather than just the corners
+    t = np.linspace(0, 1, samples)
+    xs = np.concatenate([x0 + (x1 - x0) * t, np.full(samples, x1), x1 - (x1 - x0) * t, np.full(samples, x0)])
+    ys = np.concatenate([np.full(samples, y0), y0 + (y1 - y0) * t, np.full(samples, y1), y1 - (y1 - y0) * t])
+    points = np.array(transform.TransformPoints(list(zip(xs, ys))))
+
+    inv = gdal.InvGeoTransform(ds.GetGeoTransform())
+    cols = inv[0] + inv[1] * points[:, 0] + inv[2] * points[:, 1]
+    rows = inv[3] + inv[4] * points[:, 0] + inv[5] * points[:, 1]
+
+    bx, by = ds.GetRasterBand(1).GetBlockSize()
+    c0 = max(0, int(np.floor(cols.min())) - margin) // bx * bx
+    r0 = max(0, int(np.floor(rows.min())) - margin) // by * by
+    c1 = min(ds.RasterXSize, -(-(int(np.ceil(cols.max())) + margin) // bx) * bx)
+    r1 = min(ds.RasterYSize, -(-(int(np.ceil(rows.max())) + margin) // by) * by)
+
+    # keep at least one pixel so scenes that only touch the box still produce a valid (if empty) raster
+    c0 = min(c0, ds.RasterXSize - 1)
+    r0 = min(r0, ds.RasterYSize - 1)
+    return c0, r0, max(c1 - c0, 1), max(r1 - r0, 1)
+
+def fetch_window_one(tup):
+    prod, cat, ident, url, bbox, filename = tup
+    LOGGER.info('Fetching window of {:s}...'.format(url))
+
+    gdal.SetConfigOption('GDAL_DISABLE_READDIR_ON_OPEN', 'EMPTY_DIR')
+    gdal.SetConfigOption('CPL_VSIL_CURL_ALLOWED_EXTENSIONS', '.TIF,.tif,.tiff')
+
+    ds = gdal.Open('/vsicurl/' + url)
+    window = bbox_window(ds, bbox)
+    gdal.Translate(filename, ds, srcWin=list(window), creationOptions=['TILED=YES'])
+
+    return prod, cat, ident, filename
+
+memoize(fetch_window_one, [5])
@@ -0,0 +1,138 @@
+
+import http.server
+import json
+import threading
+import time
+
+from .common import LOGGER
+from .resources import resources
+
+__all__ = ['job_server']
+
+WORKFLOWS = ('mosaic', 'timelapse')
+
+class _handler (http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, fmt, *args):
+        LOGGER.debug(fmt % args)
+
+    def _reply(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path != '/status':
+            self._reply(404, {'error': 'not found'})
+            return
+        self._reply(200, self.server.jobs.status())
+
+    def do_POST(self):
+        if self.path != '/jobs':
+            self._reply(404, {'error': 'not found'})
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            argv = [str(a) for a in json.loads(self.rfile.read(length))['args']]
+        except (ValueError, KeyError, TypeError):
+            self._reply(400, {'error': 'expected a JSON object with an args list'})
+            return
+        status, body = self.server.jobs.submit(argv)
+        self._reply(status, body)
+
+class job_server (object):
+    # runs mosaic and timelapse requests (given as command lines) against one set of resident resources, so every
+    # request shares the scene list, worker pool, download cache and in-flight downloads. identical requests that
+    # arrive while one is already running wait for it instead of repeating the work; with an artifact store, so do
+    # the individual jobs that overlapping requests have in common
+    def __init__(self, parser, res, host='127.0.0.1', port=8750):
+        self._parser = parser
+        self._res = res
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._running = 0
+        self._completed = 0
+        self._failed = 0
+        self._coalesced = 0
+        self._server = http.server.ThreadingHTTPServer((host, port), _handler)
+        self._server.daemon_threads = True
+        self._server.jobs = self
+
+    def _run(self, argv):
+        if not argv or argv[0] not in WORKFLOWS:
+            return 400, {'status': 'failed', 'error': 'first argument must be one of {:s}'.format(', '.join(WORKFLOWS))}
+        try:
+            args = self._parser.parse_args(argv)
+        except SystemExit:
+            return 400, {'status': 'failed', 'error': 'invalid arguments: {:s}'.format(' '.join(argv))}
+        # workers, caches and stores are set up once when the server starts, so requests can't change them
+        given = resources.given_options(argv[1:])
+        if given:
+            return 400, {'status': 'failed', 'error': 'options set by the server: {:s}'.format(', '.join(given))}
+        for name, value in self._res.options.items():
+            setattr(args, name, value)
+
+        LOGGER.info('Running request: {:s}'.format(' '.join(argv)))
+        start = time.perf_counter()
+        try:
+            args.func(args, self._res)
+        except Exception as e:
+            LOGGER.info('Request failed: {}'.format(e))
+            return 500, {'status': 'failed', 'error': repr(e)}
+        return 200, {'status': 'done', 'seconds': time.perf_counter() - start}
+
+    def submit(self, argv):
+        key = tuple(argv)
+        with self._lock:
+            first = self._inflight.get(key)
+            if first is None:
+                job = [threading.Event(), (500, {'status': 'failed', 'error': 'interrupted'})]
+                self._inflight[key] = job
+                self._running += 1
+            else:
+                self._coalesced += 1
+        if first is not None:
+            first[0].wait()
+            return first[1]
+
+        try:
+            job[1] = self._run(argv)
+        finally:
+            with self._lock:
+                del self._inflight[key]
+                self._running -= 1
+                if job[1][0] == 200:
+                    self._completed += 1
+                else:
+                    self._failed += 1
+            job[0].set()
+        return job[1]
+
+    def status(self):
+        with self._lock:
+            status = {
+                'running': self._running,
+                'completed': self._completed,
+                'failed': self._failed,
+                'coalesced': self._coalesced,
+            }
+        status['bytes_fetched'] = self._res.downloader.bytes_fetched
+        status['memory_reserved'] = self._res.scheduler.reserved
+        if self._res.cache is not None:
+            status['cache'] = self._res.cache.stats()
+        if self._res.artifacts is not None:
+            status['artifacts'] = self._res.artifacts.stats()
+        return status
+
+    def serve_forever(self):
+        LOGGER.info('Accepting jobs on http://{:s}:{:d}/jobs...'.format(*self._server.server_address[:2]))
+        try:
+            self._server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self._server.server_close()
@@ -0,0 +1,278 @@
+
+import copy
+import http.client
+import os
+import os.path
+import random
+import shutil
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from .common import LOGGER
+
+__all__ = ['downloader', 'download_error']
+
+_RETRY_STATUS = {408, 429, 500, 502, 503, 504}
+_REDIRECT_STATUS = {301, 302, 303, 307, 308}
+
+class download_error (Exception):
+    pass
+
+class _connection_pool (object):
+    # idle keep-alive connections, per (scheme, host, port)
+    def __init__(self, timeout):
+        self._timeout = timeout
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def get(self, scheme, netloc):
+        with self._lock:
+            idle = self._idle.get((scheme, netloc))
+            if idle:
+                return idle.pop()
+        if scheme == 'https':
+            return http.client.HTTPSConnection(netloc, timeout=self._timeout)
+        return http.client.HTTPConnection(netloc, timeout=self._timeout)
+
+    def put(self, scheme, netloc, conn):
+        with self._lock:
+            self._idle.setdefault((scheme, netloc), []).append(conn)
+
+    def close(self):
+        with self._lock:
+            for conns in self._idle.values():
+                for c in conns:
+                    c.close()
+            self._idle = {}
+
+class _rate_limit (object):
+    # token bucket shared by every transfer of one downloader
+    def __init__(self, bytes_per_second):
+        self._rate = bytes_per_second
+        self._allowance = bytes_per_second
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, n):
+        if self._rate is None:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self._allowance = min(self._rate, self._allowance + (now - self._last) * self._rate) - n
+            self._last = now
+            delay = -self._allowance / self._rate if self._allowance < 0 else 0
+        if delay > 0:
+            time.sleep(delay)
+
+class downloader (object):
+    def __init__(self, num_workers=8, segment_size=16 * 1024 * 1024, max_segments=4, retries=5, backoff=1.0, max_rate=None, timeout=60):
+        self._segment_size = segment_size
+        self._max_segments = max_segments
+        self._retries = retries
+        self._backoff = backoff
+        self._connections = _connection_pool(timeout)
+        self._rate = _rate_limit(max_rate)
+        self._files = ThreadPoolExecutor(num_workers)
+        self._segments = ThreadPoolExecutor(num_workers * max_segments)
+        self._lock = threading.Lock()
+        self._inflight = {}
+        self._tracer = None
+        # shared with every traced view, so the resident downloader counts what its views fetch
+        self._counters = {'bytes_fetched': 0}
+
+    @property
+    def bytes_fetched(self):
+        with self._lock:
+            return self._counters['bytes_fetched']
+
+    def traced(self, tracer):
+        # a view of this downloader (sharing its connections, workers, rate limit, counters and in-flight transfers)
+        # that records each file it fetches with tracer
+        view = copy.copy(self)
+        view._tracer = tracer
+        return view
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._files.shutdown()
+        self._segments.shutdown()
+        self._connections.close()
+
+    def _request(self, method, url, headers, redirects=5):
+        # returns an open response along with the connection it must be read from and returned to
+        for _ in range(redirects + 1):
+            parts = urllib.parse.urlsplit(url)
+            path = parts.path + ('?' + parts.query if parts.query else '')
+            conn = self._connections.get(parts.scheme, parts.netloc)
+            try:
+                conn.request(method, path, headers=headers)
+                resp = conn.getresponse()
+            except (OSError, http.client.HTTPException):
+                # a stale keep-alive connection fails on first use; http.client reconnects after a close
+                conn.close()
+                conn.request(method, path, headers=headers)
+                resp = conn.getresponse()
+            if resp.status in _REDIRECT_STATUS:
+                resp.read()
+                self._release(parts, conn, resp)
+                url = urllib.parse.urljoin(url, resp.getheader('Location'))
+                continue
+            return parts, conn, resp
+        raise download_error('Too many redirects fetching {:s}'.format(url))
+
+    def _release(self, parts, conn, resp):
+        if resp.will_close:
+            conn.close()
+        else:
+            self._connections.put(parts.scheme, parts.netloc, conn)
+
+    def _retry(self, func, url):
+        for attempt in range(self._retries + 1):
+            try:
+                return func()
+            except download_error:
+                raise
+            except (OSError, http.client.HTTPException) as e:
+                if attempt == self._retries:
+                    raise download_error('Failed to fetch {:s}: {}'.format(url, e))
+                delay = self._backoff * (2 ** attempt) * (1 + random.random())
+                LOGGER.info('Retrying {:s} in {:.1f}s ({})...'.format(url, delay, e))
+                time.sleep(delay)
+
+    def _probe(self, url):
+        parts, conn, resp = self._request('HEAD', url, {})
+        resp.read()
+        self._release(parts, conn, resp)
+        if resp.status in _RETRY_STATUS:
+            raise http.client.HTTPException('HTTP {:d}'.format(resp.status))
+        if resp.status != 200:
+            raise download_error('HTTP {:d} fetching {:s}'.format(resp.status, url))
+        length = resp.getheader('Content-Length')
+        ranges = resp.getheader('Accept-Ranges', 'none').lower() == 'bytes'
+        return (int(length) if length is not None else None), ranges
+
+    def _fetch_range(self, url, filename, start, end):
+        # fetches bytes [start, end) into filename, resuming from whatever is already there;
+        # end is None when the length of the resource is unknown
+        have = os.path.getsize(filename) if os.path.exists(filename) else 0
+        if end is not None and start + have >= end:
+            open(filename, 'ab').close()
+            return
+        headers = {}
+        if have > 0 or start > 0 or end is not None:
+            headers['Range'] = 'bytes={:d}-{}'.format(start + have, '' if end is None else end - 1)
+
+        parts, conn, resp = self._request('GET', url, headers)
+        try:
+            if resp.status in _RETRY_STATUS:
+                raise http.client.HTTPException('HTTP {:d}'.format(resp.status))
+            if resp.status == 200 and 'Range' in headers:
+                if start > 0:
+                    raise download_error('Server ignored range request for {:s}'.format(url))
+                # the server can't resume, so start over
+                have = 0
+            elif resp.status not in (200, 206):
+                raise download_error('HTTP {:d} fetching {:s}'.format(resp.status, url))
+
+            with open(filename, 'ab' if have > 0 else 'wb') as fh:
+                while True:
+                    chunk = resp.read(64 * 1024)
+                    if not chunk:
+                        break
+                    self._rate.consume(len(chunk))
+                    fh.write(chunk)
+                    with self._lock:
+                        self._counters['bytes_fetched'] += len(chunk)
+        except BaseException:
+            conn.close()
+            raise
+        self._release(parts, conn, resp)
+
+        if end is not None and os.path.getsize(filename) != end - start:
+            raise http.client.IncompleteRead(b'', end - start - os.path.getsize(filename))
+
+    def _fetch_segment(self, url, filename, start, end):
+        return self._retry(lambda: self._fetch_range(url, filename, start, end), url)
+
+    def fetch(self, url, filename):
+        # concurrent fetches of one url (e.g. from overlapping requests to the job server) share a single transfer
+        with self._lock:
+            first = self._inflight.get(url)
+            if first is None:
+                transfer = [threading.Event(), filename, False]
+                self._inflight[url] = transfer
+        if first is not None:
+            LOGGER.info('Waiting for transfer of {:s} in progress...'.format(url))
+            first[0].wait()
+            if first[2]:
+                try:
+                    shutil.copyfile(first[1], filename)
+                    return filename
+                except OSError:
+                    # already cleaned up by the request that fetched it
+                    pass
+            return self.fetch(url, filename)
+        try:
+            self._transfer(url, filename)
+            transfer[2] = True
+            return filename
+        finally:
+            with self._lock:
+                del self._inflight[url]
+            transfer[0].set()
+
+    def _transfer(self, url, filename):
+        LOGGER.info('Fetching {:s}...'.format(url))
+        length, ranges = self._retry(lambda: self._probe(url), url)
+
+        if length is None or not ranges or length <= self._segment_size:
+            part = filename + '.part'
+            self._retry(lambda: self._fetch_range(url, part, 0, length if ranges else None), url)
+            os.replace(part, filename)
+            return filename
+
+        num_segments = min(self._max_segments, -(-length // self._segment_size))
+        bounds = [length * i // num_segments for i in range(num_segments + 1)]
+        # parts are named by their byte range, so fetching filename again (e.g. when the job is retried) resumes every
+        # segment where it stopped, as long as the resource still has the same length
+        parts = ['{:s}.part{:d}-{:d}'.format(filename, s, e) for s, e in zip(bounds[:-1], bounds[1:])]
+        futures = [self._segments.submit(self._fetch_segment, url, p, s, e) for p, s, e in zip(parts, bounds[:-1], bounds[1:])]
+        try:
+            for f in futures:
+                f.result()
+        except BaseException:
+            for f in futures:
+                f.cancel()
+            # the parts are kept for resuming, so no segment may still be writing to one
+            wait(futures)
+            raise
+
+        with open(filename, 'wb') as out:
+            for p in parts:
+                with open(p, 'rb') as fh:
+                    while True:
+                        chunk = fh.read(1 << 20)
+                        if not chunk:
+                            break
+                        out.write(chunk)
+                os.unlink(p)
+        return filename
+
+    def _fetch_one(self, tup):
+        prod, cat, ident, url, filename = tup
+        start = time.time()
+        wall = time.perf_counter()
+        self.fetch(url, filename)
+        if self._tracer is not None:
+            self._tracer.download(url, start, time.perf_counter() - wall, os.path.getsize(filename))
+        return prod, cat, ident, filename
+
+    def fetch_all(self, files):
+        return list(self._files.map(self._fetch_one, files))
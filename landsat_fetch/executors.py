@@ -0,0 +1,304 @@
+
+import multiprocessing
+import os
+import os.path
+import pickle
+import socket
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from .common import LOGGER
+
+__all__ = ['thread_executor', 'process_executor', 'shared_dir_executor', 'create_executor', 'check_scratch', 'run_worker', 'job_error']
+
+# executors run the *_one kernels of the operations; they all provide the subset of the multiprocessing.Pool
+# interface the operations use, map(func, jobs) and apply_async(func, (job,)), so a plain pool still works as one
+
+class job_error (Exception):
+    pass
+
+def _retrying(tup):
+    func, job, retries = tup
+    for attempt in range(retries + 1):
+        try:
+            return func(job)
+        except Exception as e:
+            if attempt == retries:
+                raise
+            LOGGER.info('Retrying {:s} after failure ({})...'.format(func.__name__, e))
+
+class _future_result (object):
+    # adapts a concurrent.futures future to the AsyncResult interface
+    def __init__(self, future):
+        self._future = future
+
+    def get(self, timeout=None):
+        return self._future.result(timeout)
+
+    def ready(self):
+        return self._future.done()
+
+    def wait(self, timeout=None):
+        try:
+            self._future.exception(timeout)
+        except Exception:
+            pass
+
+class thread_executor (object):
+    # for I/O-bound jobs (and jobs where GDAL releases the GIL): no pickling, no extra processes
+    def __init__(self, num_workers, retries=0):
+        self._pool = ThreadPoolExecutor(num_workers)
+        self._retries = retries
+
+    def map(self, func, jobs):
+        return list(self._pool.map(_retrying, [(func, j, self._retries) for j in jobs]))
+
+    def apply_async(self, func, args=()):
+        job, = args
+        return _future_result(self._pool.submit(_retrying, (func, job, self._retries)))
+
+    def close(self):
+        self._pool.shutdown()
+
+    def join(self):
+        pass
+
+class process_executor (object):
+    def __init__(self, num_workers, retries=0):
+        self._pool = multiprocessing.Pool(num_workers)
+        self._retries = retries
+
+    def map(self, func, jobs):
+        return self._pool.map(_retrying, [(func, j, self._retries) for j in jobs])
+
+    def apply_async(self, func, args=()):
+        job, = args
+        return self._pool.apply_async(_retrying, ((func, job, self._retries),))
+
+    def close(self):
+        self._pool.close()
+
+    def join(self):
+        self._pool.join()
+
+def _write_atomic(filename, obj):
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(filename), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as fh:
+            pickle.dump(obj, fh)
+        os.replace(tmp, filename)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+def _layout(root):
+    dirs = {d: os.path.join(root, d) for d in ('queue', 'running', 'done')}
+    for d in dirs.values():
+        os.makedirs(d, exist_ok=True)
+    return dirs
+
+class _shared_result (object):
+    def __init__(self, executor, job_id):
+        self._executor = executor
+        self._job_id = job_id
+
+    def get(self, timeout=None):
+        return self._executor._result(self._job_id, timeout)
+
+    def ready(self):
+        return os.path.exists(self._executor._done_file(self._job_id))
+
+    def wait(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self.ready() and (deadline is None or time.monotonic() < deadline):
+            self._executor._check_stale()
+            time.sleep(self._executor._poll)
+
+class shared_dir_executor (object):
+    # a job queue in a directory shared between hosts (e.g. over NFS). each job is a pickled file in queue/ which a
+    # worker (see run_worker) claims by renaming it into running/, and answers with a file in done/. workers touch
+    # their claimed job while it runs, so a job whose worker disappeared goes back on the queue after stale seconds.
+    # failed jobs are requeued up to retries times, possibly landing on another host. inputs and outputs are passed
+    # by filename, so the scratch directory (--keepfiles) has to be on the shared filesystem as well
+    def __init__(self, root, retries=0, poll=0.2, stale=120):
+        self._root = root
+        self._dirs = _layout(root)
+        self._retries = retries
+        self._poll = poll
+        self._stale = stale
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._last_check = time.monotonic()
+        # number of failed jobs put back on the queue
+        self.retried = 0
+
+    def _queue_file(self, job_id):
+        return os.path.join(self._dirs['queue'], job_id + '.job')
+
+    def _done_file(self, job_id):
+        return os.path.join(self._dirs['done'], job_id + '.result')
+
+    def _submit(self, func, job, job_id=None, attempt=0):
+        job_id = job_id or uuid.uuid4().hex
+        with self._lock:
+            self._jobs[job_id] = (func, job, attempt)
+        _write_atomic(self._queue_file(job_id), (func, job))
+        return job_id
+
+    def _requeue_stale(self):
+        now = time.time()
+        for name in os.listdir(self._dirs['running']):
+            claimed = os.path.join(self._dirs['running'], name)
+            try:
+                if now - os.path.getmtime(claimed) > self._stale:
+                    job_id = name.split('.')[0]
+                    LOGGER.info('Requeueing job {:s} from an unresponsive worker...'.format(job_id))
+                    os.rename(claimed, self._queue_file(job_id))
+            except OSError:
+                # finished or requeued in the meantime
+                pass
+
+    def _check_stale(self):
+        with self._lock:
+            due = time.monotonic() - self._last_check > self._stale / 4
+            if due:
+                self._last_check = time.monotonic()
+        if due:
+            self._requeue_stale()
+
+    def _wait(self, job_id, deadline):
+        done = self._done_file(job_id)
+        while True:
+            try:
+                with open(done, 'rb') as fh:
+                    res = pickle.load(fh)
+                os.unlink(done)
+                return res
+            except FileNotFoundError:
+                pass
+            if deadline is not None and time.monotonic() > deadline:
+                raise multiprocessing.TimeoutError()
+            self._check_stale()
+            time.sleep(self._poll)
+
+    def _result(self, job_id, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            ok, value = self._wait(job_id, deadline)
+            with self._lock:
+                func, job, attempt = self._jobs.pop(job_id)
+            if ok:
+                return value
+            if attempt >= self._retries:
+                raise job_error('Job {:s} ({:s}) failed: {:s}'.format(job_id, func.__name__, value))
+            LOGGER.info('Retrying job {:s} ({:s}) after failure ({:s})...'.format(job_id, func.__name__, value))
+            with self._lock:
+                self.retried += 1
+            self._submit(func, job, job_id, attempt + 1)
+
+    def map(self, func, jobs):
+        job_ids = [self._submit(func, j) for j in jobs]
+        return [self._result(j) for j in job_ids]
+
+    def apply_async(self, func, args=()):
+        job, = args
+        return _shared_result(self, self._submit(func, job))
+
+    def close(self):
+        pass
+
+    def join(self):
+        pass
+
+def create_executor(kind, num_workers, retries=0, root=None):
+    if kind == 'thread':
+        return thread_executor(num_workers, retries)
+    if kind == 'process':
+        return process_executor(num_workers, retries)
+    if kind == 'shared':
+        if root is None:
+            raise ValueError('The shared executor needs a queue directory')
+        return shared_dir_executor(root, retries)
+    raise ValueError('Unknown executor {:s}'.format(kind))
+
+def check_scratch(pool, scratch):
+    # jobs on a shared queue run on other hosts, which can't see a local temporary directory
+    if isinstance(pool, shared_dir_executor) and scratch is None:
+        raise ValueError('The shared executor needs a scratch directory on the shared filesystem (--keepfiles)')
+
+def _heartbeat(claimed, stop, interval):
+    while not stop.wait(interval):
+        try:
+            os.utime(claimed)
+        except OSError:
+            return
+
+def _run_job(dirs, name, worker_id, heartbeat):
+    job_id = name.split('.')[0]
+    claimed = os.path.join(dirs['running'], '{:s}.{:s}'.format(job_id, worker_id))
+    try:
+        os.rename(os.path.join(dirs['queue'], name), claimed)
+    except OSError:
+        # another worker got there first
+        return False
+    os.utime(claimed)
+
+    stop = threading.Event()
+    beat = threading.Thread(target=_heartbeat, args=(claimed, stop, heartbeat), daemon=True)
+    beat.start()
+    try:
+        with open(claimed, 'rb') as fh:
+            func, job = pickle.load(fh)
+        res = (True, func(job))
+    except Exception as e:
+        LOGGER.info('Job {:s} failed: {}'.format(job_id, e))
+        res = (False, repr(e))
+    finally:
+        stop.set()
+        beat.join()
+
+    try:
+        _write_atomic(os.path.join(dirs['done'], job_id + '.result'), res)
+    except Exception as e:
+        _write_atomic(os.path.join(dirs['done'], job_id + '.result'), (False, 'Unpicklable result: {!r}'.format(e)))
+    try:
+        os.unlink(claimed)
+    except OSError:
+        pass
+    return True
+
+def _worker_loop(root, poll, heartbeat, idle_exit):
+    dirs = _layout(root)
+    worker_id = '{:s}-{:d}'.format(socket.gethostname(), os.getpid())
+    LOGGER.info('Worker {:s} waiting for jobs in {:s}...'.format(worker_id, root))
+    idle_since = time.monotonic()
+    while True:
+        ran = False
+        for name in sorted(os.listdir(dirs['queue'])):
+            if name.endswith('.job'):
+                ran = _run_job(dirs, name, worker_id, heartbeat) or ran
+        if ran:
+            idle_since = time.monotonic()
+        elif idle_exit is not None and time.monotonic() - idle_since > idle_exit:
+            return
+        else:
+            time.sleep(poll)
+
+def run_worker(root, num_workers=1, poll=0.2, heartbeat=10, idle_exit=None):
+    # serves jobs from a shared_dir_executor queue with num_workers processes on this host until interrupted
+    # (or until no job has arrived for idle_exit seconds)
+    if num_workers == 1:
+        _worker_loop(root, poll, heartbeat, idle_exit)
+        return
+    procs = [multiprocessing.Process(target=_worker_loop, args=(root, poll, heartbeat, idle_exit)) for _ in range(num_workers)]
+    for p in procs:
+        p.start()
+    try:
+        for p in procs:
+            p.join()
+    except KeyboardInterrupt:
+        for p in procs:
+            p.terminate()
@@ -1,13 +1,19 @@
-
 import tempfile
 import os
 import os.path
 import shutil
+import threading
+
+from .common import LOGGER
 
 __all__ = ['tempfilemanager']
 
 class tempfilemanager (object):
-    def __init__(self, prefix=None, persist=False):
+    # scratch files of a workflow run. each file starts with one reference, held by the dataset it belongs to; an
+    # operation releases its inputs once it has produced its outputs, and a file is deleted as soon as its last
+    # reference is gone (unless persist is set). a file referring to others, such as a vrt, holds a reference to each
+    # of them through link. with a budget, throttle holds back new work while scratch usage is above it
+    def __init__(self, prefix=None, persist=False, budget=None):
         if prefix is None:
             prefix = tempfile.mkdtemp()
             self._rmdir = True
@@ -17,11 +23,19 @@ class tempfilemanager (object):
         self._prefix = prefix
         self._files = []
         self._persist = persist
+        self._budget = budget
+        self._refs = {}
+        self._links = {}
+        self._cond = threading.Condition()
+        self.peak = 0
 
     def __enter__(self):
         return self
 
     def __exit__(self, *args):
+        self.sample()
+        if self._files:
+            LOGGER.info('Peak scratch usage {:.1f} MB...'.format(self.peak / (1024 * 1024)))
         if not self._persist:
             for f in self._files:
                 try:
@@ -36,5 +50,70 @@ class tempfilemanager (object):
         if name == None:
             fd, name = tempfile.mkstemp(dir=self._prefix, suffix=suffix)
             os.close(fd)
-        self._files.append(name)
+        with self._cond:
+            self._files.append(name)
+            self._refs[name] = 1
         return name
+
+    def retain(self, files):
+        with self._cond:
+            for f in files:
+                if f in self._refs:
+                    self._refs[f] += 1
+
+    def link(self, derived, sources):
+        # derived refers to sources, so they live at least as long as it does
+        self.retain(sources)
+        with self._cond:
+            self._links.setdefault(derived, []).extend(sources)
+
+    def release(self, files):
+        # files not managed here (such as stored frames) are ignored
+        self.sample()
+        with self._cond:
+            pending = list(files)
+            while pending:
+                f = pending.pop()
+                if f not in self._refs:
+                    continue
+                self._refs[f] -= 1
+                if self._refs[f] > 0:
+                    continue
+                del self._refs[f]
+                pending += self._links.pop(f, [])
+                if not self._persist:
+                    try:
+                        os.unlink(f)
+                    except OSError:
+                        pass
+            self._cond.notify_all()
+
+    def usage(self):
+        with self._cond:
+            live = list(self._refs)
+        total = 0
+        for f in live:
+            try:
+                total += os.path.getsize(f)
+            except OSError:
+                pass
+        return total
+
+    def sample(self):
+        # files only shrink when they are released, so sampling before each release finds the peak. this looks at
+        # every live file, but with early cleanup there are only as many as the products in flight need
+        usage = self.usage()
+        self.peak = max(self.peak, usage)
+        return usage
+
+    def throttle(self, busy):
+        # waits while scratch usage is above the budget, as long as busy() says work in progress may still free space
+        if self._budget is None or self._persist:
+            return
+        waited = False
+        while self.sample() > self._budget and busy():
+            if not waited:
+                LOGGER.info('Scratch usage above {:.0f} MB, waiting for space...'.format(self._budget / (1024 * 1024)))
+                waited = True
+            with self._cond:
+                self._cond.wait(1.0)
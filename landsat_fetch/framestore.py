@@ -0,0 +1,51 @@
+
+import json
+import os
+import os.path
+import shutil
+import tempfile
+
+import numpy as np
+
+from .common import LOGGER
+
+__all__ = ['framestore']
+
+class framestore (object):
+    # rendered timelapse frames for one (path, row, bands, width, calibrate) combination, keyed by productId; the
+    # manifest records the bounding box each frame was reprojected to, since frames rendered for a different union
+    # footprint no longer line up with the rest
+    def __init__(self, root, path, row, bands, width, calibrate):
+        name = '{:03d}_{:03d}_b{:s}_w{:d}_{:s}'.format(path, row, '-'.join(str(b) for b in bands), width, 'cal' if calibrate else 'dn')
+        self._path = os.path.join(root, name)
+        os.makedirs(self._path, exist_ok=True)
+        self._manifest_file = os.path.join(self._path, 'manifest.json')
+        try:
+            with open(self._manifest_file, 'r') as fh:
+                self._manifest = json.load(fh)
+        except FileNotFoundError:
+            self._manifest = {}
+
+    def _current(self, prod_id, bbox):
+        entry = self._manifest.get(prod_id)
+        return entry is not None and np.allclose(entry['bbox'], bbox) and os.path.exists(os.path.join(self._path, entry['file']))
+
+    def missing(self, entries, bbox):
+        return [e for e in entries if not self._current(e.id, bbox)]
+
+    def put(self, entry, bbox, filename):
+        name = entry.id + os.path.splitext(filename)[1]
+        fd, tmp = tempfile.mkstemp(dir=self._path)
+        os.close(fd)
+        shutil.copyfile(filename, tmp)
+        os.replace(tmp, os.path.join(self._path, name))
+        self._manifest[entry.id] = {'date': entry.date, 'bbox': [float(v) for v in bbox], 'file': name}
+
+    def save(self):
+        fd, tmp = tempfile.mkstemp(dir=self._path)
+        with os.fdopen(fd, 'w') as fh:
+            json.dump(self._manifest, fh, indent=1, sort_keys=True)
+        os.replace(tmp, self._manifest_file)
+
+    def frame(self, prod_id):
+        return os.path.join(self._path, self._manifest[prod_id]['file'])
@@ -0,0 +1,48 @@
+
+import math
+from osgeo import gdal, osr
+
+__all__ = ['DST_SRS', 'output_grid', 'fit_width', 'native_width', 'tiles']
+
+DST_SRS = '+proj=longlat +ellps=WGS84'
+
+def output_grid(inputs, bbox):
+    # the pixel size gdal.Warp would choose for the whole mosaic (the finest of the sizes suggested for each input),
+    # adjusted so the bounding box is a whole number of pixels; computed from the input headers alone
+    srs = osr.SpatialReference()
+    srs.ImportFromProj4(DST_SRS)
+    dst_wkt = srs.ExportToWkt()
+
+    res_x, res_y = None, None
+    for f in inputs:
+        gt = gdal.AutoCreateWarpedVRT(gdal.Open(f), None, dst_wkt).GetGeoTransform()
+        res_x = gt[1] if res_x is None else min(res_x, gt[1])
+        res_y = abs(gt[5]) if res_y is None else min(res_y, abs(gt[5]))
+
+    x0, y0, x1, y1 = bbox
+    cols = max(1, int((x1 - x0) / res_x + 0.5))
+    rows = max(1, int((y1 - y0) / res_y + 0.5))
+    return cols, rows
+
+def tiles(bbox, cols, rows, tile_size):
+    # splits the output grid into tile_size square windows, yielding (index, bounds, cols, rows) for each
+    x0, y0, x1, y1 = bbox
+    res_x = (x1 - x0) / cols
+    res_y = (y1 - y0) / rows
+    for ty, row in enumerate(range(0, rows, tile_size)):
+        for tx, col in enumerate(range(0, cols, tile_size)):
+            w = min(tile_size, cols - col)
+            h = min(tile_size, rows - row)
+            yield (ty, tx), [x0 + col * res_x, y1 - (row + h) * res_y, x0 + (col + w) * res_x, y1 - row * res_y], w, h
+
+def fit_width(bbox, width):
+    # the grid of the given width covering bbox; gdal suggests square pixels when warping into DST_SRS, so this has
+    # the aspect of an image warped at full resolution and scaled down to width afterwards
+    x0, y0, x1, y1 = bbox
+    return width, max(1, int(width * (y1 - y0) / (x1 - x0) + 0.5))
+
+def native_width(bbox, pixel_size=30.0):
+    # the width giving pixels of about pixel_size metres (landsat's multispectral resolution by default) at the centre
+    # latitude of bbox, for when every product must be warped onto the same grid at roughly full resolution
+    x0, y0, x1, y1 = bbox
+    return max(1, int((x1 - x0) * 111320 * math.cos(math.radians((y0 + y1) / 2)) / pixel_size + 0.5))
@@ -4,16 +4,25 @@ from osgeo import gdal
 
 from .workflows.mosaic import mosaic_workflow
 from .workflows.timelapse import timelapse_workflow
+from .workflows.serve import serve_workflow
+from .workflows.worker import worker_workflow
+from .benchmark import benchmark_workflow
 
 gdal.AllRegister()
 
-def main():
+def build_parser():
     parser = argparse.ArgumentParser()
     subparsers = parser.add_subparsers()
 
     mosaic_workflow.register(subparsers)
     timelapse_workflow.register(subparsers)
+    serve_workflow.register(subparsers)
+    worker_workflow.register(subparsers)
+    benchmark_workflow.register(subparsers)
+    return parser
 
+def main():
+    parser = build_parser()
     args = parser.parse_args()
     try: 
         args.func(args)
@@ -0,0 +1,109 @@
+
+import json
+import os
+import sqlite3
+import threading
+
+import pandas as pd
+
+from .common import LOGGER
+from .download import downloader as http_downloader
+
+__all__ = ['metadatacatalog']
+
+# MTL fields kept in their own columns, for filtering and joining with the scene list: (column, group, field)
+FIELDS = [
+    ('sun_elevation', 'IMAGE_ATTRIBUTES', 'SUN_ELEVATION'),
+    ('sun_azimuth', 'IMAGE_ATTRIBUTES', 'SUN_AZIMUTH'),
+    ('earth_sun_distance', 'IMAGE_ATTRIBUTES', 'EARTH_SUN_DISTANCE'),
+    ('cloud_cover_land', 'IMAGE_ATTRIBUTES', 'CLOUD_COVER_LAND'),
+    ('image_quality_oli', 'IMAGE_ATTRIBUTES', 'IMAGE_QUALITY_OLI'),
+]
+# only the OLI bands have reflectance coefficients
+for b in range(1, 10):
+    FIELDS.append(('reflectance_mult_{:d}'.format(b), 'RADIOMETRIC_RESCALING', 'REFLECTANCE_MULT_BAND_{:d}'.format(b)))
+    FIELDS.append(('reflectance_add_{:d}'.format(b), 'RADIOMETRIC_RESCALING', 'REFLECTANCE_ADD_BAND_{:d}'.format(b)))
+
+# largest number of parameters in one sqlite query
+_MAX_VARIABLES = 500
+
+class metadatacatalog (object):
+    # parsed MTL metadata in an sqlite table keyed by productId: the fields above as columns, and the whole MTL as
+    # json so products read from the catalog carry the same metadata as ones whose MTL was downloaded. filled in
+    # batches of concurrent downloads for the products it is missing; shared between threads (and, through sqlite's
+    # locking, between processes)
+
+    def __init__(self, path):
+        if path != ':memory:':
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            if path != ':memory:':
+                self._conn.execute('PRAGMA journal_mode=WAL')
+            columns = ', '.join('{:s} REAL'.format(c) for c, _, _ in FIELDS)
+            self._conn.execute('CREATE TABLE IF NOT EXISTS metadata (productId TEXT PRIMARY KEY, {:s}, mtl TEXT)'.format(columns))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def _query(self, sql, ids):
+        # sql has a single {:s} for the placeholders of an IN clause
+        res = []
+        with self._lock:
+            for i in range(0, len(ids), _MAX_VARIABLES):
+                chunk = ids[i:i + _MAX_VARIABLES]
+                res += self._conn.execute(sql.format(', '.join('?' * len(chunk))), chunk).fetchall()
+        return res
+
+    def missing(self, product_ids):
+        ids = list(product_ids)
+        found = {r[0] for r in self._query('SELECT productId FROM metadata WHERE productId IN ({:s})', ids)}
+        return [p for p in ids if p not in found]
+
+    def get(self, product_ids):
+        return {r[0]: json.loads(r[1]) for r in self._query('SELECT productId, mtl FROM metadata WHERE productId IN ({:s})', list(product_ids))}
+
+    def put_many(self, items):
+        # items are (productId, parsed MTL) pairs
+        rows = []
+        for product_id, mtl in items:
+            groups = mtl['L1_METADATA_FILE']
+            values = [groups.get(group, {}).get(field) for _, group, field in FIELDS]
+            rows.append([product_id] + values + [json.dumps(mtl)])
+        placeholders = ', '.join('?' * (len(FIELDS) + 2))
+        with self._lock, self._conn:
+            self._conn.executemany('INSERT OR REPLACE INTO metadata VALUES ({:s})'.format(placeholders), rows)
+
+    def fill(self, entries, downloader, mgr, batch_size=256):
+        # fetches the MTL of every product missing from the catalog, batch_size at a time
+        wanted = {p.id: p for p in entries}
+        missing = [wanted[p] for p in self.missing(wanted)]
+        if not missing:
+            return
+        LOGGER.info('Adding metadata of {:d} products to the catalog...'.format(len(missing)))
+        if downloader is None:
+            with http_downloader() as d:
+                return self.fill(missing, d, mgr, batch_size)
+
+        for i in range(0, len(missing), batch_size):
+            files = [(p.id, 'meta', None, p.metadata_url(), mgr.add_file(suffix='.json')) for p in missing[i:i + batch_size]]
+            items = []
+            for prod, _, _, filename in downloader.fetch_all(files):
+                with open(filename, 'r') as fh:
+                    items.append((prod, json.load(fh)))
+            mgr.release([f[4] for f in files])
+            self.put_many(items)
+
+    def df(self, columns=None):
+        # the catalog as a frame, for joining with the scene list on productId
+        columns = [c for c, _, _ in FIELDS] if columns is None else list(columns)
+        with self._lock:
+            return pd.read_sql_query('SELECT productId, {:s} FROM metadata'.format(', '.join(columns)), self._conn)
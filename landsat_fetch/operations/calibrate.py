@@ -5,40 +5,117 @@ from osgeo import gdal
 
 from ..product import product_set, product
 from ..common import LOGGER
+from ..vrt import scaled_vrt
+from ..storage import storage_policy, REFLECTANCE_SCALE, REFLECTANCE_OFFSET
+from ..artifacts import memoize
+from ..scheduler import schedule
 
-__all__ = ['calibrate']
+__all__ = ['calibrate', 'reflectance_vrt']
+
+# bytes held per pixel while calibrating a window: the float32 working array plus the nodata mask
+_BYTES_PER_PIXEL = 5
+
+def window_rows(ds, max_memory):
+    # number of rows per window: a whole number of blocks, as many as fit in max_memory
+    _, block_rows = ds.GetRasterBand(1).GetBlockSize()
+    rows = max(1, max_memory // (ds.RasterXSize * _BYTES_PER_PIXEL))
+    return max(block_rows, rows // block_rows * block_rows)
 
 def calibrate_one(tup):
-    prod, band, orig_file, gain, bias, sun_elevation, new_file = tup
+    prod, band, orig_file, gain, bias, sun_elevation, new_file, max_memory, storage = tup
     LOGGER.info('Calibrating product {:s} band {}...'.format(prod, band))
 
     ds = gdal.Open(orig_file)
-    arr = ds.GetRasterBand(1).ReadAsArray().astype(np.float32)
-    rows, cols = arr.shape
+    cols, rows = ds.RasterXSize, ds.RasterYSize
+
+    # gain and bias are given per band of the input file
+    if np.isscalar(gain):
+        gain, bias = [gain], [bias]
 
     # calibration formula from https://www.usgs.gov/land-resources/nli/landsat/using-usgs-landsat-level-1-data-product
-    arr[arr != 0] = (arr[arr != 0] * gain + bias) / np.sin(sun_elevation)
+    # (dn * gain + bias) / sin(sun_elevation), folded into a single multiply-add
+    scale = [g / np.sin(sun_elevation) for g in gain]
+    offset = [b / np.sin(sun_elevation) for b in bias]
+
+    # scaled uint16 storage: shift and scale into the stored range (gdal rounds when writing); nodata stays 0
+    scaled = storage.reflectance == 'uint16'
+    if scaled:
+        offset = [(o - REFLECTANCE_OFFSET) / REFLECTANCE_SCALE for o in offset]
+        scale = [s / REFLECTANCE_SCALE for s in scale]
+    data_type = gdal.GDT_UInt16 if scaled else gdal.GDT_Float32
 
     driver = gdal.GetDriverByName("GTiff")
-    outdata = driver.Create(new_file, cols, rows, 1, gdal.GDT_Float32)
+    outdata = driver.Create(new_file, cols, rows, ds.RasterCount, data_type, options=storage.creation_options(data_type))
     outdata.SetGeoTransform(ds.GetGeoTransform())
     outdata.SetProjection(ds.GetProjection())
-    outdata.GetRasterBand(1).WriteArray(arr)
+
+    step = window_rows(ds, max_memory)
+    arr = np.empty((step, cols), dtype=np.float32)
+    mask = np.empty((step, cols), dtype=bool)
+    for y in range(0, rows, step):
+        n = min(step, rows - y)
+        a, m = arr[:n], mask[:n]
+        for i in range(ds.RasterCount):
+            ds.GetRasterBand(i + 1).ReadAsArray(0, y, cols, n, buf_obj=a)
+            np.equal(a, 0, out=m)
+            a *= scale[i]
+            a += offset[i]
+            if scaled:
+                np.clip(a, 1, 65535, out=a)
+            a[m] = 0
+            outdata.GetRasterBand(i + 1).WriteArray(a, 0, y)
     outdata.FlushCache()
 
     return prod, band, new_file
 
-def calibrate(pool, mgr, dataset):
+memoize(calibrate_one, [6], ignore=[7])
+schedule(calibrate_one, memory=lambda job: job[7])
+
+def calibrate_vrt_one(tup):
+    prod, band, orig_file, gain, bias, sun_elevation, new_file, _, storage = tup
+    LOGGER.info('Creating virtual calibrated product {:s} band {}...'.format(prod, band))
+
+    if np.isscalar(gain):
+        gain, bias = [gain], [bias]
+    scale = [g / np.sin(sun_elevation) for g in gain]
+    offset = [b / np.sin(sun_elevation) for b in bias]
+    if storage.reflectance == 'uint16':
+        # the same scaled integers calibrate_one writes, so every stage downstream sees one representation: clipped
+        # to 1, so reflectance below REFLECTANCE_OFFSET doesn't turn into nodata
+        scaled_vrt(new_file, orig_file, [s / REFLECTANCE_SCALE for s in scale], [(o - REFLECTANCE_OFFSET) / REFLECTANCE_SCALE for o in offset], data_type='UInt16', clamp=(1, 65535))
+    else:
+        scaled_vrt(new_file, orig_file, scale, offset)
+
+    return prod, band, new_file
+
+memoize(calibrate_vrt_one, [6], ignore=[7])
+
+def reflectance_vrt(mgr, filename):
+    # reflectance stored as uint16 (see storage_policy) is carried through warping, merging and mosaicking as is;
+    # the workflows read their final output through this virtual raster undoing the scaling
+    ds = gdal.Open(filename)
+    count = ds.RasterCount
+    scaled = scaled_vrt(mgr.add_file(suffix=".vrt"), filename, [REFLECTANCE_SCALE] * count, [REFLECTANCE_OFFSET] * count)
+    mgr.link(scaled, [filename])
+    mgr.release([filename])
+    return scaled
+
+def calibrate(pool, mgr, dataset, max_memory=256 * 1024 * 1024, lazy=False, storage=None):
+    # with uint16 reflectance the output stays scaled, and so does everything computed from it (see reflectance_vrt)
+    storage = storage or storage_policy()
     cal_jobs = []
     for prod_id, prod in dataset.products:
         sun_elevation = np.deg2rad(prod.meta['L1_METADATA_FILE']['IMAGE_ATTRIBUTES']['SUN_ELEVATION'])
         for band, filename in prod.bands:
             gain = prod.meta['L1_METADATA_FILE']['RADIOMETRIC_RESCALING']['REFLECTANCE_MULT_BAND_{:d}'.format(band)]
             bias = prod.meta['L1_METADATA_FILE']['RADIOMETRIC_RESCALING']['REFLECTANCE_ADD_BAND_{:d}'.format(band)]
-            cal_jobs.append((prod_id, band, filename, gain, bias, sun_elevation, mgr.add_file(suffix=".tiff")))
-    
+            cal_jobs.append((prod_id, band, filename, gain, bias, sun_elevation, mgr.add_file(suffix=".vrt" if lazy else ".tiff"), max_memory, storage))
+
     calibrated_data = defaultdict(lambda: {})
-    for prod, band, filename in pool.map(calibrate_one, cal_jobs):
+    for job, (prod, band, filename) in zip(cal_jobs, pool.map(calibrate_vrt_one if lazy else calibrate_one, cal_jobs)):
+        if lazy:
+            mgr.link(filename, [job[2]])
+        mgr.release([job[2]])
         calibrated_data[prod][('band', band)] = filename
 
-    return product_set({k: product(dataset[k].meta, product.get_bands(v)) for k, v in calibrated_data.items()})
\ No newline at end of file
+    return product_set({k: product(dataset[k].meta, product.get_bands(v)) for k, v in calibrated_data.items()})
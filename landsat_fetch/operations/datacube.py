@@ -0,0 +1,135 @@
+
+import json
+import os
+import os.path
+import zlib
+import numpy as np
+import pandas as pd
+from osgeo import gdal
+
+from ..product import product, product_set
+from ..common import LOGGER
+from ..scheduler import schedule
+
+__all__ = ['datacube']
+
+# the cube is a zarr (v2) group written directly: a .zarray with the shape, chunk shape and dtype of each array,
+# one file per chunk holding its C-ordered values (zlib compressed unless level is 0, in which case chunks can be
+# memory-mapped), and an _ARRAY_DIMENSIONS attribute naming the dimensions so xarray opens it with its coordinates
+
+def _zarray(shape, chunks, dtype, level, fill_value):
+    return {
+        'zarr_format': 2,
+        'shape': list(shape),
+        'chunks': list(chunks),
+        'dtype': dtype,
+        'compressor': {'id': 'zlib', 'level': level} if level else None,
+        'fill_value': fill_value,
+        'order': 'C',
+        'filters': None,
+        'dimension_separator': '.',
+    }
+
+def _encode(arr, level):
+    data = np.ascontiguousarray(arr).tobytes()
+    return zlib.compress(data, level) if level else data
+
+def _write_json(filename, obj):
+    with open(filename, 'w') as fh:
+        json.dump(obj, fh, indent=1)
+
+def cube_chunk_one(tup):
+    # writes every chunk of the time chunk starting at t0 from the frames of its time steps, so writers of different
+    # time chunks never touch the same file. chunks left entirely at the fill value aren't written; zarr reads missing
+    # chunks as the fill value
+    t0, files, shape, chunks, dtype, level, array_dir = tup
+    LOGGER.info('Writing datacube time steps {:d} to {:d}...'.format(t0, t0 + len(files) - 1))
+    _, bands, rows, cols = shape
+    ct, _, cy, cx = chunks
+
+    datasets = [gdal.Open(f) for f in files]
+    block = np.zeros(chunks, dtype=dtype)
+    written = 0
+    for yi, y in enumerate(range(0, rows, cy)):
+        for xi, x in enumerate(range(0, cols, cx)):
+            h, w = min(cy, rows - y), min(cx, cols - x)
+            block[...] = 0
+            for t, ds in enumerate(datasets):
+                block[t, :, :h, :w] = ds.ReadAsArray(x, y, w, h).reshape(bands, h, w)
+            if not block.any():
+                continue
+            with open(os.path.join(array_dir, '{:d}.0.{:d}.{:d}'.format(t0 // ct, yi, xi)), 'wb') as fh:
+                fh.write(_encode(block, level))
+            written += 1
+
+    return t0, written
+
+schedule(cube_chunk_one, memory=lambda job: 2 * int(np.prod(job[3])) * np.dtype(job[4]).itemsize)
+
+def _write_coordinate(path, name, values, level, dim, attrs=None):
+    array_dir = os.path.join(path, name)
+    os.makedirs(array_dir, exist_ok=True)
+    meta = _zarray(values.shape, values.shape, values.dtype.str, level, None)
+    attrs = dict(attrs or {}, _ARRAY_DIMENSIONS=[dim])
+    _write_json(os.path.join(array_dir, '.zarray'), meta)
+    _write_json(os.path.join(array_dir, '.zattrs'), attrs)
+    with open(os.path.join(array_dir, '0'), 'wb') as fh:
+        fh.write(_encode(values, level))
+    return meta, attrs
+
+def datacube(pool, mgr, dataset, path, dates, bands, chunks=(1, 512, 512), level=5, band='merged', scaling=None):
+    # writes the given band of every product, all on the same grid, as the (time, band, y, x) array 'data' of a zarr
+    # group at path, ordered by the acquisition dates in dates (product id to date). chunks is (time, y, x); each
+    # chunk holds every band. scaling is the (scale, offset) of values stored scaled, which readers following the cf
+    # conventions (such as xarray) apply when decoding
+    order = sorted((pd.Timestamp(dates[k]), k) for k, _ in dataset.products)
+    files = [dataset[k].band(band) for _, k in order]
+
+    ds = gdal.Open(files[0])
+    cols, rows, count = ds.RasterXSize, ds.RasterYSize, ds.RasterCount
+    gt = ds.GetGeoTransform()
+    dtype = ds.GetRasterBand(1).ReadAsArray(0, 0, 1, 1).dtype
+    for f in files[1:]:
+        other = gdal.Open(f)
+        if (other.RasterXSize, other.RasterYSize, other.RasterCount) != (cols, rows, count):
+            raise ValueError('Datacube frames are not on the same grid ({:s})'.format(f))
+
+    shape = (len(files), count, rows, cols)
+    chunks = (min(chunks[0], shape[0]), count, min(chunks[1], rows), min(chunks[2], cols))
+    LOGGER.info('Writing datacube of shape {} in chunks of {}...'.format(shape, chunks))
+
+    os.makedirs(path, exist_ok=True)
+    metadata = {'.zgroup': {'zarr_format': 2}}
+    _write_json(os.path.join(path, '.zgroup'), metadata['.zgroup'])
+
+    # product ids label the time steps as a second coordinate along time
+    ids = [k for _, k in order]
+    coordinates = [
+        ('time', 'time', np.array([t.value // 10 ** 9 for t, _ in order], dtype='<i8'), {'units': 'seconds since 1970-01-01', 'calendar': 'proleptic_gregorian'}),
+        ('product_id', 'time', np.array(ids, dtype='<U{:d}'.format(max(len(k) for k in ids))), None),
+        ('band', 'band', np.array(bands[:count], dtype='<i4'), None),
+        ('y', 'y', gt[3] + (np.arange(rows) + 0.5) * gt[5], {'units': 'degrees_north'}),
+        ('x', 'x', gt[0] + (np.arange(cols) + 0.5) * gt[1], {'units': 'degrees_east'}),
+    ]
+    for name, dim, values, attrs in coordinates:
+        meta, attrs = _write_coordinate(path, name, values, level, dim, attrs)
+        metadata[name + '/.zarray'] = meta
+        metadata[name + '/.zattrs'] = attrs
+
+    data_dir = os.path.join(path, 'data')
+    os.makedirs(data_dir, exist_ok=True)
+    metadata['data/.zarray'] = _zarray(shape, chunks, dtype.str, level, 0)
+    metadata['data/.zattrs'] = {'_ARRAY_DIMENSIONS': ['time', 'band', 'y', 'x'], 'coordinates': 'product_id'}
+    if scaling is not None:
+        metadata['data/.zattrs'].update(scale_factor=scaling[0], add_offset=scaling[1])
+    _write_json(os.path.join(data_dir, '.zarray'), metadata['data/.zarray'])
+    _write_json(os.path.join(data_dir, '.zattrs'), metadata['data/.zattrs'])
+    # consolidated metadata, so readers get every array's metadata in one request
+    _write_json(os.path.join(path, '.zmetadata'), {'zarr_consolidated_format': 1, 'metadata': metadata})
+
+    cube_jobs = [(t0, files[t0:t0 + chunks[0]], shape, chunks, dtype.str, level, data_dir) for t0 in range(0, len(files), chunks[0])]
+    written = sum(n for _, n in pool.map(cube_chunk_one, cube_jobs))
+    LOGGER.info('Wrote {:d} chunks...'.format(written))
+    mgr.release(files)
+
+    return product_set({'datacube': product(None, {band: path})})
@@ -1,10 +1,14 @@
-from collections import defaultdict
+from collections import defaultdict, deque
+import threading
+import numpy as np
 import ffmpeg as ff
+from osgeo import gdal
 
 from ..product import product_set, product
 from ..common import LOGGER
+from ..scheduler import schedule
 
-__all__ = ['ffmpeg']
+__all__ = ['ffmpeg', 'ffmpeg_stream', 'check_frame_bands']
 
 def ffmpeg_one(tup):
     band, files, rate, tmpfile, result = tup
@@ -14,7 +18,11 @@ def ffmpeg_one(tup):
         for f in files:
             fh.write("file {}\n".format(f))
     
-    ff.input(tmpfile, r=rate, f='concat', safe='0').output(result, r=30).run(overwrite_output=True, quiet=True)
+    # like the streamed frames, padded to even dimensions for yuv420p
+    (ff.input(tmpfile, r=rate, f='concat', safe='0')
+     .filter('pad', 'ceil(iw/2)*2', 'ceil(ih/2)*2')
+     .output(result, r=30, pix_fmt='yuv420p')
+     .run(overwrite_output=True, quiet=True))
     return band, result
 
 def ffmpeg(pool, mgr, dataset, framerate):
@@ -25,6 +33,108 @@ def ffmpeg(pool, mgr, dataset, framerate):
     ffmpeg_jobs = [(k, v, framerate, mgr.add_file(suffix='.txt'), mgr.add_file(suffix='.mp4')) for k, v in ffmpeg_jobs.items()]
     
     # bad things happened when i tried to parallelize this, so for now let's just do it this way
-    ffmpeg_out = [ffmpeg_one(j) for j in ffmpeg_jobs]
+    ffmpeg_out = []
+    for j in ffmpeg_jobs:
+        ffmpeg_out.append(ffmpeg_one(j))
+        mgr.release(j[1] + [j[3]])
 
     return product_set({'ffmpeg': product(None, {k: v for k, v in ffmpeg_out})})
+
+_PIXEL_FORMATS = {1: 'gray', 3: 'rgb24'}
+
+def check_frame_bands(count):
+    # frames are grayscale or rgb, both as piped raw video and as jpeg files
+    if count not in _PIXEL_FORMATS:
+        raise ValueError('Frames need 1 or 3 bands, not {:d}'.format(count))
+
+def render_frame_one(tup):
+    prod, band, orig_file, scale_parms, width = tup
+    LOGGER.info('Rendering frame for product {:s} band {}...'.format(prod, band))
+
+    ds = gdal.Translate('', orig_file, format='MEM', width=width, scaleParams=[scale_parms], outputType=gdal.GDT_Byte)
+    arr = ds.ReadAsArray()
+    if arr.ndim == 2:
+        arr = arr[np.newaxis]
+    count, rows, cols = arr.shape
+
+    # rawvideo wants pixel-interleaved rows
+    return prod, band, cols, rows, count, np.ascontiguousarray(arr.transpose(1, 2, 0)).tobytes()
+
+def _frame_bytes(job):
+    # the frame is held three times: as the MEM dataset, the array read from it and the interleaved copy
+    _, _, orig_file, _, width = job
+    ds = gdal.Open(orig_file)
+    rows = width * ds.RasterYSize // ds.RasterXSize
+    return 3 * width * rows * ds.RasterCount
+
+schedule(render_frame_one, memory=_frame_bytes)
+
+def encode_one(pool, band, jobs, rate, lookahead, result):
+    LOGGER.info('Streaming movie for band {}...'.format(band))
+
+    proc = None
+    shape = None
+    pending = deque()
+    jobs = iter(jobs)
+    try:
+        while True:
+            # keep up to lookahead frames rendering on the pool, but hand them to ffmpeg strictly in order
+            for j in jobs:
+                pending.append(pool.apply_async(render_frame_one, (j,)))
+                if len(pending) >= lookahead:
+                    break
+            if not pending:
+                break
+            prod, _, cols, rows, count, frame = pending.popleft().get()
+
+            if proc is None:
+                check_frame_bands(count)
+                shape = cols, rows, count
+                proc = (ff.input('pipe:', format='rawvideo', pix_fmt=_PIXEL_FORMATS[count], s='{:d}x{:d}'.format(cols, rows), r=rate)
+                        .filter('pad', 'ceil(iw/2)*2', 'ceil(ih/2)*2')
+                        .output(result, r=30, pix_fmt='yuv420p')
+                        .global_args('-loglevel', 'error', '-nostats')
+                        .overwrite_output()
+                        .run_async(pipe_stdin=True))
+            elif (cols, rows, count) != shape:
+                raise ValueError('Frame for product {:s} is {:d}x{:d}x{:d}, expected {:d}x{:d}x{:d}'.format(prod, cols, rows, count, *shape))
+
+            proc.stdin.write(frame)
+    finally:
+        if proc is not None:
+            try:
+                proc.stdin.close()
+            except BrokenPipeError:
+                pass
+            proc.wait()
+
+    if proc is None or proc.returncode != 0:
+        raise RuntimeError('ffmpeg failed to encode band {}'.format(band))
+    return band, result
+
+def ffmpeg_stream(pool, mgr, dataset, scale_parms, width, framerate, lookahead=8):
+    # renders frames straight from the rasters on the pool and pipes them into one ffmpeg process per band; each
+    # ffmpeg gets its own stdin pipe, so several can run at once without competing for the terminal
+    frame_jobs = defaultdict(lambda: [])
+    for prod_id, prod in dataset.products:
+        for b, filename in prod.bands:
+            frame_jobs[b].append((prod_id, b, filename, scale_parms, width))
+
+    results = {}
+    errors = []
+    def run(band, jobs, result):
+        try:
+            results[band] = encode_one(pool, band, jobs, framerate, lookahead, result)[1]
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run, args=(b, jobs, mgr.add_file(suffix='.mp4'))) for b, jobs in frame_jobs.items()]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if errors:
+        raise errors[0]
+    mgr.release([j[2] for jobs in frame_jobs.values() for j in jobs])
+
+    return product_set({'ffmpeg': product(None, results)})
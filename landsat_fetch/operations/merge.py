@@ -2,11 +2,15 @@ from osgeo import gdal
 
 from ..product import product, product_set
 from ..common import LOGGER
+from ..vrt import stacked_vrt
+from ..storage import storage_policy
+from ..artifacts import memoize
+from ..scheduler import schedule, raster_bytes
 
-__all__ = ["merge"]
+__all__ = ["merge", "stack"]
 
 def merge_one(tup):
-    prod_id, files, filename = tup
+    prod_id, files, storage, filename = tup
 
     LOGGER.info('Merging bands for product {:s}...'.format(prod_id))
 
@@ -18,7 +22,8 @@ def merge_one(tup):
         arr = ds.GetRasterBand(1).ReadAsArray()
         if outdata is None:
             rows, cols = arr.shape
-            outdata = driver.Create(filename, cols, rows, len(datasets), gdal.GDT_Float32)
+            data_type = ds.GetRasterBand(1).DataType
+            outdata = driver.Create(filename, cols, rows, len(datasets), data_type, options=storage.creation_options(data_type))
             outdata.SetGeoTransform(ds.GetGeoTransform())
             outdata.SetProjection(ds.GetProjection())
         outdata.GetRasterBand(i + 1).WriteArray(arr)
@@ -26,9 +31,43 @@ def merge_one(tup):
     
     return prod_id, filename
 
-def merge(pool, mgr, dataset):
+memoize(merge_one, [3])
+# one whole band is held at a time
+schedule(merge_one, memory=lambda job: raster_bytes(job[1][0]))
+
+def merge_vrt_one(tup):
+    prod_id, files, _, filename = tup
+    LOGGER.info('Creating virtual merged product {:s}...'.format(prod_id))
+    return prod_id, stacked_vrt(filename, files)
+
+memoize(merge_vrt_one, [3], ignore=[2])
+
+def merge(pool, mgr, dataset, lazy=False, storage=None):
+    storage = storage or storage_policy()
     merge_jobs = []
     for prod_id, prod in dataset.products:
         filenames = [f for _, f in prod.bands]
-        merge_jobs.append((prod_id, filenames, mgr.add_file(suffix=".tiff")))
-    return product_set({k: product(dataset[k].meta, {'merged': v}) for k, v in pool.map(merge_one, merge_jobs)})
+        merge_jobs.append((prod_id, filenames, storage, mgr.add_file(suffix=".vrt" if lazy else ".tiff")))
+    merged_data = dict(pool.map(merge_vrt_one if lazy else merge_one, merge_jobs))
+    for prod_id, files, _, filename in merge_jobs:
+        if lazy:
+            mgr.link(filename, files)
+        mgr.release(files)
+    return product_set({k: product(dataset[k].meta, {'merged': v}) for k, v in merged_data.items()})
+
+def stack(pool, mgr, dataset, bands):
+    # stacks the given bands of each product into a virtual 'merged' band ahead of warping, so the bands are warped
+    # in one pass and come out already merged. they must share a resolution; other bands (such as the panchromatic
+    # band) are passed through to be warped on their own
+    stack_jobs = []
+    for prod_id, prod in dataset.products:
+        stack_jobs.append((prod_id, [prod.band(b) for b in bands], None, mgr.add_file(suffix=".vrt")))
+
+    stacked_data = {}
+    for job, (prod_id, filename) in zip(stack_jobs, pool.map(merge_vrt_one, stack_jobs)):
+        mgr.link(filename, job[1])
+        mgr.release(job[1])
+        stacked_data[prod_id] = {b: f for b, f in dataset[prod_id].bands if b not in bands}
+        stacked_data[prod_id]['merged'] = filename
+
+    return product_set({k: product(dataset[k].meta, v) for k, v in stacked_data.items()})
@@ -1,24 +1,85 @@
 
+from collections import defaultdict
 from osgeo import gdal
 
 from ..common import LOGGER
 from ..product import product, product_set
+from ..artifacts import memoize
+from ..scheduler import schedule, WARP_MEMORY
+from ..grid import DST_SRS, output_grid, fit_width, tiles
+from ..storage import storage_policy
 
 __all__ = ['mosaic']
 
 def mosaic_one(tup):
-    band, inputs, bbox, new_file = tup
+    # cols and rows are None to warp at the resolution of the inputs
+    band, inputs, bbox, cols, rows, resample, storage, new_file = tup
     LOGGER.info('Creating mosaic for band {}...'.format(band))
-    gdal.Warp(new_file, inputs, dstSRS='+proj=longlat +ellps=WGS84', srcNodata=0, outputBounds=bbox)
+    gdal.Warp(new_file, inputs, dstSRS=DST_SRS, srcNodata=0, outputBounds=bbox, width=cols or 0, height=rows or 0, resampleAlg=resample,
+              multithread=True, warpMemoryLimit=WARP_MEMORY, creationOptions=storage.options_for(inputs[0]))
     return band, new_file
 
-def mosaic(pool, mgr, dataset, bands, bounding_box):
-    mosaic_jobs = []
+memoize(mosaic_one, [7])
+schedule(mosaic_one, memory=lambda job: WARP_MEMORY, threaded=True)
+
+def mosaic_tile_one(tup):
+    band, tile, inputs, bbox, cols, rows, resample, storage, new_file = tup
+    LOGGER.info('Creating mosaic tile {} for band {}...'.format(tile, band))
+    gdal.Warp(new_file, inputs, dstSRS=DST_SRS, srcNodata=0, outputBounds=bbox, width=cols, height=rows, resampleAlg=resample,
+              multithread=True, warpMemoryLimit=WARP_MEMORY, creationOptions=storage.options_for(inputs[0]))
+    return band, tile, new_file
+
+memoize(mosaic_tile_one, [8])
+schedule(mosaic_tile_one, memory=lambda job: WARP_MEMORY, threaded=True)
+
+def assemble_one(tup):
+    band, tiles, lazy, storage, new_file = tup
+    LOGGER.info('Assembling mosaic for band {}...'.format(band))
+    if lazy:
+        gdal.BuildVRT(new_file, tiles)
+    else:
+        gdal.Translate(new_file, gdal.BuildVRT('', tiles), creationOptions=storage.options_for(tiles[0]))
+    return band, new_file
+
+memoize(assemble_one, [4])
+schedule(assemble_one, threaded=True)
+
+def mosaic(pool, mgr, dataset, bands, bounding_box, tile_size=None, lazy=False, width=None, resample=None, storage=None):
+    storage = storage or storage_policy()
+    # with a width, every band is warped straight onto a grid of that width instead of the resolution of the inputs
+    grid = fit_width(bounding_box, width) if width is not None else (None, None)
+
+    mosaic_inputs = {}
     for b in bands:
         mosaic_files = []
         for _, prod in dataset.products:
             mosaic_files.append(prod.band(b))
-        mosaic_jobs.append((b, mosaic_files, bounding_box, mgr.add_file(suffix=".tiff")))
-    return product_set({'mosaic': product(None, {band: filename for band, filename in pool.map(mosaic_one, mosaic_jobs)})})
-    
+        mosaic_inputs[b] = mosaic_files
+
+    if tile_size is None:
+        mosaic_jobs = [(b, inputs, bounding_box, grid[0], grid[1], resample, storage, mgr.add_file(suffix=".tiff")) for b, inputs in mosaic_inputs.items()]
+        mosaic_data = {band: filename for band, filename in pool.map(mosaic_one, mosaic_jobs)}
+        for inputs in mosaic_inputs.values():
+            mgr.release(inputs)
+        return product_set({'mosaic': product(None, mosaic_data)})
+
+    tile_jobs = []
+    for b, inputs in mosaic_inputs.items():
+        cols, rows = grid if width is not None else output_grid(inputs, bounding_box)
+        for tile, bbox, w, h in tiles(bounding_box, cols, rows, tile_size):
+            tile_jobs.append((b, tile, inputs, bbox, w, h, resample, storage, mgr.add_file(suffix=".tiff")))
+    LOGGER.info('Creating mosaic in {:d} tiles...'.format(len(tile_jobs)))
+
+    tile_files = defaultdict(lambda: [])
+    for band, _, filename in pool.map(mosaic_tile_one, tile_jobs):
+        tile_files[band].append(filename)
+    for inputs in mosaic_inputs.values():
+        mgr.release(inputs)
 
+    assemble_jobs = [(b, tile_files[b], lazy, storage, mgr.add_file(suffix=".vrt" if lazy else ".tiff")) for b in mosaic_inputs]
+    mosaic_data = {band: filename for band, filename in pool.map(assemble_one, assemble_jobs)}
+    for _, files, _, _, filename in assemble_jobs:
+        if lazy:
+            mgr.link(filename, files)
+        mgr.release(files)
+    return product_set({'mosaic': product(None, mosaic_data)})
@@ -1,55 +1,124 @@
 
+import numpy as np
 from osgeo import gdal
 from collections import defaultdict
-import xml.etree.ElementTree as ET
 
 from ..product import product, product_set
-from ..common import LOGGER 
+from ..common import LOGGER
+from ..storage import storage_policy, REFLECTANCE_SCALE, REFLECTANCE_OFFSET
+from ..artifacts import memoize
+from ..scheduler import schedule
+from .mosaic import assemble_one
 
 __all__ = ['pansharpen']
 
-def pansharpen_one(tup):
-    prod_id, pan_file, spec_files, output_file = tup
-    LOGGER.info("Pansharpening product {:s}...".format(prod_id))
-
-    # adapted from https://github.com/OSGeo/gdal/blob/master/gdal/swig/python/scripts/gdal_pansharpen.py
-    root = ET.Element("VRTDataset")
-    root.set('subClass', 'VRTPansharpenedDataset')
-
-    opts = ET.SubElement(root, "PansharpeningOptions")
-    nodata = ET.SubElement(opts, "NoData")
-    nodata.text = "0"
-
-    pan_band_elem = ET.SubElement(opts, "PanchroBand")
-    pan_band_filename = ET.SubElement(pan_band_elem, "SourceFilename")
-    pan_band_filename.set("relativeToVRT", "0")
-    pan_band_filename.text = pan_file
-    pan_band_band = ET.SubElement(pan_band_elem, "SourceBand")
-    pan_band_band.text = "1"
-
-    for i, b in enumerate(spec_files):
-        spec_band_elem = ET.SubElement(opts, "SpectralBand")
-        spec_band_elem.set('dstBand', str(i + 1))
-        spec_band_filename = ET.SubElement(spec_band_elem, "SourceFilename")
-        spec_band_filename.set("relativeToVRT", "0")
-        spec_band_filename.text = b
-        spec_band_source = ET.SubElement(spec_band_elem, "SourceBand")
-        spec_band_source.text = "1"
-
-    vrt = gdal.Open(ET.tostring(root))
-    gdal.GetDriverByName("GTiff").CreateCopy(output_file, vrt)
-
-    return prod_id, output_file
-
-def pansharpen(pool, mgr, dataset, pan_band, spectral_bands):
-    pan_jobs = []
+_FLOAT_TYPES = (gdal.GDT_Float32, gdal.GDT_Float64)
+
+def _windows(cols, rows, tile_size):
+    # (x, y, cols, rows) pixel windows of at most tile_size square covering the raster
+    for y in range(0, rows, tile_size):
+        for x in range(0, cols, tile_size):
+            yield x, y, min(tile_size, cols - x), min(tile_size, rows - y)
+
+def pansharpen_tile_one(tup):
+    # pan and each of spec are (filename, band index) pairs; window is a pixel window of the panchromatic band.
+    # scaling is the (scale, offset) of reflectance stored as uint16, or None
+    prod_id, tile, pan, spec, window, scaling, storage, new_file = tup
+    LOGGER.info("Pansharpening product {:s} tile {:d}...".format(prod_id, tile))
+    x, y, cols, rows = window
+
+    pan_ds = gdal.Open(pan[0])
+    pan_arr = pan_ds.GetRasterBand(pan[1]).ReadAsArray(x, y, cols, rows).astype(np.float32)
+    gt = pan_ds.GetGeoTransform()
+    ulx, uly = gt[0] + x * gt[1], gt[3] + y * gt[5]
+    tile_gt = (ulx, gt[1], gt[2], uly, gt[4], gt[5])
+
+    # the spectral bands are upsampled onto this tile only (cubic, like gdal's pansharpening), reading each file once
+    spec_arr = np.empty((len(spec), rows, cols), dtype=np.float32)
+    by_file = defaultdict(lambda: [])
+    for i, (f, index) in enumerate(spec):
+        by_file[f].append((i, index))
+    for f, bands in by_file.items():
+        ds = gdal.Translate('', f, format='MEM', bandList=[index for _, index in bands], resampleAlg='cubic',
+                            projWin=[ulx, uly, ulx + cols * gt[1], uly + rows * gt[5]], width=cols, height=rows)
+        for n, (i, _) in enumerate(bands):
+            ds.GetRasterBand(n + 1).ReadAsArray(buf_obj=spec_arr[i])
+        ds = None
+
+    # pixels where pan or any band is nodata (0) stay nodata
+    nodata = (pan_arr == 0) | (spec_arr == 0).any(axis=0)
+    if scaling is not None:
+        # brovey isn't invariant to the offset of scaled reflectance, so it works on reflectance itself
+        scale, offset = scaling
+        pan_arr = pan_arr * scale + offset
+        spec_arr *= scale
+        spec_arr += offset
+
+    # weighted brovey with equal weights, gdal's default: every band is scaled by pan over the mean of the bands
+    pseudo_pan = spec_arr.mean(axis=0)
+    valid = ~nodata & (pseudo_pan > 0)
+    ratio = np.zeros_like(pan_arr)
+    np.divide(pan_arr, pseudo_pan, out=ratio, where=valid)
+    spec_arr *= ratio
+
+    if scaling is not None:
+        spec_arr -= offset
+        spec_arr /= scale
+        spec_arr[:, ~valid] = 0
+
+    spec_ds = gdal.Open(spec[0][0])
+    data_type = spec_ds.GetRasterBand(spec[0][1]).DataType
+    if data_type not in _FLOAT_TYPES:
+        # gdal rounds when writing integers; keep valid pixels from rounding down to nodata
+        np.maximum(spec_arr, 1, out=spec_arr, where=valid)
+
+    outdata = gdal.GetDriverByName("GTiff").Create(new_file, cols, rows, len(spec), data_type, options=storage.creation_options(data_type))
+    outdata.SetGeoTransform(tile_gt)
+    outdata.SetProjection(pan_ds.GetProjection())
+    for i in range(len(spec)):
+        outdata.GetRasterBand(i + 1).WriteArray(spec_arr[i])
+    outdata.FlushCache()
+
+    return prod_id, tile, new_file
+
+memoize(pansharpen_tile_one, [7])
+# the upsampled bands plus pan, pseudo pan, ratio and the mask, all as float32
+schedule(pansharpen_tile_one, memory=lambda job: job[4][2] * job[4][3] * 4 * (len(job[3]) + 4))
+
+def _source(prod, band):
+    # a band of the product, or a (band, index) pair for one band of a stacked product band
+    if isinstance(band, tuple):
+        return prod.band(band[0]), band[1]
+    return prod.band(band), 1
+
+def pansharpen(pool, mgr, dataset, pan_band, spectral_bands, storage=None, tile_size=None, lazy=False, scaled=False):
+    # the output (at the resolution of pan_band) is computed in tiles spread over the pool, then assembled per product.
+    # scaled says the bands are calibrated reflectance stored as uint16, which the output is stored as too
+    storage = storage or storage_policy()
+    tile_size = tile_size or 2048
+    scaling = (REFLECTANCE_SCALE, REFLECTANCE_OFFSET) if scaled else None
+    tile_jobs = []
     for prod_id, prod in dataset.products:
-        pan_file = prod.band(pan_band)
-        spec_files = [prod.band(b) for b in spectral_bands]
-        pan_jobs.append((prod_id, pan_file, spec_files, mgr.add_file(suffix=".tiff")))
-    
-    pan_data = defaultdict(lambda: {})
-    for prod, filename in pool.map(pansharpen_one, pan_jobs):
-        pan_data[prod][('band', 'pansharpened')] = filename
-
-    return product_set({k: product(dataset[k].meta, product.get_bands(v)) for k, v in pan_data.items()})
+        pan = _source(prod, pan_band)
+        spec = [_source(prod, b) for b in spectral_bands]
+        ds = gdal.Open(pan[0])
+        for tile, window in enumerate(_windows(ds.RasterXSize, ds.RasterYSize, tile_size)):
+            tile_jobs.append((prod_id, tile, pan, spec, window, scaling, storage, mgr.add_file(suffix=".tiff")))
+    LOGGER.info("Pansharpening in {:d} tiles...".format(len(tile_jobs)))
+
+    tile_files = defaultdict(lambda: [])
+    for prod_id, _, filename in pool.map(pansharpen_tile_one, tile_jobs):
+        tile_files[prod_id].append(filename)
+    # a stacked band supplies several spectral bands but is released once
+    mgr.release({f for job in tile_jobs for f, _ in [job[2]] + job[3]})
+
+    # products covered by a single tile need no assembly
+    pan_data = {k: v[0] for k, v in tile_files.items() if len(v) == 1}
+    assemble_jobs = [(k, v, lazy, storage, mgr.add_file(suffix=".vrt" if lazy else ".tiff")) for k, v in tile_files.items() if len(v) > 1]
+    pan_data.update(pool.map(assemble_one, assemble_jobs))
+    for _, tiles, _, _, filename in assemble_jobs:
+        if lazy:
+            mgr.link(filename, tiles)
+        mgr.release(tiles)
+
+    return product_set({k: product(dataset[k].meta, {'pansharpened': v}) for k, v in pan_data.items()})
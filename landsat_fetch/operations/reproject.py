@@ -3,24 +3,38 @@ from osgeo import gdal
 
 from ..product import product_set, product
 from ..common import LOGGER
+from ..artifacts import memoize
+from ..scheduler import schedule, WARP_MEMORY
+from ..grid import DST_SRS, fit_width
+from ..storage import storage_policy
 
 __all__ = ['reproject']
 
 def reproject_one(tup):
-    prod, band, orig_file, bbox, new_file = tup
+    # cols and rows are None to warp at the resolution of the input. when they are smaller, gdal warps from the
+    # input's overviews if it has any
+    prod, band, orig_file, bbox, cols, rows, resample, storage, new_file = tup
     LOGGER.info('Reprojecting product {} band {}...'.format(prod, band))
-    gdal.Warp(new_file, [orig_file], dstSRS='+proj=longlat +ellps=WGS84', srcNodata=0, outputBounds=bbox)
+    gdal.Warp(new_file, [orig_file], dstSRS=DST_SRS, srcNodata=0, outputBounds=bbox, width=cols or 0, height=rows or 0, resampleAlg=resample,
+              multithread=True, warpMemoryLimit=WARP_MEMORY, creationOptions=storage.options_for(orig_file))
 
     return prod, band, new_file
 
-def reproject(pool, mgr, dataset, bounding_box):
+memoize(reproject_one, [8])
+schedule(reproject_one, memory=lambda job: WARP_MEMORY, threaded=True)
+
+def reproject(pool, mgr, dataset, bounding_box, width=None, resample=None, storage=None):
+    storage = storage or storage_policy()
+    # with a width, every product is warped straight onto a grid of that width covering bounding_box
+    cols, rows = fit_width(bounding_box, width) if width is not None else (None, None)
     proj_jobs = []
     for prod_id, prod in dataset.products:
         for band, filename in prod.bands:
-            proj_jobs.append((prod_id, band, filename, bounding_box, mgr.add_file(suffix=".tiff")))
+            proj_jobs.append((prod_id, band, filename, bounding_box, cols, rows, resample, storage, mgr.add_file(suffix=".tiff")))
     
     reproj_data = defaultdict(lambda: {})
     for prod, band, filename in pool.map(reproject_one, proj_jobs):
         reproj_data[prod][('band', band)] = filename
+    mgr.release([job[2] for job in proj_jobs])
 
     return product_set({k: product(dataset[k].meta, product.get_bands(v)) for k, v in reproj_data.items()})
@@ -3,6 +3,7 @@ from osgeo import gdal
 
 from ..product import product_set, product
 from ..common import LOGGER
+from ..artifacts import memoize
 
 __all__ = ['to_jpeg']
 
@@ -15,6 +16,8 @@ def to_jpeg_one(tup):
 
     return prod, band, new_file
 
+memoize(to_jpeg_one, [5])
+
 def to_jpeg(pool, mgr, dataset, scale_parms, width):
     jpeg_jobs = []
     for prod_id, prod in dataset.products:
@@ -24,5 +27,6 @@ def to_jpeg(pool, mgr, dataset, scale_parms, width):
     transformed_data = defaultdict(lambda: {})
     for prod, band, filename in pool.map(to_jpeg_one, jpeg_jobs):
         transformed_data[prod][('band', band)] = filename
+    mgr.release([job[2] for job in jpeg_jobs])
 
     return product_set({k: product(dataset[k].meta, product.get_bands(v)) for k, v in transformed_data.items()})
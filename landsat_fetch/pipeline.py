@@ -0,0 +1,110 @@
+
+import queue
+import threading
+import time
+
+from .product import product_set
+from .common import LOGGER
+
+__all__ = ['stage', 'operation_stage', 'pipeline']
+
+_DONE = object()
+
+class stage (object):
+    def __init__(self, name, func, workers=1):
+        self.name = name
+        self.func = func
+        self.workers = workers
+
+def operation_stage(name, op, pool, mgr, *args, workers=1, **kwargs):
+    # wraps a whole-dataset operation such as calibrate or reproject so it runs on one product at a time
+    def run_one(prod_id, prod):
+        return op(pool, mgr, product_set({prod_id: prod}), *args, **kwargs)[prod_id]
+    return stage(name, run_one, workers)
+
+class pipeline (object):
+    # runs each item through a chain of stages as soon as it leaves the previous one; stages are connected by bounded
+    # queues so a fast stage can't run more than depth items ahead of the one it feeds. with scratch (a
+    # tempfilemanager), new items are held back while scratch usage is over its budget and items in flight may free
+    # some of it
+    def __init__(self, stages, depth=4, tracer=None, scratch=None):
+        self._stages = stages
+        self._depth = depth
+        self._tracer = tracer
+        self._scratch = scratch
+        self._in_flight = 0
+        self._error = None
+        self._lock = threading.Lock()
+
+    def _busy(self):
+        with self._lock:
+            return self._in_flight > 0 and self._error is None
+
+    def _worker(self, st, inq, outq, remaining):
+        while True:
+            item = inq.get()
+            if item is _DONE:
+                inq.put(_DONE)
+                with self._lock:
+                    remaining[0] -= 1
+                    last = remaining[0] == 0
+                if last:
+                    outq.put(_DONE)
+                return
+            if self._error is not None:
+                continue
+            key, value, queued = item
+            if st is self._stages[0]:
+                # items only start taking up scratch space in the first stage, so that is where they are held back
+                if self._scratch is not None:
+                    self._scratch.throttle(self._busy)
+                with self._lock:
+                    self._in_flight += 1
+            try:
+                if self._tracer is not None:
+                    with self._tracer.span(st.name, 'stage', key=key, queue_wait_s=time.time() - queued):
+                        value = st.func(key, value)
+                else:
+                    value = st.func(key, value)
+                outq.put((key, value, time.time()))
+            except BaseException as e:
+                LOGGER.info('Stage {:s} failed for {}: {}'.format(st.name, key, e))
+                with self._lock:
+                    if self._error is None:
+                        self._error = e
+
+    def run(self, items):
+        queues = [queue.Queue(self._depth) for _ in range(len(self._stages) + 1)]
+        threads = []
+        for st, inq, outq in zip(self._stages, queues[:-1], queues[1:]):
+            remaining = [st.workers]
+            for _ in range(st.workers):
+                t = threading.Thread(target=self._worker, args=(st, inq, outq, remaining), daemon=True)
+                t.start()
+                threads.append(t)
+
+        def feed():
+            for item in items:
+                if self._error is not None:
+                    break
+                queues[0].put(item + (time.time(),))
+            queues[0].put(_DONE)
+        feeder = threading.Thread(target=feed, daemon=True)
+        feeder.start()
+
+        results = {}
+        while True:
+            item = queues[-1].get()
+            if item is _DONE:
+                break
+            key, value, _ = item
+            results[key] = value
+            with self._lock:
+                self._in_flight -= 1
+
+        feeder.join()
+        for t in threads:
+            t.join()
+        if self._error is not None:
+            raise self._error
+        return results
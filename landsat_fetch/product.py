@@ -1,21 +1,25 @@
 
-import urllib.request
-from collections import defaultdict
 import json
-import os
 
 from .common import LANDSAT_8_URL, LOGGER
+from .download import downloader as http_downloader
+from .crop import fetch_window_one
 
 __all__ = ["product_index_entry", "product", "product_set"]
 
 class product_index_entry (object):
     def __init__(self, tup):
         self._id = tup.productId
+        self._date = str(getattr(tup, 'acquisitionDate', ''))
         self._base_url = LANDSAT_8_URL + '{:03d}/{:03d}/{:s}/{:s}_'.format(tup.path, tup.row, tup.productId, tup.productId)
 
     @property
     def id(self):
         return self._id
+
+    @property
+    def date(self):
+        return self._date
     
     def metadata_url(self):
         return self._base_url + "MTL.json"
@@ -41,7 +45,6 @@ class product (object):
 
         with open(filename, 'r') as fh:
             res = json.load(fh)
-        os.unlink(filename)
 
         return res
     
@@ -69,31 +72,84 @@ class product_set (object):
         return self._dict[key]
 
     @classmethod
-    def _acquire_one(cls, tup):
-        prod, cat, ident, url, filename = tup
-        LOGGER.info('Fetching {:s}...'.format(url))
-        return (prod, cat, ident, urllib.request.urlretrieve(url, filename)[0])
-
-    @classmethod
-    def acquire(cls, pool, mgr, scene_df, scenes, include_metadata, bands, most_recent_only=True):
-        files_needed = []
+    def select(cls, scene_df, scenes, most_recent_only=True):
+        entries = []
         for path, row in scenes:
             if most_recent_only:
-                prod = [scene_df.filter(lambda df: (df.path == path) & (df.row == row)).sort('acquisitionDate', ascending=True).first()]
+                entries.append(scene_df.cell(path, row).sort('acquisitionDate', ascending=True).first())
             else:
-                prod = scene_df.filter(lambda df: (df.path == path) & (df.row == row)).all()
-            for b in bands:
-                for p in prod:
+                entries += scene_df.cell(path, row).all()
+        return entries
+
+    @classmethod
+    def acquire(cls, pool, mgr, scene_df, scenes, include_metadata, bands, most_recent_only=True, cache=None, downloader=None, bounding_box=None, metadata=None):
+        entries = cls.select(scene_df, scenes, most_recent_only)
+        return cls.acquire_products(pool, mgr, entries, include_metadata, bands, cache, downloader, bounding_box, metadata)
+
+    @classmethod
+    def acquire_products(cls, pool, mgr, entries, include_metadata, bands, cache=None, downloader=None, bounding_box=None, metadata=None, fill_metadata=True):
+        # with a metadata catalog, the MTL of each product is read from it (after fetching whatever it is missing,
+        # unless fill_metadata is off because the caller already filled it) instead of being downloaded with the bands
+        files_needed = []
+        windows_needed = []
+        cached_files = []
+        for b in bands:
+            for p in entries:
+                if bounding_box is None:
                     files_needed.append((p.id, 'band', b, p.band_url(b), mgr.add_file(suffix='.tiff')))
-            if include_metadata:
-                for p in prod:
-                    files_needed.append((p.id, 'meta', None, p.metadata_url(), mgr.add_file(suffix='.json')))
+                else:
+                    windows_needed.append((p.id, 'band', b, p.band_url(b), bounding_box, mgr.add_file(suffix='.tiff')))
+        catalog_meta = {}
+        if include_metadata and metadata is not None:
+            if fill_metadata:
+                metadata.fill(entries, downloader, mgr)
+            catalog_meta = metadata.get([p.id for p in entries])
+        elif include_metadata:
+            for p in entries:
+                files_needed.append((p.id, 'meta', None, p.metadata_url(), mgr.add_file(suffix='.json')))
+
+        urls = {filename: url for _, cat, _, url, filename in files_needed if cat == 'band'}
+
+        if cache is not None:
+            uncached_files = []
+            for prod, cat, ident, url, filename in files_needed:
+                if cache.get(prod, cat, ident, filename):
+                    cached_files.append((prod, cat, ident, filename))
+                else:
+                    uncached_files.append((prod, cat, ident, url, filename))
+            files_needed = uncached_files
+            LOGGER.info('Found {:d} files in cache...'.format(len(cached_files)))
         
-        LOGGER.info('Acquiring {:d} files in {:d} scenes...'.format(len(files_needed), len(scenes)))
-        fetched_files = pool.map(cls._acquire_one, files_needed)
+        LOGGER.info('Acquiring {:d} files in {:d} products...'.format(len(files_needed), len(entries)))
+        if downloader is None:
+            with http_downloader() as d:
+                fetched_files = d.fetch_all(files_needed)
+        else:
+            fetched_files = downloader.fetch_all(files_needed)
+
+        if cache is not None:
+            for prod, cat, ident, filename in fetched_files:
+                cache.put(prod, cat, ident, filename)
+            LOGGER.info('Download cache: {hits:d} hits, {misses:d} misses, {evictions:d} evictions'.format(**cache.stats()))
+
+        # a memoizing pool identifies the downloaded bands by url, so jobs reading them don't hash them
+        register = getattr(pool, 'register_download', None)
+        if register is not None:
+            for _, cat, _, filename in cached_files + fetched_files:
+                if cat == 'band':
+                    register(filename, urls[filename])
+
+        # cropped bands depend on the bounding box, so they bypass the cache
+        if windows_needed:
+            LOGGER.info('Acquiring windows of {:d} files in {:d} products...'.format(len(windows_needed), len(entries)))
+        fetched_files += pool.map(fetch_window_one, windows_needed)
         
-        data = defaultdict(lambda: {})
-        for scene, cat, ident, value in fetched_files:
+        # keep the products in the order they were selected in, regardless of where each file came from
+        data = {p.id: {} for p in entries}
+        for scene, cat, ident, value in cached_files + fetched_files:
             data[scene][(cat, ident)] = value
         
-        return cls({k: product(product.get_metadata(v), product.get_bands(v)) for k, v in data.items()})
+        res = cls({k: product(catalog_meta[k] if k in catalog_meta else product.get_metadata(v), product.get_bands(v)) for k, v in data.items()})
+        # the parsed metadata is kept with each product, so its file is done with
+        mgr.release([v[('meta', None)] for v in data.values() if ('meta', None) in v])
+        return res
@@ -0,0 +1,116 @@
+
+import argparse
+import threading
+
+from .artifacts import artifact_store
+from .cache import downloadcache
+from .common import LOGGER
+from .download import downloader
+from .executors import create_executor, thread_executor
+from .metadata import metadatacatalog
+from .scenes import scenelist
+from .scheduler import scheduler
+
+__all__ = ['resources']
+
+class resources (object):
+    # the state a workflow run needs besides its arguments: executors, job scheduler, download cache, artifact store,
+    # metadata catalog, downloader and scene lists. a single command creates its own from the command line, the job server keeps one alive across
+    # requests
+    def __init__(self, pool, io_pool, cache, dl, artifacts=None, keep_scenes=False, sched=None, metadata=None, options=None):
+        self.pool = pool
+        # the values of the options from add_arguments these resources were created with
+        self.options = options or {}
+        self.metadata = metadata
+        self.scheduler = sched or scheduler()
+        self.io_pool = io_pool
+        self.cache = cache
+        self.artifacts = artifacts
+        self.downloader = dl
+        self._keep_scenes = keep_scenes
+        self._scenes = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def add_arguments(cls, parser):
+        # the options from_args reads, shared by every command that creates resources. returns their actions
+        return [
+            parser.add_argument("-n", "--num_workers", type=int, default=4, help="Number of worker threads to use"),
+            parser.add_argument("--executor", type=str, default='process', choices=['process', 'thread', 'shared'], help="How processing jobs are run: local processes (default), local threads, or a queue in a shared directory served by 'landsat_fetch worker' on any number of hosts"),
+            parser.add_argument("--queue_dir", type=str, default=None, help="Shared job queue directory for --executor shared"),
+            parser.add_argument("--io_workers", type=int, default=8, help="Number of threads for I/O-bound jobs such as fetching cropped windows (default 8)"),
+            parser.add_argument("--retries", type=int, default=0, help="Number of times a failed job is retried (default 0)"),
+            parser.add_argument("--memory_budget", type=int, default=None, help="Memory that running jobs may use together; jobs wait for their turn beyond it (MB, default three quarters of physical memory)"),
+            parser.add_argument("--cores", type=int, default=None, help="Cores shared between concurrent jobs and GDAL's threads within them (default all)"),
+            parser.add_argument('--cache', type=str, default=None, help="Location of a persistent cache of downloaded files (optional)"),
+            parser.add_argument('--cache_size', type=int, default=20000, help="Maximum size of the download cache (MB, default 20000)"),
+            parser.add_argument('--cache_verify', action='store_true', default=False, help="Check every file taken from the download cache against its checksum, instead of its size and modification time"),
+            parser.add_argument('--metadata_catalog', type=str, default=None, help="Location of a local SQLite catalog of product metadata, so calibration doesn't download an MTL file per product (optional)"),
+            parser.add_argument('--artifacts', type=str, default=None, help="Location of a persistent store of processing outputs, so jobs repeated with the same inputs and parameters are skipped (optional)"),
+            parser.add_argument('--artifacts_size', type=int, default=50000, help="Maximum size of the artifact store (MB, default 50000)"),
+            parser.add_argument('--artifacts_age', type=float, default=None, help="Discard artifacts unused for this many days (optional)"),
+            parser.add_argument('--download_workers', type=int, default=8, help="Number of concurrent downloads (default 8)"),
+            parser.add_argument('--max_rate', type=float, default=None, help="Maximum total download rate (MB/s, optional)"),
+        ]
+
+    @classmethod
+    def given_options(cls, argv):
+        # the options from add_arguments that a command line sets (in any form argparse accepts), ignoring the rest
+        parser = argparse.ArgumentParser(add_help=False)
+        actions = cls.add_arguments(parser)
+        for a in actions:
+            a.default = argparse.SUPPRESS
+        given, _ = parser.parse_known_args(argv)
+        return [a.option_strings[-1] for a in actions if hasattr(given, a.dest)]
+
+    @classmethod
+    def from_args(cls, args, keep_scenes=False):
+        pool = create_executor(args.executor, args.num_workers, args.retries, args.queue_dir)
+        io_pool = thread_executor(args.io_workers, args.retries)
+
+        cache = None
+        if args.cache is not None:
+            cache = downloadcache(args.cache, args.cache_size * 1024 * 1024, args.cache_verify)
+
+        artifacts = None
+        if args.artifacts is not None:
+            max_age = None if args.artifacts_age is None else args.artifacts_age * 86400
+            artifacts = artifact_store(args.artifacts, args.artifacts_size * 1024 * 1024, max_age)
+
+        metadata = None
+        if args.metadata_catalog is not None:
+            metadata = metadatacatalog(args.metadata_catalog)
+
+        memory_budget = None if args.memory_budget is None else args.memory_budget * 1024 * 1024
+        sched = scheduler(memory_budget, args.cores, args.num_workers, args.executor == 'thread')
+
+        max_rate = None if args.max_rate is None else args.max_rate * 1024 * 1024
+        options = {a.dest: getattr(args, a.dest) for a in cls.add_arguments(argparse.ArgumentParser(add_help=False))}
+        return cls(pool, io_pool, cache, downloader(args.download_workers, max_rate=max_rate), artifacts, keep_scenes, sched, metadata, options)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self.metadata is not None:
+            self.metadata.close()
+        self.downloader.close()
+        self.io_pool.close()
+        self.pool.close()
+
+    def scenes(self, scene_list=None, catalog=None, refresh=False):
+        if not self._keep_scenes:
+            return scenelist.load_or_acquire(scene_list, catalog, scenelist.COLUMNS, refresh)
+        # loaded once per source and shared by every later request, until one asks for a refresh
+        key = (scene_list, catalog)
+        with self._lock:
+            sc = self._scenes.get(key)
+            if sc is None or refresh:
+                sc = scenelist.load_or_acquire(scene_list, catalog, scenelist.COLUMNS, refresh)
+                self._scenes[key] = sc
+            else:
+                LOGGER.info("Using resident scene list...")
+            return sc
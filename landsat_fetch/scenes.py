@@ -1,9 +1,11 @@
+import numpy as np
 import pandas as pd
 
 from .common import LANDSAT_8_URL, LOGGER
 from .product import product_index_entry
+from .catalog import scenecatalog
 
-__all__ = ['scenelist']
+__all__ = ['scenelist', 'sceneindex']
 
 def overlaps_1d(line0, line1):
     l0x0, l0x1 = line0
@@ -15,37 +17,212 @@ def overlaps_2d(box0, box1):
     b1y0, b1x0, b1y1, b1x1 = box1
     return overlaps_1d((b0x0, b0x1), (b1x0, b1x1)) & overlaps_1d((b0y0, b0y1), (b1y0, b1y1))
 
+def _date(value):
+    return np.datetime64(pd.Timestamp(value).to_datetime64(), 'ns')
+
+# wrs-2 orbit: inclination and orbits per day, which set how far a scene's outline is tilted from north
+WRS2_INCLINATION = np.radians(98.2)
+WRS2_ORBITS_PER_DAY = 233 / 16.0
+
+# the ground track runs east-west at this latitude (about 81.8 degrees), so the tilt model below doesn't hold there;
+# scenes centred beyond it are taken as their whole box
+POLAR_LATITUDE = np.degrees(np.arccos(abs(np.cos(WRS2_INCLINATION))))
+
+# modelled footprints are the same for a tilt and 90 degrees minus it, and smallest at 45 degrees: past it (from
+# about 78 degrees latitude) the model would grow back towards the whole box, so the tilt is held there
+_MAX_TILT = np.pi / 4
+
+def _footprint_tilt(lat):
+    # angle between the ground track and the meridian at lat: the orbit's own heading plus the drift from the earth
+    # turning underneath it. this slightly overestimates the tilt of a scene, which keeps the footprint model below
+    # inside the real outline
+    cos_lat = np.cos(np.radians(lat))
+    sin_heading = np.clip(abs(np.cos(WRS2_INCLINATION)) / cos_lat, 0, 1)
+    east = sin_heading + cos_lat / WRS2_ORBITS_PER_DAY
+    return np.minimum(np.arctan2(east, np.sqrt(1 - sin_heading ** 2)), _MAX_TILT)
+
+def _footprint_covers(min_lat, min_lon, max_lat, max_lon, lat, lon):
+    # whether (lat, lon) lies inside the tilted, roughly square outline of a scene, given only its min/max lat/lon
+    # box: in coordinates scaled so the box is [-1, 1]^2 the outline is a square rotated by the tilt with a corner on
+    # each side of the box. the side a scene leans to isn't known from the box, so a point has to lie inside both
+    # mirrored squares. beyond POLAR_LATITUDE, inside the box is all that's known
+    centre = (min_lat + max_lat) / 2
+    tilt = _footprint_tilt(centre)
+    c, s = np.cos(tilt), np.sin(tilt)
+    half = 1 / (c + s)
+    y = (lat - (min_lat + max_lat) / 2) / ((max_lat - min_lat) / 2)
+    x = (lon - (min_lon + max_lon) / 2) / ((max_lon - min_lon) / 2)
+    inside = ((np.abs(x * c + y * s) <= half) & (np.abs(y * c - x * s) <= half) &
+              (np.abs(x * c - y * s) <= half) & (np.abs(y * c + x * s) <= half))
+    return np.where(np.abs(centre) >= POLAR_LATITUDE, (np.abs(x) <= 1) & (np.abs(y) <= 1), inside)
+
+class sceneindex (object):
+    # positional indices into a scene list frame: footprints ordered by min_lat, so a bounding box query only has to
+    # look at the rows whose min_lat lies within [y0 - tallest footprint, y1], and the rows of each (path, row) cell
+    # ordered by acquisition date, so cell and date range queries are a dictionary lookup and a binary search
+
+    def __init__(self, df):
+        self._min_lat = df.min_lat.to_numpy()
+        self._max_lat = df.max_lat.to_numpy()
+        self._min_lon = df.min_lon.to_numpy()
+        self._max_lon = df.max_lon.to_numpy()
+        self._lat_order = np.argsort(self._min_lat, kind='stable')
+        self._sorted_min_lat = self._min_lat[self._lat_order]
+        self._max_span = float((self._max_lat - self._min_lat).max()) if len(df) else 0
+
+        dates = pd.to_datetime(df.acquisitionDate).to_numpy().astype('datetime64[ns]')
+        cells = df.path.to_numpy().astype(np.int64) * 1000 + df.row.to_numpy().astype(np.int64)
+        self._cell_order = np.lexsort((dates, cells))
+        self._cell_dates = dates[self._cell_order]
+        sorted_cells = cells[self._cell_order]
+        keys, starts = np.unique(sorted_cells, return_index=True)
+        ends = np.append(starts[1:], len(sorted_cells))
+        self._cells = {int(k): (int(s), int(e)) for k, s, e in zip(keys, starts, ends)}
+
+    def bbox(self, y0, x0, y1, x1):
+        lo = np.searchsorted(self._sorted_min_lat, y0 - self._max_span, side='left')
+        hi = np.searchsorted(self._sorted_min_lat, y1, side='right')
+        candidates = self._lat_order[lo:hi]
+        mask = overlaps_2d((self._min_lat[candidates], self._min_lon[candidates], self._max_lat[candidates], self._max_lon[candidates]), (y0, x0, y1, x1))
+        return np.sort(candidates[mask])
+
+    def cell(self, path, row, start=None, end=None):
+        lo, hi = self._cells.get(int(path) * 1000 + int(row), (0, 0))
+        dates = self._cell_dates[lo:hi]
+        first = lo if start is None else lo + np.searchsorted(dates, _date(start), side='left')
+        last = hi if end is None else lo + np.searchsorted(dates, _date(end), side='right')
+        return self._cell_order[first:last]
+
+    def cells(self):
+        return [(k // 1000, k % 1000) for k in sorted(self._cells)]
+
 class scenelist (object):
-    def __init__(self, pd_obj):
-        self._df = pd_obj
+    # the columns the workflows query; download_url is only needed for the legacy scene list layout
+    COLUMNS = ['productId', 'entityId', 'acquisitionDate', 'cloudCover', 'processingLevel', 'path', 'row', 'min_lat', 'min_lon', 'max_lat', 'max_lon']
+
+    def __init__(self, pd_obj, rows=None, root=None):
+        # a list derived by a query or filter shares the frame and the index of the loaded list it came from (its
+        # root), and keeps the positions it selected in that frame, in order. the index is built once, on the root,
+        # and a derived list's own frame is only built when something reads it
+        if root is None and not pd_obj.index.equals(pd.RangeIndex(len(pd_obj))):
+            # positions double as row labels
+            pd_obj = pd_obj.reset_index(drop=True)
+        self._base = pd_obj
+        self._rows = rows
+        self._root = root or self
+        self._df = pd_obj if rows is None else None
+        self._index = None
+
+    def _derive(self, rows):
+        return self.__class__(self._base, rows, self._root)
+
+    def positions(self):
+        return np.arange(len(self._base)) if self._rows is None else self._rows
+
+    def index(self):
+        root = self._root
+        if root._index is None:
+            root._index = sceneindex(root._base)
+        return root._index
+
+    def overlapping(self, *bbox):
+        found = self.index().bbox(*bbox)
+        if self._rows is None:
+            return self._derive(found)
+        return self._derive(self._rows[np.isin(self._rows, found)])
+
+    def cell(self, path, row, start=None, end=None):
+        # like overlapping, keeps the order of this list (e.g. from sort) rather than the date order of the index
+        found = self.index().cell(path, row, start, end)
+        if self._rows is None:
+            return self._derive(np.sort(found))
+        return self._derive(self._rows[np.isin(self._rows, found)])
     
     def filter(self, func):
-        return self.__class__(self._df[func(self._df)])
+        return self._derive(self.positions()[np.asarray(func(self.df()), dtype=bool)])
     
     def sort(self, *args, **kwargs):
-        return self.__class__(self._df.sort_values(*args, **kwargs))
+        return self._derive(self.df().sort_values(*args, **kwargs).index.to_numpy())
 
     def remove_duplicates(self):
-        return self.__class__(self._df.drop_duplicates(subset='entityId'))
+        positions = self.positions()
+        duplicated = pd.Series(self._base.entityId.to_numpy()[positions]).duplicated().to_numpy()
+        return self._derive(positions[~duplicated])
 
     def first(self):
-        return product_index_entry(next(self._df.itertuples()))
+        return product_index_entry(next(self.df().itertuples()))
     
     def all(self):
-        return [product_index_entry(t) for t in self._df.itertuples()]
+        return [product_index_entry(t) for t in self.df().itertuples()]
     
     def df(self):
+        if self._df is None:
+            self._df = self._base.iloc[self._rows]
         return self._df
 
+    def join_metadata(self, catalog, columns=None):
+        # adds columns of a metadata catalog; scenes missing from it get NaN
+        return self.__class__(self.df().merge(catalog.df(columns), on='productId', how='left'))
+
     def paths_and_rows(self):
-        return [(r.path, r.row) for r in self._df[['path', 'row']].drop_duplicates().itertuples()]
+        return [(r.path, r.row) for r in self.df()[['path', 'row']].drop_duplicates().itertuples()]
+
+    def plan_coverage(self, y0, x0, y1, x1, cloud_weight=1.0, age_weight=1.0, samples=64):
+        # greedy weighted set cover of a samples x samples grid over the bounding box: the cheapest product of each
+        # (path, row) cell is a candidate, and candidates are picked by newly covered points per unit cost until
+        # nothing more can be covered. the scene list only has a min/max lat/lon box per scene, whose corners lie
+        # outside the scene's tilted outline, so footprints are modelled as the region inside the outline whichever
+        # way it leans (see _footprint_covers); the reported coverage is a lower bound, and a point counted as covered
+        # is covered by a chosen scene. scenes beyond POLAR_LATITUDE are taken as their whole box instead, so when one
+        # is chosen the coverage is only approximate, which the third value returned tells
+        df = self.df()
+        if not len(df):
+            return [], 0.0, False
+
+        dates = pd.to_datetime(df.acquisitionDate)
+        age = (dates.max() - dates).dt.total_seconds().to_numpy() / (365.25 * 86400)
+        cost = 1 + cloud_weight * df.cloudCover.to_numpy() / 100 + age_weight * age
+
+        cells = df.path.to_numpy().astype(np.int64) * 1000 + df.row.to_numpy().astype(np.int64)
+        order = np.lexsort((cost, cells))
+        _, first = np.unique(cells[order], return_index=True)
+        candidates = order[first]
+
+        lat = np.linspace(y0, y1, samples)
+        lon = np.linspace(x0, x1, samples)
+        lat, lon = [a.ravel() for a in np.meshgrid(lat, lon)]
+        boxes = [df[c].to_numpy().astype(np.float64)[candidates, None] for c in ('min_lat', 'min_lon', 'max_lat', 'max_lon')]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            covers = _footprint_covers(*(boxes + [lat, lon]))
+
+        covered = np.zeros(lat.shape, dtype=bool)
+        chosen = []
+        while True:
+            gain = (covers & ~covered).sum(axis=1)
+            best = np.argmax(gain / cost[candidates])
+            if gain[best] == 0:
+                break
+            chosen.append(candidates[best])
+            covered |= covers[best]
+
+        chosen = sorted(chosen)
+        centre = (df.min_lat.to_numpy()[chosen] + df.max_lat.to_numpy()[chosen]) / 2
+        approximate = bool((np.abs(centre) >= POLAR_LATITUDE).any())
+        return [product_index_entry(t) for t in df.iloc[chosen].itertuples()], covered.mean(), approximate
 
     @staticmethod
     def overlaps(df, *bbox):
         return overlaps_2d((df.min_lat, df.min_lon, df.max_lat, df.max_lon), bbox)
 
     @classmethod
-    def load_or_acquire(cls, path=None):
+    def load_or_acquire(cls, path=None, catalog=None, columns=None, refresh=False):
         if path is None:
             path = LANDSAT_8_URL + "scene_list.gz"
-        return cls(pd.read_csv(path))
+        if catalog is None:
+            return cls(pd.read_csv(path, usecols=columns))
+
+        catalog = scenecatalog(catalog)
+        if refresh or not catalog.exists():
+            LOGGER.info("Updating scene catalog from {:s}...".format(path))
+            catalog.update(path)
+        return cls(catalog.load(columns))
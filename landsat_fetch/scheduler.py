@@ -0,0 +1,154 @@
+
+import os
+import threading
+
+from osgeo import gdal
+
+__all__ = ['scheduler', 'scheduled_pool', 'schedule', 'raster_bytes', 'WARP_MEMORY']
+
+# working buffer gdal.Warp allocates by default, on top of the block cache
+WARP_MEMORY = 64 * 1024 * 1024
+
+# bounds on the block cache given to each job
+_MIN_CACHE = 16 * 1024 * 1024
+_MAX_CACHE = 512 * 1024 * 1024
+
+def schedule(func, memory=None, threaded=False):
+    # describes a *_one kernel to the scheduler: memory(job) estimates what it holds besides gdal's block cache, and
+    # threaded says whether gdal can spread its work over several threads (warping, pansharpening, compression)
+    func.memory = memory
+    func.threaded = threaded
+    return func
+
+def raster_bytes(filename):
+    # in-memory size of a whole raster, from its header
+    ds = gdal.Open(filename)
+    band = ds.GetRasterBand(1)
+    return ds.RasterXSize * ds.RasterYSize * ds.RasterCount * gdal.GetDataTypeSize(band.DataType) // 8
+
+def _physical_memory():
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        return 4 * 1024 * 1024 * 1024
+
+class scheduler (object):
+    # admits raster jobs under a global memory budget and splits a core budget between concurrent jobs and gdal's
+    # own threads. shared by every pool wrapped with scheduled_pool, including those of concurrent requests. with
+    # in_process (a thread executor) every job shares this process's block cache, so it is sized once from the budget
+    # here instead of per job
+    def __init__(self, memory_budget=None, cores=None, num_workers=4, in_process=False):
+        self.memory_budget = memory_budget or _physical_memory() * 3 // 4
+        self.cores = cores or os.cpu_count() or 1
+        self.num_workers = num_workers
+        self._shared_cache = 0
+        if in_process:
+            self._shared_cache = min(_MAX_CACHE * num_workers, max(_MIN_CACHE, self.memory_budget // 4))
+            gdal.SetCacheMax(self._shared_cache)
+        self._used = 0
+        self._cond = threading.Condition()
+
+    def plan(self, func, num_jobs):
+        # threads and block cache per job for a batch of num_jobs; a batch smaller than the pool leaves cores over
+        # for gdal to use within each job. there is no per job cache when the process shares one
+        concurrency = max(1, min(self.num_workers, num_jobs))
+        threads = max(1, self.cores // concurrency) if getattr(func, 'threaded', False) else 1
+        if self._shared_cache:
+            return threads, None
+        cache = min(_MAX_CACHE, max(_MIN_CACHE, self.memory_budget // (2 * concurrency)))
+        return threads, cache
+
+    def estimate(self, func, job, cache):
+        memory = getattr(func, 'memory', None)
+        return (cache or 0) + (memory(job) if memory is not None else 0)
+
+    @property
+    def reserved(self):
+        with self._cond:
+            return self._used
+
+    def try_admit(self, size):
+        # a job larger than the whole budget is still admitted once nothing else is running
+        with self._cond:
+            if self._used == 0 or self._shared_cache + self._used + size <= self.memory_budget:
+                self._used += size
+                return True
+            return False
+
+    def release(self, size):
+        with self._cond:
+            self._used -= size
+            self._cond.notify_all()
+
+    def wait(self, timeout):
+        with self._cond:
+            self._cond.wait(timeout)
+
+# the thread count is set for the calling thread only, so concurrent jobs on a thread executor keep their own
+# (gdal builds without thread-local options fall back to the process-wide one)
+_set_thread_option = getattr(gdal, 'SetThreadLocalConfigOption', gdal.SetConfigOption)
+
+class _configured (object):
+    # a kernel along with the gdal settings to run it with in the worker. cache is None when the worker process
+    # shares its block cache between concurrent jobs
+    def __init__(self, func, threads, cache):
+        self.func = func
+        self.threads = threads
+        self.cache = cache
+        self.__name__ = func.__name__
+
+    def __call__(self, job):
+        _set_thread_option('GDAL_NUM_THREADS', str(self.threads))
+        if self.cache is not None:
+            gdal.SetCacheMax(self.cache)
+        return self.func(job)
+
+class scheduled_pool (object):
+    def __init__(self, pool, sched):
+        self._pool = pool
+        self._sched = sched
+
+    def map(self, func, jobs):
+        threads, cache = self._sched.plan(func, len(jobs))
+        configured = _configured(func, threads, cache)
+        results = [None] * len(jobs)
+        inflight = []
+
+        def reap():
+            done = [j for j in inflight if j[2].ready()]
+            for j in done:
+                inflight.remove(j)
+                self._sched.release(j[1])
+                results[j[0]] = j[2].get()
+            return len(done)
+
+        try:
+            for i, job in enumerate(jobs):
+                size = self._sched.estimate(func, job, cache)
+                while not self._sched.try_admit(size):
+                    # finished jobs of this batch only give their memory back here, so check them before waiting
+                    if reap():
+                        continue
+                    if inflight:
+                        inflight[0][2].wait(0.05)
+                    else:
+                        self._sched.wait(0.05)
+                inflight.append((i, size, self._pool.apply_async(configured, (job,))))
+            while inflight:
+                i, size, res = inflight.pop(0)
+                try:
+                    results[i] = res.get()
+                finally:
+                    self._sched.release(size)
+        finally:
+            for _, size, _ in inflight:
+                self._sched.release(size)
+        return results
+
+    def apply_async(self, func, args=()):
+        # used for bounded lookahead (see ffmpeg_stream), which already limits how much is in flight
+        threads, cache = self._sched.plan(func, self._sched.num_workers)
+        return self._pool.apply_async(_configured(func, threads, cache), args)
+
+    def __getattr__(self, name):
+        return getattr(self._pool, name)
@@ -0,0 +1,70 @@
+
+from osgeo import gdal
+
+from .common import LOGGER
+
+__all__ = ['storage_policy', 'stored_reflectance', 'REFLECTANCE_SCALE', 'REFLECTANCE_OFFSET']
+
+# reflectance stored as uint16 is (value - REFLECTANCE_OFFSET) / REFLECTANCE_SCALE, covering -0.2 to 1.44 in steps of
+# 2.5e-5, about one DN of the source data (2e-5 divided by the sine of the sun elevation). 0 is kept for nodata
+REFLECTANCE_SCALE = 1.0 / 40000
+REFLECTANCE_OFFSET = -0.2
+
+def stored_reflectance(value):
+    # the uint16 value reflectance is stored as
+    return (value - REFLECTANCE_OFFSET) / REFLECTANCE_SCALE
+
+_FLOAT_TYPES = (gdal.GDT_Float32, gdal.GDT_Float64)
+_LEVEL_OPTIONS = {'DEFLATE': 'ZLEVEL', 'ZSTD': 'ZSTD_LEVEL', 'LZMA': 'LZMA_PRESET'}
+
+def _has_compression(method):
+    options = gdal.GetDriverByName('GTiff').GetMetadataItem('DMD_CREATIONOPTIONLIST') or ''
+    return method in options
+
+class storage_policy (object):
+    # how intermediate GeoTIFFs are laid out on disk. passed to the *_one kernels in their job tuples, so it has to
+    # stay picklable, and its repr identifies it in artifact keys
+    def __init__(self, tiled=True, block_size=256, compress=None, level=None, reflectance='float32', bigtiff='IF_SAFER'):
+        if compress is not None:
+            compress = compress.upper()
+            if compress == 'ZSTD' and not _has_compression('ZSTD'):
+                LOGGER.info('This GDAL build has no ZSTD support, using DEFLATE instead...')
+                compress = 'DEFLATE'
+        if reflectance not in ('float32', 'float16', 'uint16'):
+            raise ValueError('Unknown reflectance type {:s}'.format(reflectance))
+        self.tiled = tiled
+        self.block_size = block_size
+        self.compress = compress
+        self.level = level
+        self.reflectance = reflectance
+        self.bigtiff = bigtiff
+
+    def __repr__(self):
+        return 'storage_policy(tiled={!r}, block_size={!r}, compress={!r}, level={!r}, reflectance={!r}, bigtiff={!r})'.format(
+            self.tiled, self.block_size, self.compress, self.level, self.reflectance, self.bigtiff)
+
+    def creation_options(self, data_type):
+        opts = ['BIGTIFF={:s}'.format(self.bigtiff)]
+        if self.tiled:
+            opts += ['TILED=YES', 'BLOCKXSIZE={:d}'.format(self.block_size), 'BLOCKYSIZE={:d}'.format(self.block_size)]
+        # float16 is stored through NBITS, so these rasters are still read and written as float32
+        half = self.reflectance == 'float16' and data_type == gdal.GDT_Float32
+        if half:
+            opts.append('NBITS=16')
+        if self.compress is not None:
+            opts.append('COMPRESS={:s}'.format(self.compress))
+            if self.level is not None and self.compress in _LEVEL_OPTIONS:
+                opts.append('{:s}={:d}'.format(_LEVEL_OPTIONS[self.compress], self.level))
+            # horizontal differencing helps every codec on smooth imagery; the floating point predictor doesn't
+            # apply to 16 bit floats
+            if data_type in _FLOAT_TYPES and not half:
+                opts.append('PREDICTOR=3')
+            elif data_type not in _FLOAT_TYPES:
+                opts.append('PREDICTOR=2')
+        return opts
+
+    def options_for(self, filename):
+        # creation options for a raster with the data type of filename (e.g. a warp of it)
+        # the dataset has to outlive its band, so it's kept in a variable
+        ds = gdal.Open(filename)
+        return self.creation_options(ds.GetRasterBand(1).DataType)
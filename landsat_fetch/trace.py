@@ -0,0 +1,219 @@
+
+import contextlib
+import json
+import os
+import resource
+import threading
+import time
+
+from .executors import thread_executor
+
+__all__ = ['tracer', 'traced_pool']
+
+def _io_counters(thread=False):
+    # characters read and written by this process (or just the calling thread), including page cache hits and
+    # sockets (linux only)
+    try:
+        with open('/proc/thread-self/io' if thread else '/proc/self/io', 'r') as fh:
+            fields = dict(line.split(':', 1) for line in fh)
+        return int(fields['rchar']), int(fields['wchar'])
+    except (OSError, KeyError, ValueError):
+        return 0, 0
+
+def _reset_peak_rss():
+    # resets VmHWM so the next reading only covers the job about to run (linux >= 4.0)
+    try:
+        with open('/proc/self/clear_refs', 'w') as fh:
+            fh.write('5')
+    except OSError:
+        pass
+
+def _peak_rss():
+    try:
+        with open('/proc/self/status', 'r') as fh:
+            for line in fh:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+class _sample (object):
+    # with thread, cpu time and i/o are those of the calling thread only (not counting threads gdal starts for it),
+    # and peak memory isn't sampled, as it belongs to the whole process
+    def __init__(self, thread=False):
+        self.start = time.time()
+        self._thread = thread
+        self._wall = time.perf_counter()
+        self._cpu = self._cpu_time()
+        self._io = _io_counters(thread)
+
+    def _cpu_time(self):
+        return time.thread_time() if self._thread else time.process_time()
+
+    def finish(self, name, cat, **args):
+        read, written = _io_counters(self._thread)
+        rec = {
+            'name': name,
+            'cat': cat,
+            'start': self.start,
+            'wall_s': time.perf_counter() - self._wall,
+            'cpu_s': self._cpu_time() - self._cpu,
+            'bytes_read': read - self._io[0],
+            'bytes_written': written - self._io[1],
+            'peak_rss': None if self._thread else _peak_rss(),
+            'pid': os.getpid(),
+            'tid': threading.get_ident(),
+        }
+        rec.update(args)
+        return rec
+
+def _traced_call(tup):
+    # runs one job in a pool worker, returning its result along with a record of what it cost. jobs on a thread pool
+    # share their process with each other, so they are only charged for their own thread
+    func, job, submitted, thread = tup
+    if not thread:
+        _reset_peak_rss()
+    s = _sample(thread)
+    res = func(job)
+    return res, s.finish(func.__name__, 'job', queue_wait_s=max(0.0, s.start - submitted))
+
+class _traced_result (object):
+    def __init__(self, tracer, res):
+        self._tracer = tracer
+        self._res = res
+
+    def get(self, timeout=None):
+        res, rec = self._res.get(timeout)
+        self._tracer.record(rec)
+        return res
+
+    def ready(self):
+        return self._res.ready()
+
+    def wait(self, timeout=None):
+        self._res.wait(timeout)
+
+class traced_pool (object):
+    # wraps a multiprocessing pool so every job run through map or apply_async is recorded by the tracer
+    def __init__(self, pool, tracer):
+        self._pool = pool
+        self._tracer = tracer
+        self._thread = isinstance(pool, thread_executor)
+
+    def map(self, func, jobs):
+        submitted = time.time()
+        results = []
+        for res, rec in self._pool.map(_traced_call, [(func, j, submitted, self._thread) for j in jobs]):
+            self._tracer.record(rec)
+            results.append(res)
+        return results
+
+    def apply_async(self, func, args=()):
+        job, = args
+        return _traced_result(self._tracer, self._pool.apply_async(_traced_call, ((func, job, time.time(), self._thread),)))
+
+    def __getattr__(self, name):
+        return getattr(self._pool, name)
+
+class tracer (object):
+    # collects timing records for operations, pool jobs and downloads; records are appended to a JSON lines file as
+    # they arrive and optionally written out as a Chrome trace (chrome://tracing or ui.perfetto.dev) on close.
+    # a tracer without a filename records nothing
+    def __init__(self, filename=None, chrome=None):
+        self._chrome = chrome
+        self._fh = open(filename, 'w') if filename is not None else None
+        self._events = []
+        self._spans = threading.local()
+        self._open_spans = 0
+        self._lock = threading.Lock()
+        self._t0 = time.time()
+
+    @property
+    def enabled(self):
+        return self._fh is not None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self._fh is None:
+            return
+        self._fh.close()
+        self._fh = None
+        if self._chrome is not None:
+            with open(self._chrome, 'w') as fh:
+                json.dump({'traceEvents': self._events, 'displayTimeUnit': 'ms'}, fh)
+
+    def pool(self, pool):
+        return traced_pool(pool, self) if self.enabled else pool
+
+    def record(self, rec):
+        if self._fh is None:
+            return
+        # job costs also count towards every span open on the thread that collected them
+        if rec['cat'] == 'job':
+            for span in getattr(self._spans, 'stack', []):
+                span['job_cpu_s'] += rec['cpu_s']
+                span['job_bytes_read'] += rec['bytes_read']
+                span['job_bytes_written'] += rec['bytes_written']
+                span['jobs'] += 1
+        with self._lock:
+            self._fh.write(json.dumps(rec) + '\n')
+            self._fh.flush()
+            if self._chrome is not None:
+                args = {k: v for k, v in rec.items() if k not in ('name', 'cat', 'start', 'wall_s', 'pid', 'tid')}
+                self._events.append({
+                    'name': rec['name'],
+                    'cat': rec['cat'],
+                    'ph': 'X',
+                    'ts': (rec['start'] - self._t0) * 1e6,
+                    'dur': rec['wall_s'] * 1e6,
+                    'pid': rec['pid'],
+                    'tid': rec['tid'],
+                    'args': args,
+                })
+
+    @contextlib.contextmanager
+    def span(self, name, cat='operation', **args):
+        if self._fh is None:
+            yield
+            return
+        totals = {'job_cpu_s': 0.0, 'job_bytes_read': 0, 'job_bytes_written': 0, 'jobs': 0}
+        stack = getattr(self._spans, 'stack', None)
+        if stack is None:
+            stack = self._spans.stack = []
+        stack.append(totals)
+        # peak memory is reported per operation: the high-water mark restarts with the first open span, so spans open
+        # at the same time (nested, or stages of a pipeline) share it
+        with self._lock:
+            if self._open_spans == 0:
+                _reset_peak_rss()
+            self._open_spans += 1
+        s = _sample()
+        try:
+            yield
+        finally:
+            stack.pop()
+            with self._lock:
+                self._open_spans -= 1
+            args.update(totals)
+            self.record(s.finish(name, cat, **args))
+
+    def download(self, url, start, wall, size):
+        if self._fh is None:
+            return
+        self.record({
+            'name': 'fetch',
+            'cat': 'download',
+            'start': start,
+            'wall_s': wall,
+            'url': url,
+            'bytes': size,
+            'bytes_per_s': size / wall if wall > 0 else None,
+            'pid': os.getpid(),
+            'tid': threading.get_ident(),
+        })
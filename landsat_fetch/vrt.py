@@ -0,0 +1,76 @@
+
+import os
+import os.path
+import shutil
+import xml.etree.ElementTree as ET
+from osgeo import gdal
+
+__all__ = ['scaled_vrt', 'stacked_vrt', 'materialize']
+
+def scaled_vrt(filename, source, scales, offsets, nodata=0, data_type='Float32', clamp=None):
+    # virtual dataset computing band i of source as value * scales[i] + offsets[i], leaving nodata pixels at 0.
+    # with clamp, a (min, max) pair, scaled values are clipped to that range (through a lookup table, which gdal
+    # applies after the scaling and holds constant beyond its ends)
+    ds = gdal.Open(source)
+
+    root = ET.Element('VRTDataset')
+    root.set('rasterXSize', str(ds.RasterXSize))
+    root.set('rasterYSize', str(ds.RasterYSize))
+    srs = ET.SubElement(root, 'SRS')
+    srs.text = ds.GetProjection()
+    gt = ET.SubElement(root, 'GeoTransform')
+    gt.text = ', '.join(repr(float(v)) for v in ds.GetGeoTransform())
+
+    for i, (scale, offset) in enumerate(zip(scales, offsets)):
+        band = ET.SubElement(root, 'VRTRasterBand')
+        band.set('dataType', data_type)
+        band.set('band', str(i + 1))
+        src = ET.SubElement(band, 'ComplexSource')
+        src_filename = ET.SubElement(src, 'SourceFilename')
+        src_filename.set('relativeToVRT', '0')
+        src_filename.text = os.path.abspath(source)
+        src_band = ET.SubElement(src, 'SourceBand')
+        src_band.text = str(i + 1)
+        src_offset = ET.SubElement(src, 'ScaleOffset')
+        src_offset.text = repr(float(offset))
+        src_ratio = ET.SubElement(src, 'ScaleRatio')
+        src_ratio.text = repr(float(scale))
+        if clamp is not None:
+            lut = ET.SubElement(src, 'LUT')
+            lut.text = '{0!r}:{0!r},{1!r}:{1!r}'.format(float(clamp[0]), float(clamp[1]))
+        if nodata is not None:
+            src_nodata = ET.SubElement(src, 'NODATA')
+            src_nodata.text = str(nodata)
+
+    ET.ElementTree(root).write(filename)
+    return filename
+
+def stacked_vrt(filename, sources):
+    # virtual dataset with the first band of each source as one of its bands
+    gdal.BuildVRT(filename, [os.path.abspath(s) for s in sources], separate=True)
+    return filename
+
+def materialize(source, filename, cog=False):
+    if cog:
+        if gdal.GetDriverByName('COG') is not None:
+            gdal.Translate(filename, source, format='COG', creationOptions=['BIGTIFF=IF_SAFER'])
+        else:
+            # gdal < 3.1: build the overviews on a tiled copy, then lay them out cloud-optimized alongside the data
+            tmp = filename + '.tmp.tiff'
+            gdal.Translate(tmp, source, creationOptions=['TILED=YES', 'BIGTIFF=IF_SAFER'])
+            ds = gdal.Open(tmp, gdal.GA_Update)
+            factors = []
+            while max(ds.RasterXSize, ds.RasterYSize) // (2 ** (len(factors) + 1)) >= 256:
+                factors.append(2 ** (len(factors) + 1))
+            ds.BuildOverviews('AVERAGE', factors)
+            ds = None
+            gdal.Translate(filename, tmp, creationOptions=['TILED=YES', 'COPY_SRC_OVERVIEWS=YES', 'BIGTIFF=IF_SAFER'])
+            os.unlink(tmp)
+    elif source.endswith('.vrt'):
+        gdal.Translate(filename, source, format='GTiff')
+    elif os.stat(source).st_nlink > 1:
+        # a hardlink into the artifact store; a copy keeps later edits of the output (such as added overviews) out
+        # of the stored artifact
+        shutil.copyfile(source, filename)
+    else:
+        shutil.move(source, filename)
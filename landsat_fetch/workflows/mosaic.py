@@ -1,14 +1,19 @@
 
-import multiprocessing
-import shutil
 
 from ..filemanager import tempfilemanager
+from ..trace import tracer
+from ..resources import resources
+from ..executors import check_scratch
+from ..artifacts import memo_pool
+from ..scheduler import scheduled_pool
+from ..storage import storage_policy
 from ..common import LOGGER
-from ..scenes import scenelist
 from ..product import product_set, product
-from ..operations.calibrate import calibrate
+from ..vrt import materialize
+from ..pipeline import pipeline, stage, operation_stage
+from ..operations.calibrate import calibrate, reflectance_vrt
 from ..operations.mosaic import mosaic
-from ..operations.merge import merge
+from ..operations.merge import merge, stack
 from ..operations.pansharpen import pansharpen
 
 __all__ = ['mosaic_workflow']
@@ -25,27 +30,64 @@ class mosaic_workflow (object):
         parser.add_argument("-c", "--max_clouds", type=float, default=10, help="Maximum cloud cover of fetched products (percent, default 10)")
         parser.add_argument("-b", "--band", type=int, action='append', default=None, help="Band selection for the mosaic (default is RGB)")
         parser.add_argument("-f", "--scene_list", type=str, default=None, help="Path to an existing scene list (optional)")
-        parser.add_argument("-n", "--num_workers", type=int, default=4, help="Number of worker threads to use")
+        parser.add_argument("--catalog", type=str, default=None, help="Location of a local columnar scene catalog built from the scene list (optional)")
+        parser.add_argument("--refresh_catalog", action='store_true', default=False, help="Add new scenes from the scene list to the catalog")
+        parser.add_argument("--plan_coverage", action='store_true', default=False, help="Only fetch the cheapest set of products (by cloud cover and age) that covers the bounding box")
+        resources.add_arguments(parser)
         parser.add_argument('--calibrate', action='store_true', default=False, help="Enable conversion from DN to reflectance")
+        parser.add_argument('--max_memory', type=int, default=256, help="Approximate memory used by each calibration job (MB, default 256)")
+        parser.add_argument('--lazy', action='store_true', default=False, help="Represent calibrated and merged products as virtual rasters instead of writing them out")
+        parser.add_argument('--stack', action='store_true', default=False, help="Warp the bands of each product together in one pass, producing the merged mosaic directly")
+        parser.add_argument('--compress', type=str, default=None, choices=['deflate', 'lzw', 'zstd'], help="Compression of intermediate rasters (default none)")
+        parser.add_argument('--compress_level', type=int, default=None, help="Compression level for deflate or zstd (optional)")
+        parser.add_argument('--block_size', type=int, default=256, help="Tile size of intermediate rasters (pixels, default 256)")
+        parser.add_argument('--reflectance_type', type=str, default='float32', choices=['float32', 'float16', 'uint16'], help="Storage of calibrated reflectance: float32 (default), float16, or uint16 scaled by 1/40000")
         parser.add_argument('--keepfiles', type=str, default=None, help="Location to store source and intermediate data instead of a temporary directory")
+        parser.add_argument('--scratch_budget', type=int, default=None, help="With --pipeline, hold back new products while intermediate files take up more than this (MB, optional)")
+        parser.add_argument('--crop', action='store_true', default=False, help="Only fetch the parts of each band that intersect the bounding box")
+        parser.add_argument("-w", "--width", type=int, default=None, help="Width of the output in pixels, instead of the resolution of the products (optional)")
+        parser.add_argument("--resample", type=str, default='average', help="Resampling method for warping to --width (default average)")
+        parser.add_argument('--tile_size', type=int, default=None, help="Warp the mosaic in tiles of this many pixels in parallel (optional, also the tile size for pansharpening, default 2048)")
+        parser.add_argument('--cog', action='store_true', default=False, help="Write the output as a Cloud-Optimized GeoTIFF with overviews")
         parser.add_argument('--pansharpen', action='store_true', default=False, help="Produce pansharpened output instead of simply merging bands")
+        parser.add_argument('--pansharpen_scenes', action='store_true', default=False, help="With --pansharpen, pansharpen each product before mosaicking instead of the finished mosaic")
+        parser.add_argument('--trace', type=str, default=None, help="Write timing, CPU, I/O and memory records for every operation, job and download to this JSON lines file (optional)")
+        parser.add_argument('--chrome_trace', type=str, default=None, help="With --trace, also write the records as a Chrome trace viewable in chrome://tracing or Perfetto (optional)")
+        parser.add_argument('--pipeline', action='store_true', default=False, help="Calibrate each product as soon as it is downloaded instead of one stage at a time")
+        parser.add_argument('--pipeline_depth', type=int, default=4, help="Number of products that may wait between pipeline stages (default 4)")
         parser.set_defaults(func=cls.run)
     
     @classmethod
-    def run(cls, args):
+    def run(cls, args, res=None):
+        if res is None:
+            with resources.from_args(args) as res:
+                return cls.run(args, res)
+
         if args.band is None:
             args.band = [4, 3, 2]
 
-        pool = multiprocessing.Pool(args.num_workers)
+        storage = storage_policy(block_size=args.block_size, compress=args.compress, level=args.compress_level, reflectance=args.reflectance_type)
+        # calibrated bands stored as uint16 stay scaled until the output is written
+        scaled = args.calibrate and storage.reflectance == 'uint16'
 
-        with tempfilemanager(args.keepfiles, args.keepfiles is not None) as mgr:
+        check_scratch(res.pool, args.keepfiles)
+        scratch_budget = None if args.scratch_budget is None else args.scratch_budget * 1024 * 1024
+        with tracer(args.trace, args.chrome_trace) as tr, tempfilemanager(args.keepfiles, args.keepfiles is not None, scratch_budget) as mgr:
+            pool = scheduled_pool(tr.pool(res.pool), res.scheduler)
+            io_pool = tr.pool(res.io_pool)
+            if res.artifacts is not None:
+                pool = memo_pool(pool, res.artifacts)
+                io_pool = memo_pool(io_pool, res.artifacts)
+            cache = res.cache
+            metadata = res.metadata
+            dl = res.downloader.traced(tr)
 
             LOGGER.info("Loading scene list...")
-            sc = scenelist.load_or_acquire(args.scene_list)
+            sc = res.scenes(args.scene_list, args.catalog, args.refresh_catalog)
 
-            LOGGER.info("Filtering scene list on processing level and footprint...")
+            LOGGER.info("Filtering scene list on footprint and processing level...")
+            sc = sc.overlapping(args.lat1, args.lon0, args.lat0, args.lon1)
             sc = sc.filter(lambda df: df.processingLevel == 'L1TP')
-            sc = sc.filter(lambda df: scenelist.overlaps(df, args.lat1, args.lon0, args.lat0, args.lon1))
 
             LOGGER.info("Selecting matching paths and rows...")
             cells_needed = sc.paths_and_rows()
@@ -57,18 +99,85 @@ class mosaic_workflow (object):
             if args.pansharpen and not 8 in all_bands:
                 all_bands = all_bands + [8]
 
-            data = product_set.acquire(pool, mgr, sc, cells_needed, args.calibrate, all_bands)
+            # with --stack the bands of each product are warped together; the panchromatic band has a different
+            # resolution, so it is still warped on its own
+            stack_bands = [b for b in args.band if b != 8]
+            mosaic_bands = ['merged'] + [b for b in all_bands if b not in stack_bands] if args.stack else all_bands
+            spectral_bands = [('merged', i + 1) for i in range(len(stack_bands))] if args.stack else args.band
+
+            # pansharpening each product first leaves a single band to mosaic, at the panchromatic resolution
+            scene_pansharpen = args.pansharpen and args.pansharpen_scenes
+            if scene_pansharpen:
+                mosaic_bands = ['pansharpened']
+
+            bounding_box = [args.lon0, args.lat1, args.lon1, args.lat0]
+            crop_box = bounding_box if args.crop else None
+
+            if args.plan_coverage:
+                LOGGER.info("Planning scene coverage...")
+                entries, coverage, approximate = sc.plan_coverage(args.lat1, args.lon0, args.lat0, args.lon1)
+                # scenes near the poles are taken as their whole box, so their coverage may be overestimated
+                LOGGER.info("Selected {:d} products covering {:s} {:.1f}% of the bounding box (from {:d} cells)".format(len(entries), 'about' if approximate else 'at least', coverage * 100, len(cells_needed)))
+            else:
+                entries = product_set.select(sc, cells_needed)
+
+            if args.calibrate and metadata is not None:
+                # one batched pass for the products missing from the metadata catalog, rather than a request per product
+                # (so acquiring them doesn't fill it again)
+                with tr.span('metadata'):
+                    metadata.fill(entries, dl, mgr)
 
-            if args.calibrate:
-                data = calibrate(pool, mgr, data)
+            if args.pipeline:
+                stages = [stage('acquire', lambda prod_id, entry: product_set.acquire_products(io_pool, mgr, [entry], args.calibrate, all_bands, cache, dl, crop_box, metadata, fill_metadata=False)[prod_id], args.io_workers)]
+                if args.calibrate:
+                    stages.append(operation_stage('calibrate', calibrate, pool, mgr, args.max_memory * 1024 * 1024, args.lazy, storage, workers=args.num_workers))
+                if args.stack:
+                    stages.append(operation_stage('stack', stack, pool, mgr, stack_bands, workers=args.num_workers))
+                if scene_pansharpen:
+                    stages.append(operation_stage('pansharpen', pansharpen, pool, mgr, 8, spectral_bands, storage, args.tile_size, args.lazy, scaled, workers=args.num_workers))
+                results = pipeline(stages, args.pipeline_depth, tr, mgr).run((e.id, e) for e in entries)
+                data = product_set({e.id: results[e.id] for e in entries})
+            else:
+                with tr.span('acquire'):
+                    data = product_set.acquire_products(io_pool, mgr, entries, args.calibrate, all_bands, cache, dl, crop_box, metadata, fill_metadata=False)
+
+                if args.calibrate:
+                    with tr.span('calibrate'):
+                        data = calibrate(pool, mgr, data, args.max_memory * 1024 * 1024, args.lazy, storage)
+
+                if args.stack:
+                    with tr.span('stack'):
+                        data = stack(pool, mgr, data, stack_bands)
 
-            data = mosaic(pool, mgr, data, all_bands, [args.lon0, args.lat1, args.lon1, args.lat0])
+                if scene_pansharpen:
+                    LOGGER.info('Pansharpening products...')
+                    with tr.span('pansharpen'):
+                        data = pansharpen(pool, mgr, data, 8, spectral_bands, storage, args.tile_size, args.lazy, scaled)
+
+            with tr.span('mosaic'):
+                data = mosaic(pool, mgr, data, mosaic_bands, bounding_box, args.tile_size, args.lazy, args.width, args.resample if args.width is not None else None, storage)
             
             if args.pansharpen:
-                LOGGER.info('Pansharpening...')
-                data = pansharpen(pool, mgr, data, 8, args.band)
-                shutil.move(data['mosaic'].band('pansharpened'), args.output)
+                if not scene_pansharpen:
+                    LOGGER.info('Pansharpening...')
+                    with tr.span('pansharpen'):
+                        data = pansharpen(pool, mgr, data, 8, spectral_bands, storage, args.tile_size, args.lazy, scaled)
+                output = data['mosaic'].band('pansharpened')
             else:
-                LOGGER.info('Merging bands...')
-                data = merge(pool, mgr, data)
-                shutil.move(data['mosaic'].band('merged'), args.output)
+                if not args.stack:
+                    LOGGER.info('Merging bands...')
+                    with tr.span('merge'):
+                        data = merge(pool, mgr, data, args.lazy, storage)
+                output = data['mosaic'].band('merged')
+
+            with tr.span('write_output'):
+                if scaled:
+                    output = reflectance_vrt(mgr, output)
+                materialize(output, args.output, args.cog)
+
+            # every memoized job and download of this run is done, so the artifact store and download cache are trimmed
+            # once here
+            if res.artifacts is not None:
+                res.artifacts.evict()
+            if res.cache is not None:
+                res.cache.evict()
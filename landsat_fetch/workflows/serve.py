@@ -0,0 +1,20 @@
+
+from ..daemon import job_server
+from ..resources import resources
+
+__all__ = ['serve_workflow']
+
+class serve_workflow (object):
+    @classmethod
+    def register(cls, subparsers):
+        parser = subparsers.add_parser('serve')
+        parser.add_argument("--host", type=str, default='127.0.0.1', help="Address to accept jobs on (default 127.0.0.1)")
+        parser.add_argument("-p", "--port", type=int, default=8750, help="Port to accept jobs on (default 8750)")
+        resources.add_arguments(parser)
+        parser.set_defaults(func=cls.run)
+
+    @classmethod
+    def run(cls, args):
+        from ..main import build_parser
+        with resources.from_args(args, keep_scenes=True) as res:
+            job_server(build_parser(), res, args.host, args.port).serve_forever()
@@ -1,17 +1,27 @@
 
-import multiprocessing
+import contextlib
 import shutil
 import numpy as np
 
 from ..filemanager import tempfilemanager
+from ..trace import tracer
+from ..resources import resources
+from ..executors import check_scratch
+from ..artifacts import memo_pool
+from ..scheduler import scheduled_pool
+from ..metadata import metadatacatalog
+from ..storage import storage_policy, stored_reflectance, REFLECTANCE_SCALE, REFLECTANCE_OFFSET
 from ..common import LOGGER
-from ..scenes import scenelist
 from ..product import product_set, product
+from ..framestore import framestore
+from ..pipeline import pipeline, stage, operation_stage
 from ..operations.calibrate import calibrate
 from ..operations.reproject import reproject
-from ..operations.merge import merge
+from ..operations.merge import merge, stack
 from ..operations.to_jpeg import to_jpeg
-from ..operations.ffmpeg import ffmpeg
+from ..operations.ffmpeg import ffmpeg, ffmpeg_stream, check_frame_bands
+from ..operations.datacube import datacube
+from ..grid import native_width
 
 __all__ = ['timelapse_workflow']
 
@@ -19,42 +29,102 @@ class timelapse_workflow (object):
     @classmethod
     def register(cls, subparsers):
         parser = subparsers.add_parser('timelapse')
-        parser.add_argument("output", type=str, help="Name of the output file")
+        parser.add_argument("output", type=str, help="Name of the output file (a directory with --cube)")
         parser.add_argument("path", type=int, help="WRS path to fetch")
         parser.add_argument("row", type=int, help="WRS row to fetch")
         parser.add_argument("start", type=str, help="ISO datetime string for start of timelapse")
         parser.add_argument("end", type=str, help="ISO datetime string for end of timelapse")
-        parser.add_argument("-w", "--width", type=int, help="Width of output in pixels", default=1080)
+        parser.add_argument("-w", "--width", type=int, help="Width of output in pixels (default 1080, or the resolution of the products with --cube)", default=None)
+        parser.add_argument("--full_resolution", action='store_true', default=False, help="Reproject at the resolution of the products and only scale frames down to --width afterwards")
+        parser.add_argument("--resample", type=str, default='average', help="Resampling method for warping to the output resolution (default average)")
         parser.add_argument("-r", "--rate", type=int, help="Frame rate", default=15)
-        parser.add_argument("-b", "--band", type=int, action='append', default=None, help="Band selection for the composite (default is RGB)")
+        parser.add_argument("-b", "--band", type=int, action='append', default=None, help="Band selection for the composite, one or three bands unless writing a --cube (default is RGB)")
         parser.add_argument("-f", "--scene_list", type=str, default=None, help="Path to an existing scene list (optional)")
-        parser.add_argument("-n", "--num_workers", type=int, default=4, help="Number of worker threads to use")
+        parser.add_argument("--catalog", type=str, default=None, help="Location of a local columnar scene catalog built from the scene list (optional)")
+        parser.add_argument("--refresh_catalog", action='store_true', default=False, help="Add new scenes from the scene list to the catalog")
+        resources.add_arguments(parser)
         parser.add_argument('--calibrate', action='store_true', default=False, help="Enable conversion from DN to reflectance")
+        parser.add_argument('--max_memory', type=int, default=256, help="Approximate memory used by each calibration job (MB, default 256)")
+        parser.add_argument('--lazy', action='store_true', default=False, help="Represent calibrated and merged products as virtual rasters instead of writing them out")
+        parser.add_argument('--stack', action='store_true', default=False, help="Warp the bands of each product together in one pass, producing merged frames directly")
+        parser.add_argument('--compress', type=str, default=None, choices=['deflate', 'lzw', 'zstd'], help="Compression of intermediate rasters (default none)")
+        parser.add_argument('--compress_level', type=int, default=None, help="Compression level for deflate or zstd (optional)")
+        parser.add_argument('--block_size', type=int, default=256, help="Tile size of intermediate rasters (pixels, default 256)")
+        parser.add_argument('--reflectance_type', type=str, default='float32', choices=['float32', 'float16', 'uint16'], help="Storage of calibrated reflectance: float32 (default), float16, or uint16 scaled by 1/40000")
         parser.add_argument('--keepfiles', type=str, default=None, help="Location to store source and intermediate data instead of a temporary directory")
+        parser.add_argument('--scratch_budget', type=int, default=None, help="With --pipeline, hold back new products while intermediate files take up more than this (MB, optional)")
+        parser.add_argument('--min_sun_elevation', type=float, default=None, help="Skip scenes taken with the sun lower than this, such as dark winter scenes (degrees, optional)")
+        parser.add_argument('--frame_store', type=str, default=None, help="Location of a persistent store of rendered frames, so only new scenes are processed on later runs")
+        parser.add_argument('--cube', action='store_true', default=False, help="Write the reprojected and merged stack as a chunked Zarr datacube with dimensions (time, band, y, x) instead of a movie")
+        parser.add_argument('--chunks', type=str, default='1,512,512', help="Chunk shape of the datacube as time,y,x: small time chunks favor reading whole scenes, large ones reading time series of a few pixels (default 1,512,512)")
+        parser.add_argument('--cube_level', type=int, default=5, help="zlib compression level of the datacube, 0 to store chunks uncompressed so they can be memory-mapped (default 5)")
+        parser.add_argument('--pipe_frames', action='store_true', default=False, help="Pipe raw frames into ffmpeg instead of writing intermediate JPEG files")
+        parser.add_argument('--trace', type=str, default=None, help="Write timing, CPU, I/O and memory records for every operation, job and download to this JSON lines file (optional)")
+        parser.add_argument('--chrome_trace', type=str, default=None, help="With --trace, also write the records as a Chrome trace viewable in chrome://tracing or Perfetto (optional)")
+        parser.add_argument('--pipeline', action='store_true', default=False, help="Process each product as soon as it is downloaded instead of one stage at a time")
+        parser.add_argument('--pipeline_depth', type=int, default=4, help="Number of products that may wait between pipeline stages (default 4)")
         parser.set_defaults(func=cls.run)
     
     @classmethod
-    def run(cls, args):
+    def run(cls, args, res=None):
+        if res is None:
+            with resources.from_args(args) as res:
+                return cls.run(args, res)
+
         if args.band is None:
             args.band = [4, 3, 2]
+        # a datacube keeps the resolution of the products unless -w asks for less, frames are scaled to fit a video
+        if args.width is None and not args.cube:
+            args.width = 1080
+
+        storage = storage_policy(block_size=args.block_size, compress=args.compress, level=args.compress_level, reflectance=args.reflectance_type)
+        # calibrated bands stored as uint16 stay scaled all the way to the frames, so they are scaled for display
+        # (or described in the cube's attributes) in stored units
+        scaled = args.calibrate and storage.reflectance == 'uint16'
 
-        if args.calibrate:
+        if scaled:
+            scale_parms = [stored_reflectance(0), stored_reflectance(1), 0, 255]
+        elif args.calibrate:
             scale_parms = [0, 1, 0, 255]
         else:
             scale_parms = [0, 65536, 0, 255]
 
-        pool = multiprocessing.Pool(args.num_workers)
+        chunks = tuple(int(v) for v in args.chunks.split(','))
+        if len(chunks) != 3:
+            raise ValueError('--chunks takes three sizes: time,y,x')
+        # a datacube takes any number of bands, a video only one or three
+        if not args.cube:
+            check_frame_bands(len(args.band))
 
-        with tempfilemanager(args.keepfiles, args.keepfiles is not None) as mgr:
+        check_scratch(res.pool, args.keepfiles)
+        scratch_budget = None if args.scratch_budget is None else args.scratch_budget * 1024 * 1024
+        with tracer(args.trace, args.chrome_trace) as tr, tempfilemanager(args.keepfiles, args.keepfiles is not None, scratch_budget) as mgr, contextlib.ExitStack() as scope:
+            pool = scheduled_pool(tr.pool(res.pool), res.scheduler)
+            io_pool = tr.pool(res.io_pool)
+            if res.artifacts is not None:
+                pool = memo_pool(pool, res.artifacts)
+                io_pool = memo_pool(io_pool, res.artifacts)
+            cache = res.cache
+            metadata = res.metadata
+            dl = res.downloader.traced(tr)
 
             LOGGER.info("Loading scene list...")
-            sc = scenelist.load_or_acquire(args.scene_list)
+            sc = res.scenes(args.scene_list, args.catalog, args.refresh_catalog)
 
             LOGGER.info("Filtering scene list...")
-            sc = sc.filter(lambda df: (df.row == args.row) & (df.path == args.path) & (df.acquisitionDate >= args.start) & (df.acquisitionDate <= args.end))
+            sc = sc.cell(args.path, args.row, args.start, args.end)
             sc = sc.sort('acquisitionDate')
             sc = sc.remove_duplicates()
 
+            if args.min_sun_elevation is not None:
+                # sun elevation is only in the MTL files, so every candidate scene's metadata goes into the catalog
+                # first (a temporary one without --metadata_catalog, closed with the run)
+                if metadata is None:
+                    metadata = scope.enter_context(metadatacatalog(':memory:'))
+                with tr.span('metadata'):
+                    metadata.fill(sc.all(), dl, mgr)
+                sc = sc.join_metadata(metadata, ['sun_elevation']).filter(lambda df: df.sun_elevation >= args.min_sun_elevation)
+
             min_lat = np.inf
             max_lat = -np.inf
             min_lon = np.inf
@@ -66,13 +136,92 @@ class timelapse_workflow (object):
                 min_lon = min(min_lon, row.min_lon)
                 max_lon = max(max_lon, row.max_lon)
 
-            data = product_set.acquire(pool, mgr, sc, [(args.path, args.row)], args.calibrate, args.band, most_recent_only=False)
+            bounding_box = [min_lon, min_lat, max_lon, max_lat]
+
+            # frames end up args.width wide, so unless asked otherwise warp straight to that instead of full resolution
+            warp_width = None if args.full_resolution else args.width
+            resample = None if warp_width is None else args.resample
+            if args.cube and warp_width is None:
+                # every time step of the cube has to be on the same grid, by default at the resolution of the products
+                warp_width = native_width(bounding_box)
+
+            entries = product_set.select(sc, [(args.path, args.row)], most_recent_only=False)
+
+            # with a frame store only frames that haven't been rendered for this footprint yet go through processing
+            store = None
+            render = entries
+            frame_scale_parms = scale_parms
+            if args.frame_store is not None and not args.cube:
+                store = framestore(args.frame_store, args.path, args.row, args.band, args.width, args.calibrate)
+                render = store.missing(entries, bounding_box)
+                frame_scale_parms = [0, 255, 0, 255]
+                LOGGER.info("Rendering {:d} of {:d} frames...".format(len(render), len(entries)))
+            render_jpeg = not args.cube and (store is not None or not args.pipe_frames)
+
+            if args.calibrate and metadata is not None:
+                # one batched pass for the products missing from the metadata catalog, rather than a request per product
+                # (so acquiring them doesn't fill it again)
+                with tr.span('metadata'):
+                    metadata.fill(render, dl, mgr)
+
+            if args.pipeline:
+                stages = [stage('acquire', lambda prod_id, entry: product_set.acquire_products(io_pool, mgr, [entry], args.calibrate, args.band, cache, dl, metadata=metadata, fill_metadata=False)[prod_id], args.io_workers)]
+                if args.calibrate:
+                    stages.append(operation_stage('calibrate', calibrate, pool, mgr, args.max_memory * 1024 * 1024, args.lazy, storage, workers=args.num_workers))
+                if args.stack:
+                    stages.append(operation_stage('stack', stack, pool, mgr, args.band, workers=args.num_workers))
+                stages.append(operation_stage('reproject', reproject, pool, mgr, bounding_box, warp_width, resample, storage, workers=args.num_workers))
+                if not args.stack:
+                    stages.append(operation_stage('merge', merge, pool, mgr, args.lazy, storage, workers=args.num_workers))
+                if render_jpeg:
+                    stages.append(operation_stage('to_jpeg', to_jpeg, pool, mgr, scale_parms, args.width, workers=args.num_workers))
+                results = pipeline(stages, args.pipeline_depth, tr, mgr).run((e.id, e) for e in render)
+                data = product_set({e.id: results[e.id] for e in render})
+            else:
+                with tr.span('acquire'):
+                    data = product_set.acquire_products(io_pool, mgr, render, args.calibrate, args.band, cache, dl, metadata=metadata, fill_metadata=False)
+
+                if args.calibrate:
+                    with tr.span('calibrate'):
+                        data = calibrate(pool, mgr, data, args.max_memory * 1024 * 1024, args.lazy, storage)
+
+                if args.stack:
+                    with tr.span('stack'):
+                        data = stack(pool, mgr, data, args.band)
+
+                with tr.span('reproject'):
+                    data = reproject(pool, mgr, data, bounding_box, warp_width, resample, storage)
+                if not args.stack:
+                    with tr.span('merge'):
+                        data = merge(pool, mgr, data, args.lazy, storage)
+                if render_jpeg:
+                    with tr.span('to_jpeg'):
+                        data = to_jpeg(pool, mgr, data, scale_parms, args.width)
+
+            # every memoized job and download of this run is done, so the artifact store and download cache are trimmed
+            # once here
+            if res.artifacts is not None:
+                res.artifacts.evict()
+            if res.cache is not None:
+                res.cache.evict()
+
+            if args.cube:
+                with tr.span('datacube'):
+                    datacube(pool, mgr, data, args.output, {e.id: e.date for e in entries}, args.band, chunks, args.cube_level, scaling=(REFLECTANCE_SCALE, REFLECTANCE_OFFSET) if scaled else None)
+                return
 
-            if args.calibrate:
-                data = calibrate(pool, mgr, data)
+            if store is not None:
+                for e in render:
+                    store.put(e, bounding_box, data[e.id].band('merged'))
+                    mgr.release([data[e.id].band('merged')])
+                store.save()
+                data = product_set({e.id: product(None, {'merged': store.frame(e.id)}) for e in entries})
 
-            data = reproject(pool, mgr, data, [min_lon, min_lat, max_lon, max_lat])
-            data = merge(pool, mgr, data)
-            data = to_jpeg(pool, mgr, data, scale_parms, args.width)
-            data = ffmpeg(pool, mgr, data, args.rate)
-            shutil.move(data['ffmpeg'].band('merged'), args.output)           
+            if args.pipe_frames:
+                with tr.span('ffmpeg_stream'):
+                    data = ffmpeg_stream(pool, mgr, data, frame_scale_parms, args.width, args.rate, args.num_workers * 2)
+            else:
+                with tr.span('ffmpeg'):
+                    data = ffmpeg(pool, mgr, data, args.rate)
+            with tr.span('write_output'):
+                shutil.move(data['ffmpeg'].band('merged'), args.output)           
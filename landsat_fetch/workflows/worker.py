@@ -0,0 +1,17 @@
+
+from ..executors import run_worker
+
+__all__ = ['worker_workflow']
+
+class worker_workflow (object):
+    @classmethod
+    def register(cls, subparsers):
+        parser = subparsers.add_parser('worker')
+        parser.add_argument("queue_dir", type=str, help="Shared job queue directory, as passed to a workflow with --executor shared")
+        parser.add_argument("-n", "--num_workers", type=int, default=4, help="Number of worker processes to run on this host")
+        parser.add_argument("--idle_exit", type=float, default=None, help="Exit after this many seconds without a job (optional)")
+        parser.set_defaults(func=cls.run)
+
+    @classmethod
+    def run(cls, args):
+        run_worker(args.queue_dir, args.num_workers, idle_exit=args.idle_exit)